@@ -0,0 +1,90 @@
+FUNCTIONS = ("sum", "min", "max")
+
+def pop_functions(params):
+    """Removes the aggregate functions from the params of a query
+
+    :param params: A dictionary with filters and functions, e.g.
+        {"sum": "price", "animal": "lion"}
+    :returns: A list of (function name, column name)
+    """
+    return [(name, params.pop(name)) for name in FUNCTIONS if name in params]
+
+def empty(functions):
+    """Returns the result of the functions over no rows
+    """
+    return dict((name, 0 if name == "sum" else None)
+        for name, column in functions)
+
+def accumulate(result, functions, row):
+    """Adds the values of a row to the partial result of the functions
+
+    Rows without the column or with None are ignored.
+    """
+    for name, column in functions:
+        value = row.get(column)
+        if value is None:
+            continue
+        current = result[name]
+        if name == "sum":
+            result[name] = current + value
+        elif current is None or \
+                (value < current if name == "min" else value > current):
+            result[name] = value
+
+def combine(result, functions, other):
+    """Adds a partial result to another partial result of the functions
+    """
+    for name, column in functions:
+        value = other[name]
+        if value is None:
+            continue
+        current = result[name]
+        if name == "sum":
+            result[name] = current + value
+        elif current is None or \
+                (value < current if name == "min" else value > current):
+            result[name] = value
+
+def aggregate_rows(rows, functions):
+    """Applies the functions to the rows while they are iterated
+
+    :param rows: An iterable of rows
+    :param functions: A list of (function name, column name)
+    :returns: A dictionary of function name -> value
+    """
+    result = empty(functions)
+    for row in rows:
+        accumulate(result, functions, row)
+    return result
+
+def group_rows(rows, column, functions):
+    """Counts the rows and applies the functions for every value of column
+
+    Rows without the column are counted in the None group.
+
+    :param rows: An iterable of rows
+    :param column: The name of the column used to group
+    :param functions: A list of (function name, column name)
+    :returns: A dictionary of value -> dictionary of function name -> value
+    """
+    groups = {}
+    for row in rows:
+        value = row.get(column)
+        result = groups.get(value)
+        if result is None:
+            result = groups[value] = empty(functions)
+            result["count"] = 0
+        result["count"] += 1
+        accumulate(result, functions, row)
+    return groups
+
+def combine_groups(groups, functions, other):
+    """Adds the groups of other to groups, see group_rows
+    """
+    for value, partial in other.items():
+        result = groups.get(value)
+        if result is None:
+            groups[value] = dict(partial)
+        else:
+            result["count"] += partial["count"]
+            combine(result, functions, partial)
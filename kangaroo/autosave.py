@@ -0,0 +1,152 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class AutoSave(object):
+    def __init__(self, save, interval=None, changes=None):
+        """Saves a bucket from a background thread
+
+        The bucket is saved every "interval" seconds if something changed
+        and as soon as "changes" changes were made. Flush requests are
+        coalesced: the requests that arrive while the bucket is being saved
+        are served together by the next save (group commit).
+
+        Example:
+            >> autosave = AutoSave(save, interval=5)
+            >> autosave.start()
+            >> autosave.flush()
+
+        :param save: A callable that saves the bucket
+        :param interval: The maximum number of seconds that a change waits
+            to be saved, None to not save by time.
+        :param changes: The number of changes that triggers a save, None to
+            not save by number of changes.
+        """
+        self.save = save
+        self.interval = interval
+        self.changes = changes
+        self.pending = 0
+        self.requested = 0
+        self.started = 0
+        self.saved = 0
+        self.failed = 0
+        self.error = None
+        self.running = False
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        """Starts the thread that saves the bucket
+        """
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self.__run,
+            name="kangaroo-autosave")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Saves the pending changes and stops the thread
+        """
+        with self.condition:
+            if not self.running:
+                return
+            if self.pending > 0:
+                self.__request()
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+        self.thread = None
+
+    def table_changed(self, event, table, row, key):
+        """Counts the changes of the tables, see TableEvents
+        """
+        with self.condition:
+            self.pending += 1
+            if self.changes is not None and self.pending >= self.changes:
+                self.__request()
+            elif self.pending == 1 and self.interval is not None:
+                # the thread starts counting the interval
+                self.condition.notify_all()
+
+    def __request(self):
+        # The condition has to be held. A save that already started may not
+        # include the last changes, so only the save that didn't start yet
+        # is shared.
+        if self.requested == self.started:
+            self.requested += 1
+            self.condition.notify_all()
+        return self.requested
+
+    def request(self):
+        """Asks the thread to save the bucket
+
+        :returns: A number that can be passed to wait
+        """
+        with self.condition:
+            if not self.running:
+                raise Exception("The autosave is not running")
+            return self.__request()
+
+    def wait(self, ticket):
+        """Waits until the save requested by request is finished
+
+        :param ticket: The number returned by request
+        :raises: The exception raised by the save if it failed
+        """
+        with self.condition:
+            while self.saved < ticket and self.failed < ticket:
+                self.condition.wait()
+            if self.saved < ticket:
+                raise self.error
+
+    def flush(self):
+        """Saves the bucket from the thread and waits until it's saved
+        """
+        self.wait(self.request())
+
+    def __next_save(self):
+        # waits for a request or the end of the interval, returns the
+        # number of the request that the save serves or None to stop
+        with self.condition:
+            deadline = None
+            while True:
+                if self.requested > self.started:
+                    self.started = self.requested
+                    self.pending = 0
+                    return self.started
+                if not self.running:
+                    return None
+                timeout = None
+                if self.interval is not None and self.pending > 0:
+                    if deadline is None:
+                        deadline = time.time() + self.interval
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        self.requested += 1
+                        self.started = self.requested
+                        self.pending = 0
+                        return self.started
+                self.condition.wait(timeout)
+
+    def __run(self):
+        while True:
+            ticket = self.__next_save()
+            if ticket is None:
+                return
+            try:
+                self.save()
+            except Exception as e:
+                logger.exception("The autosave of the bucket failed")
+                with self.condition:
+                    self.error = e
+                    self.failed = ticket
+                    self.condition.notify_all()
+            else:
+                with self.condition:
+                    self.saved = ticket
+                    self.condition.notify_all()
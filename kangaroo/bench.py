@@ -0,0 +1,376 @@
+"""Benchmarks of kangaroo
+
+The suite measures inserts, queries, index builds and storages over the
+cities of tests/tb_cidades.csv and synthetic tables of 10k, 100k and 1M 
+rows. Results are printed as json, so they can be saved and compared 
+between commits.
+
+Example:
+    > python -m kangaroo.bench --output before.json
+    > python -m kangaroo.bench suite --sizes 10000 100000 --repeat 5
+    > python -m kangaroo.bench contention --threads 4 --rows 10000
+    > python -m kangaroo.bench parallel_scan --rows 1000000
+"""
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from kangaroo.bucket import Bucket
+from kangaroo.table import Table
+
+CIDADES_PATH = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "tests", "tb_cidades.csv")
+
+# column and value of every operator for every kind of dataset
+SYNTHETIC_QUERIES = {
+    "eq": ("group", 7),
+    "in": ("group", [1, 2, 3]),
+    "gt": ("score", 0.99),
+    "gte": ("score", 0.99),
+    "range": ("score", (0.1, 0.11)),
+    "contains": ("name", "ab"),
+    "startswith": ("name", "ab"),
+    "endswith": ("name", "yz")
+}
+CIDADES_QUERIES = {
+    "eq": ("state", '"SP"'),
+    "in": ("state", ['"SP"', '"RJ"']),
+    "gt": ("code", "9000"),
+    "gte": ("code", "9000"),
+    "range": ("code", ("1000", "1100")),
+    "contains": ("name", "Santa"),
+    "startswith": ("name", '"Sao'),
+    "endswith": ("name", 'polis"')
+}
+# the operators that every kind of index resolves, see kangaroo.index
+INDEX_OPERATORS = {
+    "hash": ("eq", "in"),
+    "sorted": ("eq", "in", "gt", "gte", "range", "startswith")
+}
+
+def synthetic_rows(size, seed=0):
+    """Returns a list of random rows, the same for the same seed
+
+    :param size: The number of rows
+    :param seed: The seed of the random generator
+    :returns: A list of dictionaries
+    """
+    generator = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    rows = []
+    for i in range(size):
+        rows.append(dict(id=i, group=generator.randrange(100),
+            score=generator.random(), 
+            name="".join(generator.choice(letters) for j in range(8))))
+    return rows
+
+def cidades_rows(path=CIDADES_PATH):
+    """Returns the cities of tb_cidades.csv as a list of rows
+    """
+    with open(path, "r") as f:
+        return [dict(code=r[0], state_code=r[1], state=r[2], name=r[3]) 
+            for r in csv.reader(f, quotechar="|")]
+
+def measure(function, repeat):
+    """Returns the median of the seconds that function takes
+    """
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+def peak_memory(function):
+    """Returns the peak of memory in bytes allocated while function runs
+    """
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def bench_inserts(rows, repeat):
+    """Measures the rows per second of insert and insert_many
+    """
+    def insert():
+        table = Table("bench")
+        for row in rows:
+            table.insert(row)
+
+    def insert_many():
+        Table("bench").insert_many(rows)
+
+    return dict(
+        insert_rows_per_second=round(len(rows) / measure(insert, repeat)),
+        insert_many_rows_per_second=round(len(rows) / 
+            measure(insert_many, repeat)))
+
+def bench_indexes(rows, columns, repeat):
+    """Measures the seconds that add_index takes for every kind of index
+    """
+    table = Table("bench")
+    table.insert_many(rows)
+    result = {}
+    for column in columns:
+        for kind in INDEX_OPERATORS:
+            def build():
+                table.add_index(column, kind=kind)
+                table.delete_index(column)
+            result["{0}_{1}".format(column, kind)] = measure(build, repeat)
+    return result
+
+def bench_queries(rows, queries, repeat):
+    """Measures the latency of find_all for every operator
+
+    Every operator is measured without index and with every kind of index
+    that resolves it.
+
+    :returns: A dictionary of operator -> access -> seconds
+    """
+    table = Table("bench")
+    table.insert_many(rows)
+    result = {}
+    for operator, (column, value) in sorted(queries.items()):
+        params = {"{0}__{1}".format(column, operator): value}
+        latencies = {}
+        latencies["scan"] = measure(lambda: table.find_all(**params), repeat)
+        for kind, operators in sorted(INDEX_OPERATORS.items()):
+            if operator in operators:
+                table.add_index(column, kind=kind)
+                latencies[kind] = measure(lambda: table.find_all(**params),
+                    repeat)
+                table.delete_index(column)
+        latencies["rows"] = len(table.find_all(**params))
+        result[operator] = latencies
+    return result
+
+def bench_storages(rows, formats, repeat):
+    """Measures the dump and load of a bucket with every storage
+
+    :returns: A dictionary of format -> measures
+    """
+    result = {}
+    directory = tempfile.mkdtemp(prefix="kangaroo-bench-")
+    try:
+        for storage_format in formats:
+            path = os.path.join(directory, "bench." + storage_format)
+            options = dict(table_name="bench", infer_types=True)
+            bucket = Bucket(storage_format=storage_format, storage_path=path,
+                storage_options=options)
+            bucket.bench.insert_many(rows)
+
+            def load():
+                Bucket(storage_format=storage_format, storage_path=path,
+                    storage_options=options).bench
+
+            result[storage_format] = dict(
+                dump_seconds=measure(bucket.flush, repeat),
+                dump_peak_bytes=peak_memory(bucket.flush),
+                load_seconds=measure(load, repeat),
+                load_peak_bytes=peak_memory(load),
+                file_bytes=os.path.getsize(path))
+    finally:
+        shutil.rmtree(directory)
+    return result
+
+def environment():
+    """Returns the versions of python and kangaroo used by the suite
+    """
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(python=sys.version.split()[0], 
+        implementation=platform.python_implementation(),
+        platform=platform.platform(), cpus=os.cpu_count(), commit=commit,
+        time=time.time())
+
+def suite(sizes=(10000, 100000, 1000000), repeat=3, 
+    formats=("pickle", "json", "csv"), cidades=CIDADES_PATH):
+    """Runs every benchmark over every dataset
+
+    :param sizes: The number of rows of the synthetic datasets
+    :param repeat: The number of times that every measure runs, the 
+        median is reported
+    :param formats: The storages measured
+    :param cidades: The path of tb_cidades.csv, None to skip it
+    :returns: A dictionary that can be saved as json
+    """
+    datasets = []
+    if cidades is not None and os.path.exists(cidades):
+        datasets.append(("cidades", cidades_rows(cidades), CIDADES_QUERIES))
+    for size in sizes:
+        datasets.append(("synthetic_{0}".format(size), synthetic_rows(size),
+            SYNTHETIC_QUERIES))
+
+    result = dict(environment=environment(), repeat=repeat, datasets={})
+    for name, rows, queries in datasets:
+        columns = sorted(set(c for c, v in queries.values()))
+        result["datasets"][name] = dict(
+            rows=len(rows),
+            inserts=bench_inserts(rows, repeat),
+            indexes=bench_indexes(rows, columns, repeat),
+            queries=bench_queries(rows, queries, repeat),
+            storages=bench_storages(rows, formats, repeat))
+    return result
+
+def contention(threads=4, rows=10000, duration=2.0):
+    """Measures the throughput of readers and a writer sharing a table
+
+    Reader threads run an indexed find_all and a full scan in a loop while
+    a writer thread updates an indexed column. It runs once with the locks
+    of the table and once with every operation behind a single global lock,
+    the way an application serializes a table that isn't thread safe.
+
+    :param threads: The number of reader threads
+    :param rows: The number of rows in the table
+    :param duration: The number of seconds that every mode runs
+    :returns: A dictionary with the reads and writes per second of every
+        mode
+    """
+    results = {}
+    for mode in ("table_lock", "global_lock"):
+        table = Table("bench", tbl_index=["group"])
+        table.insert_many(dict(group=i % 100, number=i) for i in range(rows))
+        if mode == "global_lock":
+            shared = threading.Lock()
+            read_lock = write_lock = shared
+        else:
+            read_lock = write_lock = None
+
+        counters = dict(reads=0, writes=0)
+        stop = threading.Event()
+
+        def reader(n):
+            reads = 0
+            while not stop.is_set():
+                if read_lock is None:
+                    table.find_all(group=n % 100)
+                    table.find_all(number__gt=rows - 10)
+                else:
+                    with read_lock:
+                        table.find_all(group=n % 100)
+                        table.find_all(number__gt=rows - 10)
+                reads += 2
+                n += 1
+            counters["reads"] += reads
+
+        def writer():
+            # updates keep the size of the table, so both modes scan the 
+            # same number of rows
+            writes = 0
+            while not stop.is_set():
+                row = table.get_row(writes % rows + 1)
+                if write_lock is None:
+                    row["group"] = (row["group"] + 1) % 100
+                else:
+                    with write_lock:
+                        row["group"] = (row["group"] + 1) % 100
+                writes += 1
+            counters["writes"] += writes
+
+        workers = [threading.Thread(target=reader, args=(i,))
+            for i in range(threads)]
+        workers.append(threading.Thread(target=writer))
+        start = time.time()
+        for w in workers:
+            w.start()
+        time.sleep(duration)
+        stop.set()
+        for w in workers:
+            w.join()
+        elapsed = time.time() - start
+        results[mode] = dict(
+            reads_per_second=round(counters["reads"] / elapsed, 1),
+            writes_per_second=round(counters["writes"] / elapsed, 1))
+    return results
+
+def parallel_scan(rows=1000000, processes=None):
+    """Measures the time of a full scan with and without a process pool
+
+    The parallel times include forking the processes of the pool, which
+    happens on every scan.
+
+    :param rows: The number of rows in the table
+    :param processes: A list with the number of processes to measure, by
+        default every power of two up to the number of cpus.
+    :returns: A dictionary with the seconds of the serial scan and the 
+        seconds and speedup of every number of processes
+    """
+    if processes is None:
+        cpus = os.cpu_count() or 1
+        processes = [1]
+        while processes[-1] * 2 <= cpus:
+            processes.append(processes[-1] * 2)
+
+    table = Table("bench")
+    table.insert_many(dict(number=i, name="row {0}".format(i)) 
+        for i in range(rows))
+
+    def run():
+        start = time.time()
+        table.find_all(number__gt=rows // 2, name__contains="9")
+        return time.time() - start
+
+    serial = min(run() for i in range(3))
+    result = dict(rows=rows, cpus=os.cpu_count(), serial_seconds=serial,
+        parallel={})
+    for n in processes:
+        table.enable_parallel_scan(threshold=0, processes=n)
+        seconds = min(run() for i in range(3))
+        table.disable_parallel_scan()
+        result["parallel"][n] = dict(seconds=seconds, 
+            speedup=round(serial / seconds, 2))
+    return result
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="python -m kangaroo.bench",
+        description="Runs the benchmarks of kangaroo")
+    parser.add_argument("benchmark", nargs="?", default="suite",
+        choices=["suite", "contention", "parallel_scan"])
+    parser.add_argument("--sizes", type=int, nargs="+", 
+        default=[10000, 100000, 1000000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--formats", nargs="+", 
+        default=["pickle", "json", "csv"])
+    parser.add_argument("--cidades", default=CIDADES_PATH)
+    parser.add_argument("--output", default=None,
+        help="the file where the json is saved instead of printing it")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--rows", type=int, default=None)
+    parser.add_argument("--duration", type=float, default=2.0)
+    args = parser.parse_args(args)
+
+    if args.benchmark == "suite":
+        result = suite(sizes=args.sizes, repeat=args.repeat,
+            formats=args.formats, cidades=args.cidades)
+    elif args.benchmark == "contention":
+        result = contention(threads=args.threads, rows=args.rows or 10000,
+            duration=args.duration)
+    else:
+        result = parallel_scan(rows=args.rows or 1000000)
+
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+if __name__ == "__main__":
+    main()
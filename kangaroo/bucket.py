@@ -1,44 +1,176 @@
-import os 
+import asyncio
+import contextlib
+import threading
 
-from kangaroo.storage import StorageCPickle, StorageJson, StorageCsv
+from kangaroo.autosave import AutoSave
+from kangaroo.join import hash_join
+from kangaroo.partition import PartitionedTable
+from kangaroo.profiling import Profiler
+from kangaroo.storage import StorageCPickle, StorageJson, StorageCsv, \
+    StorageLog, StorageBinary, StorageJsonLines, StorageDirectory
 from kangaroo.table import Table
+from kangaroo.columnar import ColumnarTable
 
 class Bucket(object):
+    # the table that describes the partitioned tables of the bucket
+    PARTITIONS = "__partitions__"
+
     def __init__(self, storage_format=None, storage_path=None, 
-        storage_options={}):
+        storage_options={}, table_format=None):
         """Creates a new Bucket instance.
 
         :param storage_path: a valid path where we want to save the information.
         :param storage_format: a valid format with you want to use to save 
-            information. Valid values are [None, "pickle", "json"].
+            information. Valid values are [None, "pickle", "json", "jsonl",
+            "csv", "log", "binary", "directory"].
             If it's None, the information will be keeped in memory and 
             storage_path will be ignored
         :param storage_options: a dictionary with specific options for every
             storage. 
+        :param table_format: the kind of table that the bucket creates. 
+            Valid values are [None, "compact", "columnar"]. If it's None the
+            tables are instances of kangaroo.Table, "compact" creates 
+            instances of kangaroo.Table with compact rows and "columnar" 
+            creates instances of kangaroo.columnar.ColumnarTable (it 
+            requires numpy).
         """
         self.__tables = {}
         self.__storage = None
+        self.__autosave = None
+        self.__partitions = {}
+        self.__profiler = None
+        self.__lock = threading.RLock()
+
+        self.__table_options = {}
+        if table_format is None:
+            self.__table_class = Table
+        elif table_format == "compact":
+            self.__table_class = Table
+            self.__table_options = dict(compact=True)
+        elif table_format == "columnar":
+            self.__table_class = ColumnarTable
+        else:
+            raise Exception("Invalid table format")
 
         if storage_format == "pickle":
             self.__storage = StorageCPickle(storage_path, self, storage_options)
         elif storage_format == "json":
             self.__storage = StorageJson(storage_path, self, storage_options)
+        elif storage_format == "jsonl":
+            self.__storage = StorageJsonLines(storage_path, self, 
+                storage_options)
         elif storage_format == "csv":
             self.__storage = StorageCsv(storage_path, self, storage_options)
+        elif storage_format == "log":
+            self.__storage = StorageLog(storage_path, self, storage_options)
+        elif storage_format == "directory":
+            self.__storage = StorageDirectory(storage_path, self, 
+                storage_options)
+        elif storage_format == "binary":
+            self.__storage = StorageBinary(storage_path, self, storage_options)
         elif storage_format is None:
             self.__storage = None
         else:
             raise Exception("Invalid storage format")
 
-        if storage_path is not None and os.path.exists(storage_path):
+        if self.__storage is not None and self.__storage.exists():
             self.__storage.load()
 
     def __getattr__(self, name):
-        if name in self.__tables:
-            return self.__tables[name]
-        table = self.add_table(Table(tbl_name=name))
+        table = self.__tables.get(name)
+        if table is not None:
+            return table
+        with self.__lock:
+            # another thread could have created the table while we waited
+            if name in self.__tables:
+                return self.__tables[name]
+            partitioned = self.__partitioned_table(name)
+            if partitioned is not None:
+                return partitioned
+            table = None
+            if self.__storage is not None:
+                # storages that load tables on demand decode it the first 
+                # time that it's used
+                table = self.__storage.load_table(name)
+            if table is None:
+                table = self.make_table(tbl_name=name)
+            return self.add_table(table)
+
+    def __partitioned_table(self, name):
+        table = self.__partitions.get(name)
+        if table is not None or name == self.PARTITIONS or \
+                self.PARTITIONS not in self.table_names:
+            return table
+        description = getattr(self, self.PARTITIONS).find(tbl_name=name)
+        if description is None:
+            return None
+        table = PartitionedTable(name, description["key"], 
+            description["shards"], lambda n: getattr(self, n),
+            boundaries=description["boundaries"])
+        self.__partitions[name] = table
+        return table
+
+    def add_partitioned_table(self, tbl_name, key, shards=8, 
+        boundaries=None, tbl_index=[], tbl_index_kinds={}):
+        """Creates a table split in shards by the value of a column
+
+        Every shard is a table of the bucket named "<tbl_name>#<number>", 
+        so it's saved and loaded on its own by the storage. The description
+        of the partitioned tables is kept in the "__partitions__" table.
+        See kangaroo.partition.PartitionedTable. Buckets of columnar tables
+        can't partition them, the rows of a columnar table can't be moved
+        to other shard.
+
+        Example:
+            >> bucket.add_partitioned_table("cities", "state", shards=16)
+            >> bucket.add_partitioned_table("sales", "year", shards=3,
+            ..     boundaries=[2000, 2010])
+
+        :param tbl_name: The name of the table
+        :param key: The name of the column used to partition the rows
+        :param shards: The number of shards
+        :param boundaries: A sorted list of shards - 1 values to partition 
+            by ranges, None to partition by hash.
+        :param tbl_index: a list of index names of every shard
+        :param tbl_index_kinds: a dictionary of index name -> kind of index
+        :returns: An instance of kangaroo.partition.PartitionedTable
+        :raises: Exception if the bucket creates columnar tables
+        """
+        if self.__table_class is ColumnarTable:
+            raise Exception("Columnar tables can't be partitioned")
+        with self.__lock:
+            if tbl_name in self.table_names or \
+                    self.__partitioned_table(tbl_name) is not None:
+                raise Exception("The table already exists")
+            table = PartitionedTable(tbl_name, key, shards, 
+                lambda n: getattr(self, n), boundaries=boundaries)
+            for name in table.shard_names:
+                self.add_table(self.make_table(tbl_name=name, 
+                    tbl_index=tbl_index, tbl_index_kinds=tbl_index_kinds))
+            getattr(self, self.PARTITIONS).insert(dict(tbl_name=tbl_name, 
+                key=key, shards=shards, boundaries=boundaries))
+            self.__partitions[tbl_name] = table
         return table
 
+    def __lazy_tables(self):
+        if self.__storage is None:
+            return []
+        return self.__storage.lazy_tables()
+
+    def make_table(self, tbl_name, tbl_index=[], tbl_index_kinds={}):
+        """Creates a new table of the format used by the bucket
+
+        The table is not added to the bucket.
+
+        :param tbl_name: The name of the table
+        :param tbl_index: a list of index names
+        :param tbl_index_kinds: a dictionary of index name -> kind of index
+        :returns: An instance of kangaroo.Table or 
+            kangaroo.columnar.ColumnarTable
+        """
+        return self.__table_class(tbl_name=tbl_name, tbl_index=tbl_index,
+            tbl_index_kinds=tbl_index_kinds, **self.__table_options)
+
     def add_table(self, table):
         """Adds a new table to the bucket
         
@@ -46,9 +178,18 @@ class Bucket(object):
         :returns: the same instance added in table
 
         """
-        if table.tbl_name in self.__tables:
-            raise Exception("The table already exists")
-        self.__tables[table.tbl_name] = table
+        with self.__lock:
+            if table.tbl_name in self.__tables or \
+                    table.tbl_name in self.__lazy_tables():
+                raise Exception("The table already exists")
+            self.__tables[table.tbl_name] = table
+            if self.__storage is not None:
+                self.__storage.table_added(table)
+            if self.__autosave is not None:
+                table.add_listener(self.__autosave.table_changed)
+                self.__autosave.table_changed("add_table", table, None, None)
+            if self.__profiler is not None:
+                table.enable_profiling(self.__profiler)
         return table
     
     def delete_table(self, tbl_name):
@@ -59,20 +200,176 @@ class Bucket(object):
         :param tbl_table: the name of the table that we want to delete.
         :raises: Exception
         """
-        if tbl_name in self.__tables:
-            del self.__tables[tbl_name]
-        else:
-            raise Exception("The table {0} Does't no exists".format(name))
+        with self.__lock:
+            partitioned = self.__partitioned_table(tbl_name)
+            if partitioned is not None:
+                for name in partitioned.shard_names:
+                    self.delete_table(name)
+                partitions = getattr(self, self.PARTITIONS)
+                partitions.delete_row(partitions.find(tbl_name=tbl_name))
+                del self.__partitions[tbl_name]
+                return
+
+            if tbl_name in self.__lazy_tables():
+                getattr(self, tbl_name)
+
+            if tbl_name in self.__tables:
+                table = self.__tables.pop(tbl_name)
+                if self.__storage is not None:
+                    self.__storage.table_deleted(table)
+                if self.__autosave is not None:
+                    table.remove_listener(self.__autosave.table_changed)
+                    self.__autosave.table_changed("delete_table", table, None,
+                        None)
+            else:
+                raise Exception("The table {0} Does't no exists".format(
+                    tbl_name))
 
     @property
     def tables(self):
         """Returns the list of available tables
+
+        Tables that the storage didn't load yet are loaded.
         """
+        for name in self.__lazy_tables():
+            getattr(self, name)
         return list(self.__tables.values())
 
+    @property
+    def table_names(self):
+        """Returns the names of the available tables without loading them
+        """
+        names = list(self.__tables.keys())
+        for name in self.__lazy_tables():
+            if name not in self.__tables:
+                names.append(name)
+        return names
+
+    def join(self, left, right, left_on, right_on=None, left_filters=None,
+        right_filters=None, how="inner"):
+        """Joins the rows of two tables of the bucket, see 
+        kangaroo.join.hash_join
+
+        Example:
+            >> for order, customer in bucket.join("orders", "customers", 
+            ..         "customer_id", "id", left_filters=dict(total__gt=100)):
+            ..     print(customer.name, order.total)
+
+        :param left: The name of the left table or a table
+        :param right: The name of the right table or a table
+        :returns: An iterator of (left row, right row) tuples
+        """
+        if not hasattr(left, "tbl_name"):
+            left = getattr(self, left)
+        if not hasattr(right, "tbl_name"):
+            right = getattr(self, right)
+        return hash_join(left, right, left_on, right_on=right_on, 
+            left_filters=left_filters, right_filters=right_filters, how=how)
+
     def flush(self):
         """Saves the information from memory to disk
+
+        If the autosave is enabled the bucket is saved by the autosave 
+        thread, flushes made at the same time are saved together.
+        """
+        autosave = self.__autosave
+        if autosave is not None:
+            autosave.flush()
+        else:
+            self.__dump()
+
+    async def aflush(self):
+        """Saves the bucket without blocking the asyncio event loop
+
+        The bucket is saved in a thread of the default executor of the loop.
+
+        Example:
+            >> await bucket.aflush()
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.flush)
+
+    def __dump(self):
+        # The read side of every table is held while the storage saves it, 
+        # so the saved version of the bucket is consistent. Tables are 
+        # locked in the same order by every dump.
+        if self.__storage is None:
+            return
+        with self.__lock:
+            with contextlib.ExitStack() as stack:
+                for name in sorted(self.__tables):
+                    stack.enter_context(self.__tables[name].lock.reader)
+                self.__storage.dump()
+
+    def enable_autosave(self, interval=None, changes=None):
+        """Saves the bucket from a background thread
+
+        The bucket is saved every interval seconds if it changed and when 
+        the number of changes reaches changes. Changes wait for the save 
+        to finish while a table is being saved, reads are not blocked.
+
+        Example:
+            >> bucket.enable_autosave(interval=5, changes=10000)
+
+        :param interval: The maximum number of seconds that a change waits
+            to be saved
+        :param changes: The number of changes (inserts, updates and deletes)
+            that triggers a save
+        """
+        if self.__storage is None:
+            raise Exception("The bucket doesn't have a storage")
+        with self.__lock:
+            if self.__autosave is not None:
+                self.__autosave.interval = interval
+                self.__autosave.changes = changes
+                return
+            autosave = AutoSave(self.__dump, interval=interval,
+                changes=changes)
+            for table in self.__tables.values():
+                table.add_listener(autosave.table_changed)
+            self.__autosave = autosave
+        autosave.start()
+
+    def enable_profiling(self, slow_query_seconds=None, callback=None):
+        """Profiles the queries of every table of the bucket
+
+        Tables that are added or loaded later are profiled too. See 
+        kangaroo.profiling.Profiler.
+
+        Example:
+            >> profiler = bucket.enable_profiling(slow_query_seconds=0.1)
+            >> bucket.zoo.find_all(number__gt=10)
+            >> profiler.stats["zoo"]["rows_scanned"]
+
+        :param slow_query_seconds: The seconds that make a query slow, slow
+            queries are logged.
+        :param callback: A callable that receives the profile of every query
+        :returns: An instance of kangaroo.profiling.Profiler
+        """
+        with self.__lock:
+            self.__profiler = Profiler(slow_query_seconds=slow_query_seconds,
+                callback=callback)
+            for table in self.__tables.values():
+                table.enable_profiling(self.__profiler)
+        return self.__profiler
+
+    def disable_profiling(self):
+        """Stops profiling the queries of the tables of the bucket
+        """
+        with self.__lock:
+            self.__profiler = None
+            for table in self.__tables.values():
+                table.disable_profiling()
+
+    def disable_autosave(self):
+        """Saves the pending changes and stops the autosave thread
         """
-        if self.__storage is not None:
-            self.__storage.dump()
+        with self.__lock:
+            autosave = self.__autosave
+            if autosave is None:
+                return
+            self.__autosave = None
+            for table in self.__tables.values():
+                table.remove_listener(autosave.table_changed)
+        autosave.stop()
 
@@ -0,0 +1,122 @@
+import threading
+from collections import OrderedDict
+
+from kangaroo.filters import compile_filters
+from kangaroo.ordering import parse_order
+
+def freeze(value):
+    """Returns a hashable version of a filter value
+
+    :raises: TypeError if the value can't be hashed
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    elif isinstance(value, (set, frozenset)):
+        return frozenset(freeze(v) for v in value)
+    hash(value)
+    return value
+
+class QueryCache(object):
+    def __init__(self, max_size=128):
+        """A LRU cache of the results of Table.find_all
+
+        Queries that run at the same time can share the cache.
+
+        Entries are keyed by the normalized filters of the query and they
+        are invalidated with the events of the table: an insert or a delete
+        invalidates the entries whose filters match the row and an update
+        invalidates the entries that filter by the modified column. Rows in
+        the results are the rows of the table, so updates of other columns
+        are seen without invalidating anything.
+
+        :param max_size: The maximum number of results kept
+        """
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    @property
+    def stats(self):
+        """Returns the counters of the cache
+        :returns: A dictionary
+        """
+        return dict(hits=self.hits, misses=self.misses,
+            evictions=self.evictions, invalidations=self.invalidations,
+            size=len(self.entries), max_size=self.max_size)
+
+    def key(self, filters, limit, offset, order_by=None):
+        """Returns the key of a query
+
+        :param filters: A list of kangaroo.filters.Filter instances
+        :returns: None if the query can't be cached or a hashable key
+        """
+        try:
+            return (frozenset((f.key, f.name, freeze(f.value))
+                for f in filters), limit, offset, order_by)
+        except TypeError:
+            return None
+
+    def get(self, key):
+        """Returns a copy of the result saved for key
+
+        :returns: None if the result is not in the cache or a list of rows
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return list(entry[2])
+
+    def put(self, key, filters, rows, order_by=None):
+        """Saves the result of a query
+
+        :param key: The key returned by QueryCache.key
+        :param filters: A list of kangaroo.filters.Filter instances
+        :param rows: The list of rows returned by the query
+        :param order_by: The order of the rows, updates of its column
+            invalidate the result too.
+        """
+        columns = set(f.key for f in filters)
+        if order_by is not None:
+            columns.add(parse_order(order_by)[0])
+        entry = (columns, compile_filters(filters), list(rows))
+        with self.lock:
+            self.entries[key] = entry
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Removes every result from the cache
+        """
+        with self.lock:
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+
+    def __invalidate(self, test):
+        with self.lock:
+            keys = [k for k, e in self.entries.items() if test(e)]
+            for k in keys:
+                del self.entries[k]
+            self.invalidations += len(keys)
+
+    def table_changed(self, event, table, row, key):
+        """Invalidates the results affected by a change, see TableEvents
+        """
+        if event in ("insert", "delete"):
+            def matches(entry):
+                try:
+                    return entry[1] is None or entry[1](row)
+                except Exception:
+                    # if the filters can't evaluate the row we don't know
+                    return True
+            self.__invalidate(matches)
+        elif event == "update":
+            self.__invalidate(lambda e: key in e[0])
@@ -0,0 +1,520 @@
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from kangaroo.aggregates import pop_functions, aggregate_rows, group_rows
+from kangaroo.filters import parse_filters
+from kangaroo.index import normalize_name
+from kangaroo.ordering import order_rows
+from kangaroo.projection import project_rows
+from kangaroo.profiling import QueryProfile
+from kangaroo.table import TableEvents, restore_row
+
+# operators that can be evaluated with numpy over numeric columns
+VECTOR_OPERATORS = ("gt", "gte", "eq", "in", "range")
+
+def get_dtype(value):
+    """Returns the numpy dtype that we use to store the value
+    """
+    if isinstance(value, bool):
+        return numpy.bool_
+    elif isinstance(value, int) and -2 ** 63 <= value < 2 ** 63:
+        return numpy.int64
+    elif isinstance(value, float):
+        return numpy.float64
+    return object
+
+class Column(object):
+    def __init__(self, capacity):
+        """A column of a ColumnarTable
+
+        The values are kept in a typed numpy array, the type is picked with
+        the first value and the column falls back to an array of python 
+        objects when a value of other type arrives, so values are always 
+        returned with their original type. Positions where the row doesn't 
+        have the column are marked in the nulls mask.
+
+        :param capacity: The number of positions to allocate.
+        """
+        self.values = None
+        self.nulls = numpy.ones(capacity, dtype=numpy.bool_)
+
+    def grow(self, capacity):
+        """Resizes the column to the given capacity
+        """
+        nulls = numpy.ones(capacity, dtype=numpy.bool_)
+        nulls[:len(self.nulls)] = self.nulls
+        self.nulls = nulls
+        if self.values is not None:
+            values = numpy.zeros(capacity, dtype=self.values.dtype)
+            values[:len(self.values)] = self.values
+            self.values = values
+
+    def __fits(self, value):
+        kind = self.values.dtype.kind
+        if kind == "O":
+            return True
+        elif kind == "b":
+            return isinstance(value, bool)
+        elif kind == "i":
+            return get_dtype(value) is numpy.int64
+        elif kind == "f":
+            return isinstance(value, float)
+        return False
+
+    def set(self, position, value):
+        """Stores a value in a position of the column
+        """
+        if self.values is None:
+            self.values = numpy.zeros(len(self.nulls), dtype=get_dtype(value))
+        elif not self.__fits(value):
+            self.values = self.values.astype(object)
+        self.values[position] = value
+        self.nulls[position] = False
+
+    def mask(self, operator, size):
+        """Evaluates a filter over the first size positions of the column
+
+        :param operator: An instance of kangaroo.filters.Filter
+        :param size: The number of used positions in the column
+        :returns: A numpy array of booleans
+        """
+        if self.values is None:
+            return numpy.zeros(size, dtype=numpy.bool_)
+
+        values = self.values[:size]
+        present = ~self.nulls[:size]
+        if values.dtype.kind != "O" and operator.name in VECTOR_OPERATORS:
+            result = self.__vector_mask(operator, values)
+            if result is not None:
+                return result & present
+
+        compare = operator.compare
+        key = operator.key
+        return numpy.fromiter(
+            (p and compare({key: v}) for v, p in zip(values.tolist(),
+                present.tolist())), dtype=numpy.bool_, count=size)
+
+    def __vector_mask(self, operator, values):
+        # numpy only follows the python semantics when both sides are
+        # numbers, the rest of the cases are resolved value by value.
+        name = operator.name
+        value = operator.value
+        if name in ("gt", "gte", "eq"):
+            if not isinstance(value, (int, float)):
+                return None
+            if name == "gt":
+                return values > value
+            elif name == "gte":
+                return values >= value
+            return values == value
+        elif name == "range":
+            low, high = value
+            if not isinstance(low, (int, float)) or \
+                    not isinstance(high, (int, float)):
+                return None
+            return (values >= low) & (values <= high)
+        elif name == "in":
+            value = list(value)
+            for v in value:
+                if not isinstance(v, (int, float)):
+                    return None
+            return numpy.isin(values, value)
+        return None
+
+    def take(self, positions):
+        """Returns the values in the positions, None where there is no value
+        """
+        if self.values is None:
+            return [None] * len(positions)
+        return self.values[positions].tolist()
+
+class ColumnarTable(TableEvents):
+    __profiler = None
+
+    def __init__(self, tbl_name, tbl_index=[], tbl_index_kinds={}):
+        """Creates a new instance of kangaroo.columnar.ColumnarTable
+
+        It's a table with the same api than kangaroo.Table that stores
+        every column in a numpy array instead of keeping a Row per record.
+        Filters are evaluated as vectorized boolean masks and Row instances
+        are only created for the rows returned.
+
+        The returned rows are copies, modifying one of them updates the
+        table but not the other copies of the same record.
+
+        Indexes are accepted to be compatible with kangaroo.Table and the
+        storages, but they are not used because every query is a
+        vectorized scan.
+
+        :param tbl_name: The name of the table
+        :param tbl_index: a list of index names
+        :param tbl_index_kinds: a dictionary of index name -> kind of index
+        """
+        if numpy is None:
+            raise Exception("numpy is required to use a ColumnarTable")
+        self.__tbl_name = tbl_name
+        self.__index = {}
+        for i in tbl_index:
+            i = normalize_name(i)
+            self.__index[i] = tbl_index_kinds.get(i, "hash")
+        self.__columns = {}
+        self.__size = 0
+        self.__capacity = 1024
+        self.__alive = numpy.zeros(self.__capacity, dtype=numpy.bool_)
+
+    def __unicode__(self):
+        return "Kangaroo.ColumnarTable<{0}>".format(self.tbl_name)
+
+    def __len__(self):
+        """Returns the number of rows in the table
+        """
+        return int(numpy.count_nonzero(self.__alive[:self.__size]))
+
+    def __getstate__(self):
+        state = super(ColumnarTable, self).__getstate__()
+        state.pop("_ColumnarTable__profiler", None)
+        return state
+
+    def enable_profiling(self, profiler):
+        """Records the queries in a profiler, see 
+        kangaroo.Table.enable_profiling
+        """
+        self.__profiler = profiler
+
+    def disable_profiling(self):
+        """Stops recording the queries of the table
+        """
+        self.__profiler = None
+
+    @property
+    def profiler(self):
+        """Returns the profiler of the table or None
+        """
+        return self.__profiler
+
+    @property
+    def tbl_name(self):
+        """Returns the name of the table
+        :returns: an string that represents the name of the table
+        """
+        return self.__tbl_name
+
+    @property
+    def columns(self):
+        """Returns the names of the columns that the rows of the table use
+        """
+        return list(self.__columns.keys())
+
+    @property
+    def tbl_index(self):
+        """Returns the list of indexs of the table
+        :returns: A list of index names
+        """
+        return list(self.__index.keys())
+
+    @property
+    def tbl_index_kinds(self):
+        """Returns the kind of every index of the table, composite indexes
+        are left out like in kangaroo.Table.tbl_index_kinds
+        :returns: A dictionary of index name -> kind of index
+        """
+        return dict((k, v) for k, v in self.__index.items() 
+            if not isinstance(k, tuple))
+
+    def add_index(self, index_name, kind="hash"):
+        """Registers an index in the table, see kangaroo.Table.add_index
+        """
+        index_name = normalize_name(index_name)
+        with self.lock:
+            if self.__index.get(index_name) != kind:
+                self.__index[index_name] = kind
+                self.notify("add_index", key=index_name)
+
+    def delete_index(self, index_name):
+        """Deletes an existing index in the table
+        """
+        index_name = normalize_name(index_name)
+        with self.lock:
+            if index_name in self.__index:
+                del self.__index[index_name]
+                self.notify("delete_index", key=index_name)
+
+    def __column(self, name):
+        column = self.__columns.get(name)
+        if column is None:
+            column = self.__columns[name] = Column(self.__capacity)
+        return column
+
+    def __grow(self):
+        self.__capacity *= 2
+        alive = numpy.zeros(self.__capacity, dtype=numpy.bool_)
+        alive[:self.__size] = self.__alive[:self.__size]
+        self.__alive = alive
+        for column in self.__columns.values():
+            column.grow(self.__capacity)
+
+    def insert(self, data):
+        """Inserts a new row in the table
+
+        :param data: A dictionary that it's going to define the columns of the
+            new Row.
+        :returns: An instance of Row
+        """
+        with self.lock:
+            row = self.restore(self.__size + 1, data)
+            self.notify("insert", row)
+        return row
+
+    def insert_many(self, iterable):
+        """Inserts a group of rows, see kangaroo.Table.insert_many
+        """
+        with self.lock:
+            positions = []
+            for data in iterable:
+                position = self.__size
+                self.__store(position, data)
+                positions.append(position)
+            rows = self.__materialize(positions)
+            self.notify_many("insert", rows)
+        return rows
+
+    def restore(self, idd, data):
+        """Inserts a row keeping the id that it had, see kangaroo.Table.restore
+        """
+        position = idd - 1
+        with self.lock:
+            self.__store(position, data)
+            return self.__materialize([position])[0]
+
+    def __store(self, position, data):
+        while position >= self.__capacity:
+            self.__grow()
+        for k, v in data.items():
+            self.__column(k).set(position, v)
+        self.__alive[position] = True
+        self.__size = max(self.__size, position + 1)
+
+    def get_row(self, idd):
+        """Returns the row with the given id, see kangaroo.Table.get_row
+        """
+        position = idd - 1
+        with self.lock.reader:
+            if position < 0 or position >= self.__size or \
+                    not self.__alive[position]:
+                return None
+            return self.__materialize([position])[0]
+
+    def row_updated(self, row, key_changed):
+        """Stores in the column the new value of a row
+
+        :param row: An instance of kangaroo.Row
+        :param key_changed: The name of the column that was modified
+        """
+        with self.lock:
+            if self.__store_value(row, key_changed):
+                self.notify("update", row, key_changed)
+
+    def row_restored(self, row, key_changed):
+        """Stores in the column the old value of a row after row_updated
+        failed, see kangaroo.Table.row_restored
+        """
+        with self.lock:
+            self.__store_value(row, key_changed)
+
+    def __store_value(self, row, key):
+        # returns False if the row was deleted
+        position = row.idd - 1
+        if not self.__alive[position]:
+            return False
+        column = self.__column(key)
+        if key in row:
+            column.set(position, row[key])
+        else:
+            column.nulls[position] = True
+        return True
+
+    def delete_row(self, row):
+        """Deletes a row from the table
+
+        :param row: An instance of kangaroo.Row
+        :raises: ValueError if the row is not in the table, like a row of 
+            other table or a row already deleted
+        """
+        with self.lock:
+            position = -1 if row.idd is None else row.idd - 1
+            if row.table is not self or position < 0 or \
+                    position >= self.__size or not self.__alive[position]:
+                raise ValueError("The row is not in the table {0}".format(
+                    self.tbl_name))
+            self.__alive[position] = False
+            self.notify("delete", row)
+
+    def update_where(self, filters, values):
+        """Sets the same values in every row that matches the filters, see
+        kangaroo.Table.update_where
+        """
+        with self.lock:
+            positions = self.__positions(filters)
+            for k, v in values.items():
+                column = self.__column(k)
+                for position in positions.tolist():
+                    column.set(position, v)
+            if len(positions) > 0 and len(values) > 0:
+                self.notify_many("update", self.__materialize(positions),
+                    list(values.keys()))
+        return len(positions)
+
+    def delete_where(self, filters):
+        """Deletes every row that matches the filters, see
+        kangaroo.Table.delete_where
+        """
+        with self.lock:
+            positions = self.__positions(filters)
+            if len(positions) == 0:
+                return 0
+            rows = self.__materialize(positions)
+            self.__alive[positions] = False
+            self.notify_many("delete", rows)
+        return len(positions)
+
+    def __mask(self, filters):
+        mask = self.__alive[:self.__size].copy()
+        for f in filters:
+            column = self.__columns.get(f.key)
+            if column is None:
+                mask[:] = False
+                break
+            mask &= column.mask(f, self.__size)
+        return mask
+
+    def __materialize(self, positions):
+        names = list(self.__columns.keys())
+        values = [self.__columns[n].take(positions) for n in names]
+        nulls = [self.__columns[n].nulls[positions].tolist() for n in names]
+        rows = []
+        for i, position in enumerate(positions):
+            data = {}
+            for j, name in enumerate(names):
+                if not nulls[j][i]:
+                    data[name] = values[j][i]
+            rows.append(restore_row(data, self, int(position) + 1))
+        return rows
+
+    def __project(self, positions, fields, values_list):
+        # reads the values straight from the columns without creating rows
+        columns = [self.__columns.get(f) for f in fields]
+        values = [[None] * len(positions) if c is None else 
+            c.take(positions) for c in columns]
+        nulls = [[True] * len(positions) if c is None else 
+            c.nulls[positions].tolist() for c in columns]
+        if values_list:
+            for v, n in zip(values, nulls):
+                for i, null in enumerate(n):
+                    if null:
+                        v[i] = None
+            return list(zip(*values)) if len(fields) > 0 else \
+                [()] * len(positions)
+        rows = []
+        for i in range(len(positions)):
+            rows.append(dict([(f, values[j][i]) 
+                for j, f in enumerate(fields) if not nulls[j][i]]))
+        return rows
+
+    def __positions(self, kwargs):
+        return numpy.flatnonzero(self.__mask(parse_filters(kwargs)))
+
+    def iter_find(self, **kwargs):
+        """Iterates over the rows of the table that match the filters
+
+        The filters are evaluated at once, rows are created in small
+        batches while the iterator is consumed.
+
+        :param kwargs: a list of params that we are going to use to filter
+            the existing rows.
+        :returns: An iterator of Row instances
+        """
+        with self.lock.reader:
+            positions = self.__positions(kwargs)
+        for start in range(0, len(positions), 256):
+            with self.lock.reader:
+                rows = self.__materialize(positions[start:start + 256])
+            for row in rows:
+                yield row
+
+    def find(self, **kwargs):
+        """Finds a row in the table, see kangaroo.Table.find
+        """
+        for row in self.iter_find(**kwargs):
+            return row
+        return None
+
+    def find_all(self, limit=None, offset=0, order_by=None, fields=None,
+        values_list=False, **kwargs):
+        """Finds a list of rows in the table, see kangaroo.Table.find_all
+
+        A projection with fields is read from the columns, no Row is 
+        created for it.
+        """
+        stop = None if limit is None else offset + limit
+        profiler = self.__profiler
+        if profiler is not None:
+            profile = QueryProfile(self.__tbl_name, parse_filters(kwargs))
+            profile.access = "vectorized"
+        with self.lock.reader:
+            positions = self.__positions(kwargs)
+            if order_by is not None:
+                rows = order_rows(self.__materialize(positions), order_by,
+                    limit, offset)
+                if fields is not None or values_list:
+                    rows = project_rows(rows, fields, values_list)
+            elif fields is not None:
+                rows = self.__project(positions[offset:stop], fields,
+                    values_list)
+            elif values_list:
+                raise Exception("values_list needs a list of fields")
+            else:
+                rows = self.__materialize(positions[offset:stop])
+            if profiler is not None:
+                profile.rows_scanned = self.__size
+        if profiler is not None:
+            profiler.record(profile.finish(len(rows)))
+        return rows
+
+    def count(self, **kwargs):
+        """Returns the number of rows that match, see kangaroo.Table.count
+        """
+        with self.lock.reader:
+            return int(numpy.count_nonzero(self.__mask(parse_filters(kwargs))))
+
+    def aggregate(self, **kwargs):
+        """Computes sum, min and max of columns, see kangaroo.Table.aggregate
+        """
+        functions = pop_functions(kwargs)
+        return aggregate_rows(self.iter_find(**kwargs), functions)
+
+    def group_by(self, column, **kwargs):
+        """Counts the rows of every value of a column, see 
+        kangaroo.Table.group_by
+        """
+        functions = pop_functions(kwargs)
+        return group_rows(self.iter_find(**kwargs), column, functions)
+
+    def explain(self, **kwargs):
+        """Explains how the table resolves a query, see kangaroo.Table.explain
+        """
+        filters = parse_filters(kwargs)
+        with self.lock.reader:
+            actual_rows = int(numpy.count_nonzero(self.__mask(filters)))
+        return {
+            "access": "vectorized",
+            "driver": None,
+            "probes": [],
+            "residual_filters": ["{0}__{1}".format(f.key, f.name)
+                for f in filters],
+            "table_rows": len(self),
+            "scanned_rows": len(self),
+            "estimated_rows": len(self),
+            "actual_rows": actual_rows
+        }
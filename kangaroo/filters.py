@@ -27,7 +27,48 @@ def get_operator(operator_name):
 
     raise Exception("Invalid operator name {0}".format(operator_name))
 
+def parse_filters(params):
+    """Returns the list of filters described by a dictionary of params
+
+    Every key is a column name optionally followed by "__" and an operator
+    name, e.g. "number__gt". Keys without operator use "eq".
+
+    :param params: A dictionary of key -> value
+    :returns: A list of Filter instances
+    """
+    filters = []
+    for k in params.keys():
+        args = k.split("__")
+        key = args[0]
+        value = params[k]
+        operator_name = args[1] if len(args) == 2 else "eq"
+        op_class = get_operator(operator_name)
+        filters.append(op_class(key, value))
+    return filters
+
+def compile_filters(filters):
+    """Returns a function that checks every filter in a single call
+    
+    :param filters: A list of Filter instances
+    :returns: None if there are no filters or a function that receives a 
+        row and returns True if the row matches every filter.
+    """
+    if len(filters) == 0:
+        return None
+    if len(filters) == 1:
+        return filters[0].compare
+
+    compares = [f.compare for f in filters]
+    def match(item):
+        for compare in compares:
+            if not compare(item):
+                return False
+        return True
+    return match
+
 class Filter(object):
+    name = None
+
     def __init__(self, key, value):
         """Base class for for filters
     
@@ -47,30 +88,40 @@ class Filter(object):
         raise NotImplementedError()
 
 class Gt(Filter):
+    name = "gt"
+
     def compare(self, item):
         if self.key not in item:
             return False
         return item[self.key] > self.value
 
 class Gte(Filter):
+    name = "gte"
+
     def compare(self, item):
         if self.key not in item:
             return False
         return item[self.key] >= self.value
 
 class Eq(Filter):
+    name = "eq"
+
     def compare(self, item):
         if self.key not in item:
             return False
         return item[self.key] == self.value
 
 class In(Filter):
+    name = "in"
+
     def compare(self, item):
         if self.key not in item:
             return False
         return item[self.key] in self.value
 
 class Range(Filter):
+    name = "range"
+
     def compare(self, item):
         if self.key not in item:
             return False
@@ -78,18 +129,24 @@ class Range(Filter):
                 item[self.key] >= self.value[0]
 
 class Contains(Filter):
+    name = "contains"
+
     def compare(self, item):
         if self.key not in item:
             return False
         return self.value in item[self.key]
 
 class StartsWith(Filter):
+    name = "startswith"
+
     def compare(self, item):
         if self.key not in item:
             return False
         return item[self.key].startswith(self.value)
 
 class EndsWith(Filter):
+    name = "endswith"
+
     def compare(self, item):
         if self.key not in item:
             return False
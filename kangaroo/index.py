@@ -0,0 +1,376 @@
+import bisect
+
+def get_index_class(kind):
+    """Returns an Index Class that represents the kind of index
+
+    If there is not class that match with kind it will raise an exception.
+
+    :param kind: An string that represents the kind of index. Valid values
+        are ["hash", "sorted"].
+    :returns: A subclass of Index
+    """
+    if kind == "hash":
+        return HashIndex
+    elif kind == "sorted":
+        return SortedIndex
+
+    raise Exception("Invalid index kind {0}".format(kind))
+
+def normalize_name(name):
+    """Returns the name of an index as it's kept by the tables
+
+    The name of a composite index is the tuple of its columns. Storages 
+    that use json load it as a list, so lists are converted to tuples.
+
+    :param name: The name of a column or a list or tuple of columns
+    """
+    if isinstance(name, list):
+        return tuple(name)
+    return name
+
+def make_index(name, kind="hash"):
+    """Creates the index of a column or a composite index
+
+    :param name: The name of a column or a tuple of columns for a 
+        composite index
+    :param kind: The kind of index, see get_index_class. Composite indexes
+        are always "hash" indexes.
+    :returns: An instance of Index
+    """
+    name = normalize_name(name)
+    if isinstance(name, tuple):
+        if kind != "hash":
+            raise Exception("Composite indexes are hash indexes")
+        return CompositeIndex(name)
+    return get_index_class(kind)(name)
+
+class Index(object):
+    kind = None
+
+    def __init__(self, column):
+        """Base class for indexes
+
+        An index keeps the rows of a table grouped by the value of one of
+        their columns. Every group is a dictionary of row.idd -> row, so rows
+        can be added and removed from a group in constant time.
+
+        :param column: The name of the column that we want to index.
+        """
+        self.column = column
+        self.columns = (column,)
+        self.groups = {}
+        self.values = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, row):
+        """Adds a row to the index
+
+        Rows without the indexed column are ignored.
+
+        :param row: An instance of kangaroo.Row
+        """
+        if self.column not in row:
+            return
+        value = row[self.column]
+        group = self.groups.get(value)
+        if group is None:
+            # it can fail, so it's called before the index changes
+            self.value_added(value)
+            group = self.groups[value] = {}
+        group[row.idd] = row
+        self.values[row.idd] = value
+
+    def add_many(self, rows):
+        """Adds a list of rows to the index in a single pass
+
+        If the index can't keep a value no row is added.
+
+        :param rows: A list of kangaroo.Row instances
+        """
+        column = self.column
+        groups = self.groups
+        values = self.values
+        new_values = []
+        added = []
+        try:
+            for row in rows:
+                if column not in row:
+                    continue
+                value = row[column]
+                idd = row.idd
+                group = groups.get(value)
+                if group is None:
+                    group = groups[value] = {}
+                    new_values.append(value)
+                group[idd] = row
+                values[idd] = value
+                added.append(idd)
+            self.values_added(new_values)
+        except Exception:
+            for idd in added:
+                value = values.pop(idd)
+                group = groups[value]
+                del group[idd]
+                if len(group) == 0:
+                    del groups[value]
+            raise
+
+    def remove(self, row):
+        """Removes a row from the index
+
+        :param row: An instance of kangaroo.Row
+        """
+        if row.idd not in self.values:
+            return
+        value = self.values.pop(row.idd)
+        group = self.groups[value]
+        del group[row.idd]
+        if len(group) == 0:
+            del self.groups[value]
+            self.value_removed(value)
+
+    def remove_many(self, rows):
+        """Removes a list of rows from the index in a single pass
+
+        :param rows: A list of kangaroo.Row instances
+        """
+        groups = self.groups
+        values = self.values
+        old_values = []
+        for row in rows:
+            idd = row.idd
+            if idd not in values:
+                continue
+            value = values.pop(idd)
+            group = groups[value]
+            del group[idd]
+            if len(group) == 0:
+                del groups[value]
+                old_values.append(value)
+        self.values_removed(old_values)
+
+    def update(self, row):
+        """Moves a row to the group of its current value
+
+        :param row: An instance of kangaroo.Row
+        """
+        if self.values.get(row.idd, self) == row.get(self.column, self):
+            return
+        self.remove(row)
+        self.add(row)
+
+    def value_added(self, value):
+        """Called when a new distinct value appears in the index
+        """
+        pass
+
+    def values_added(self, values):
+        """Called when add_many adds a list of new distinct values
+        """
+        for value in values:
+            self.value_added(value)
+
+    def value_removed(self, value):
+        """Called when the last row of a distinct value leaves the index
+        """
+        pass
+
+    def values_removed(self, values):
+        """Called when remove_many removes a list of distinct values
+        """
+        for value in values:
+            self.value_removed(value)
+
+    def lookup(self, operator):
+        """Returns the groups of rows that can match the operator
+
+        :param operator: An instance of kangaroo.filters.Filter over the
+            indexed column.
+        :returns: None if the index can't resolve the operator or a list of
+            groups (dictionaries of row.idd -> row) otherwise.
+        """
+        try:
+            if operator.name == "eq":
+                group = self.groups.get(operator.value)
+                return [] if group is None else [group]
+            elif operator.name == "in" and \
+                    isinstance(operator.value, (list, tuple, set, frozenset)):
+                # other values, like strings, use the semantics of "in"
+                groups = []
+                seen = set()
+                for value in operator.value:
+                    if value in seen:
+                        continue
+                    seen.add(value)
+                    group = self.groups.get(value)
+                    if group is not None:
+                        groups.append(group)
+                return groups
+        except TypeError:
+            # unhashable values can't be searched in the index
+            return None
+        return None
+
+class HashIndex(Index):
+    kind = "hash"
+
+class SortedIndex(Index):
+    kind = "sorted"
+
+    def __init__(self, column):
+        """An index that also keeps its distinct values sorted
+
+        Besides equality it can resolve gt, gte, range and startswith
+        operators with a binary search over the sorted values.
+
+        None values are kept in their group but not in the sorted values,
+        so they are only reachable by equality.
+
+        :param column: The name of the column that we want to index.
+        """
+        super(SortedIndex, self).__init__(column)
+        self.keys = []
+
+    def value_added(self, value):
+        if value is not None:
+            bisect.insort(self.keys, value)
+
+    def values_added(self, values):
+        # sorting once is cheaper than inserting every value in the list
+        values = [v for v in values if v is not None]
+        if len(values) > 0:
+            # the keys don't change if the values can't be compared
+            keys = self.keys + values
+            keys.sort()
+            self.keys[:] = keys
+
+    def value_removed(self, value):
+        if value is not None:
+            del self.keys[bisect.bisect_left(self.keys, value)]
+
+    def values_removed(self, values):
+        # filtering the list once is cheaper than deleting every value
+        values = set(v for v in values if v is not None)
+        if len(values) > 0:
+            self.keys[:] = [k for k in self.keys if k not in values]
+
+    def __slice(self, start, end):
+        return [self.groups[k] for k in self.keys[start:end]]
+
+    def lookup(self, operator):
+        groups = super(SortedIndex, self).lookup(operator)
+        if groups is not None:
+            return groups
+
+        keys = self.keys
+        try:
+            if operator.name == "gt":
+                return self.__slice(bisect.bisect_right(keys, operator.value),
+                    None)
+            elif operator.name == "gte":
+                return self.__slice(bisect.bisect_left(keys, operator.value),
+                    None)
+            elif operator.name == "range":
+                low, high = operator.value
+                return self.__slice(bisect.bisect_left(keys, low),
+                    bisect.bisect_right(keys, high))
+            elif operator.name == "startswith":
+                start = end = bisect.bisect_left(keys, operator.value)
+                while end < len(keys) and keys[end].startswith(operator.value):
+                    end += 1
+                return self.__slice(start, end)
+        except (TypeError, AttributeError):
+            # the values can't be compared with the operator value, we let
+            # the table fall back to a full scan.
+            return None
+        return None
+
+class CompositeIndex(Index):
+    kind = "hash"
+
+    def __init__(self, columns):
+        """An index over the values of several columns
+
+        Rows are grouped by the tuple of their values. Equality over every
+        column returns a single group and equality over the leftmost 
+        columns returns the groups that start with those values, which are
+        kept by prefix. The tuple of a row without some column stops 
+        before it, so the row is only found by the shorter prefixes, and 
+        rows without the first column are left out.
+
+        Example:
+            >> table.add_index(("country", "state"))
+            >> table.find_all(country="BR", state="AL")
+            >> table.find_all(country="BR")
+
+        :param columns: A tuple with the names of the columns
+        """
+        super(CompositeIndex, self).__init__(tuple(columns))
+        self.columns = tuple(columns)
+        self.prefixes = {}
+
+    def value_of(self, row):
+        """Returns the tuple of values of the leftmost columns that the row
+        has, None if it doesn't have the first column
+        """
+        values = []
+        for column in self.columns:
+            if column not in row:
+                break
+            values.append(row[column])
+        return tuple(values) if len(values) > 0 else None
+
+    def add(self, row):
+        value = self.value_of(row)
+        if value is None:
+            return
+        group = self.groups.get(value)
+        if group is None:
+            group = self.groups[value] = {}
+            self.value_added(value)
+        group[row.idd] = row
+        self.values[row.idd] = value
+
+    def add_many(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def update(self, row):
+        if self.values.get(row.idd) == self.value_of(row):
+            return
+        self.remove(row)
+        self.add(row)
+
+    def __prefix_sizes(self, value):
+        # an incomplete tuple is a prefix of itself
+        return range(1, min(len(value) + 1, len(self.columns)))
+
+    def value_added(self, value):
+        group = self.groups[value]
+        for size in self.__prefix_sizes(value):
+            self.prefixes.setdefault(value[:size], {})[value] = group
+
+    def value_removed(self, value):
+        for size in self.__prefix_sizes(value):
+            prefix = self.prefixes[value[:size]]
+            del prefix[value]
+            if len(prefix) == 0:
+                del self.prefixes[value[:size]]
+
+    def lookup_prefix(self, values):
+        """Returns the groups of rows whose leftmost columns have the values
+
+        :param values: A tuple with the values of the first columns of the
+            index, the values of every column resolve a single group.
+        :returns: None if the values can't be hashed or a list of groups
+        """
+        try:
+            if len(values) == len(self.columns):
+                group = self.groups.get(values)
+                return [] if group is None else [group]
+            prefix = self.prefixes.get(values)
+            return [] if prefix is None else list(prefix.values())
+        except TypeError:
+            return None
@@ -0,0 +1,73 @@
+import datetime
+import re
+
+INT_RE = re.compile(r"^[-+]?(0|[1-9][0-9]*)$")
+FLOAT_RE = re.compile(r"^[-+]?([0-9]+\.[0-9]*|\.[0-9]+|[0-9]+(?=[eE]))"
+    r"([eE][-+]?[0-9]+)?$")
+DATE_RE = re.compile(r"^[0-9]{4}-[0-9]{2}-[0-9]{2}$")
+BOOLEANS = {"true": True, "false": False}
+
+def to_bool(value):
+    return BOOLEANS[value.lower()]
+
+def to_date(value):
+    return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+
+def is_int(value):
+    return INT_RE.match(value) is not None
+
+def is_float(value):
+    return FLOAT_RE.match(value) is not None or is_int(value)
+
+def is_bool(value):
+    return value.lower() in BOOLEANS
+
+def is_date(value):
+    if DATE_RE.match(value) is None:
+        return False
+    try:
+        to_date(value)
+    except ValueError:
+        return False
+    return True
+
+# from the most specific to the most generic, ints are floats too
+TYPES = [
+    (is_bool, to_bool),
+    (is_int, int),
+    (is_float, float),
+    (is_date, to_date)
+]
+
+def infer_converter(values):
+    """Returns the converter that can parse every value of a sample
+
+    Empty values are ignored. Numbers with leading zeros are kept as
+    strings because they are usually codes, not quantities.
+
+    :param values: A list of strings
+    :returns: None if the values have to be kept as strings or a function
+        that receives a string and returns the converted value.
+    """
+    values = [v for v in values if v != ""]
+    if len(values) == 0:
+        return None
+    for check, converter in TYPES:
+        for v in values:
+            if not check(v):
+                break
+        else:
+            return converter
+    return None
+
+def safe_converter(converter):
+    """Returns a converter that keeps the original string when it fails
+
+    :param converter: A function that receives a string
+    """
+    def convert(value):
+        try:
+            return converter(value)
+        except (ValueError, KeyError):
+            return value
+    return convert
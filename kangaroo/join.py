@@ -0,0 +1,146 @@
+from kangaroo.filters import parse_filters, compile_filters
+
+def build_groups(rows, column):
+    """Groups rows by the value of a column
+
+    Rows without the column, with None or with a value that can't be
+    hashed never match, so they are left out.
+
+    :param rows: An iterable of rows
+    :param column: The name of the column
+    :returns: A dictionary of value -> list of rows
+    """
+    groups = {}
+    for row in rows:
+        value = row.get(column)
+        if value is None:
+            continue
+        try:
+            group = groups.get(value)
+        except TypeError:
+            continue
+        if group is None:
+            groups[value] = [row]
+        else:
+            group.append(row)
+    return groups
+
+def lookup(groups, value):
+    """Returns the group of a value
+
+    :returns: None if there is no match or the group
+    """
+    if value is None:
+        return None
+    try:
+        return groups.get(value)
+    except TypeError:
+        return None
+
+def hash_join(left, right, left_on, right_on=None, left_filters=None,
+    right_filters=None, how="inner"):
+    """Joins the rows of two tables whose columns have the same value
+
+    The filters of every side are applied before the join. One side is
+    kept in a hash table grouped by its join column and the other side is
+    streamed and looked up in it. A table with an index over its join
+    column doesn't build anything, the groups of the index are used and
+    its filters are checked on the rows that match. Otherwise the side
+    with less matching rows is grouped. With how="left" the right side is
+    always the one looked up, so left rows without a match can be
+    returned.
+
+    Values compare like in an equality filter and None never matches. The
+    pairs are returned while they are found, in the order of the side
+    that is streamed. Like iter_find the tables should not be modified
+    while iterating.
+
+    Example:
+        >> for order, customer in hash_join(bucket.orders,
+        ..         bucket.customers, "customer_id", "id",
+        ..         left_filters=dict(total__gt=100)):
+        ..     print(customer.name, order.total)
+
+    :param left: A table, see kangaroo.Table
+    :param right: A table
+    :param left_on: The name of the join column of the left table
+    :param right_on: The name of the join column of the right table,
+        left_on by default
+    :param left_filters: A dictionary with the filters of the left table,
+        the same params that we use in find_all
+    :param right_filters: A dictionary with the filters of the right table
+    :param how: "inner" or "left". A left join returns (row, None) for the
+        left rows without a match.
+    :returns: An iterator of (left row, right row) tuples
+    """
+    if how not in ("inner", "left"):
+        raise Exception("Invalid join {0}".format(how))
+    right_on = left_on if right_on is None else right_on
+    left_filters = left_filters or {}
+    right_filters = right_filters or {}
+
+    left_groups = index_groups(left, left_on)
+    right_groups = index_groups(right, right_on)
+    if how == "left" or (right_groups is not None and left_groups is None):
+        build_right = True
+    elif left_groups is not None and right_groups is None:
+        build_right = False
+    else:
+        build_right = right.count(**right_filters) <= \
+            left.count(**left_filters)
+
+    if build_right:
+        return probe(left, left_on, left_filters, right, right_on,
+            right_filters, right_groups, how == "left")
+    pairs = probe(right, right_on, right_filters, left, left_on,
+        left_filters, left_groups, False)
+    return ((l, r) for r, l in pairs)
+
+def index_groups(table, column):
+    """Returns the groups of the index of a table over a column
+
+    :returns: None if the table has no index over the column or a
+        dictionary of value -> dictionary of row.idd -> row
+    """
+    method = getattr(table, "index_groups", None)
+    if method is None:
+        return None
+    return method(column)
+
+def probe(table, column, filters, other, other_column, other_filters,
+    groups, outer):
+    """Streams the rows of table and looks them up in the rows of other
+
+    :param groups: The groups of an index of other over other_column, None
+        to group the rows of other that match its filters.
+    :param outer: True to return (row, None) for the rows without a match
+    :returns: An iterator of (row of table, row of other) tuples
+    """
+    match = None
+    if groups is None:
+        groups = build_groups(other.iter_find(**other_filters), other_column)
+    else:
+        # the groups of an index are dictionaries of row.idd -> row
+        groups = IndexGroups(groups)
+        match = compile_filters(parse_filters(dict(other_filters)))
+
+    for row in table.iter_find(**filters):
+        found = False
+        for other_row in lookup(groups, row.get(column)) or ():
+            if match is None or match(other_row):
+                found = True
+                yield row, other_row
+        if outer and not found:
+            yield row, None
+
+class IndexGroups(object):
+    def __init__(self, groups):
+        """Looks up the rows of the groups of an index like build_groups
+
+        :param groups: A dictionary of value -> dictionary of row.idd -> row
+        """
+        self.groups = groups
+
+    def get(self, value):
+        group = self.groups.get(value)
+        return None if group is None else group.values()
@@ -0,0 +1,134 @@
+import threading
+
+try:
+    from threading import get_ident
+except ImportError:
+    from thread import get_ident
+
+class ReadDepth(threading.local):
+    # the number of times that the current thread holds the read side
+    depth = 0
+
+class ReadLock(object):
+    def __init__(self, lock):
+        """The read side of a RWLock, it's used with the with statement
+        """
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire_read()
+        return self
+
+    def __exit__(self, *args):
+        self.lock.release_read()
+
+class RWLock(object):
+    def __init__(self):
+        """A reader/writer lock
+
+        Any number of threads can hold the read side at the same time, the
+        write side is exclusive. A writer closes the gate to new readers
+        and waits for the current ones, so a stream of reads can't starve
+        the writers. Both sides are reentrant and the thread that holds the
+        write side can also read, but a thread that holds the read side
+        can't start writing.
+
+        Using the lock with the with statement takes the write side.
+
+        Example:
+            >> lock = RWLock()
+            >> with lock.reader:
+            ..     table.find_all(animal="lion")
+            >> with lock:
+            ..     table.insert(dict(animal="lion"))
+        """
+        self.mutex = threading.Lock()
+        self.condition = threading.Condition(self.mutex)
+        self.local = ReadDepth()
+        self.readers = 0
+        self.writer = None
+        self.writes = 0
+        # threads waiting in the condition, nobody is notified without them
+        self.waiting_writers = 0
+        self.waiting_readers = 0
+        # callbacks of the writer that run once the write side is released
+        self.released = []
+        self.reader = ReadLock(self)
+
+    def acquire_read(self):
+        local = self.local
+        depth = local.depth
+        if depth == 0:
+            mutex = self.mutex
+            mutex.acquire()
+            if self.writer is not None or self.waiting_writers > 0:
+                me = get_ident()
+                if self.writer != me:
+                    self.waiting_readers += 1
+                    while self.writer is not None or self.waiting_writers > 0:
+                        self.condition.wait()
+                    self.waiting_readers -= 1
+            self.readers += 1
+            mutex.release()
+        local.depth = depth + 1
+
+    def release_read(self):
+        local = self.local
+        depth = local.depth - 1
+        local.depth = depth
+        if depth == 0:
+            mutex = self.mutex
+            mutex.acquire()
+            self.readers -= 1
+            if self.readers == 0 and self.waiting_writers > 0:
+                self.condition.notify_all()
+            mutex.release()
+
+    def acquire_write(self):
+        me = get_ident()
+        if self.writer == me:
+            # only this thread can change the writer from itself
+            self.writes += 1
+            return
+        with self.mutex:
+            if self.writer is not None or self.readers > 0:
+                if self.local.depth > 0:
+                    raise Exception("A thread can't write while it's reading")
+                self.waiting_writers += 1
+                while self.writer is not None or self.readers > 0:
+                    self.condition.wait()
+                self.waiting_writers -= 1
+            self.writer = me
+            self.writes = 1
+
+    def release_write(self):
+        self.writes -= 1
+        if self.writes == 0:
+            released, self.released = self.released, []
+            with self.mutex:
+                self.writer = None
+                if self.waiting_writers > 0 or self.waiting_readers > 0:
+                    self.condition.notify_all()
+            for callback in released:
+                callback()
+
+    def after_release(self, callback):
+        """Calls a function when the thread releases the write side
+
+        It lets the writer do work that takes other locks without holding
+        this one. The function is called at once if the thread doesn't 
+        hold the write side.
+
+        :param callback: A function without params
+        """
+        if self.writer != get_ident():
+            callback()
+        else:
+            self.released.append(callback)
+
+    def __enter__(self):
+        self.acquire_write()
+        return self
+
+    def __exit__(self, *args):
+        self.release_write()
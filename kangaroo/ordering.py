@@ -0,0 +1,67 @@
+import heapq
+import itertools
+
+def parse_order(order_by):
+    """Returns the column and the direction of an order
+
+    :param order_by: The name of a column, with a "-" prefix to sort in
+        descending order, e.g. "-score".
+    :returns: A tuple (column, descending)
+    """
+    if order_by.startswith("-"):
+        return order_by[1:], True
+    return order_by, False
+
+def sort_key(column, descending):
+    """Returns the key used to sort rows by a column
+
+    Rows without the column or with None go after the rest of the rows in
+    both directions.
+    """
+    if descending:
+        def key(row):
+            value = row.get(column)
+            return (value is not None, value)
+    else:
+        def key(row):
+            value = row.get(column)
+            return (value is None, value)
+    return key
+
+def order_rows(rows, order_by, limit=None, offset=0):
+    """Sorts rows by a column and returns a page of them
+
+    When there is a limit only the first offset + limit rows are kept in a
+    heap, so the rows are never sorted completely. Rows with the same value
+    keep their order.
+
+    :param rows: An iterable of rows
+    :param order_by: The order, see parse_order
+    :param limit: The maximum number of rows to return
+    :param offset: The number of rows to skip
+    :returns: A list of rows
+    """
+    column, descending = parse_order(order_by)
+    key = sort_key(column, descending)
+    if limit is None:
+        rows = sorted(rows, key=key, reverse=descending)
+    elif descending:
+        rows = heapq.nlargest(offset + limit, rows, key=key)
+    else:
+        rows = heapq.nsmallest(offset + limit, rows, key=key)
+    if offset:
+        return rows[offset:]
+    return rows
+
+def merge_ordered(lists, order_by, limit=None, offset=0):
+    """Merges lists of rows already sorted by order_rows
+
+    :param lists: A list of lists of rows
+    :param order_by: The order, see parse_order
+    :returns: A list of rows
+    """
+    column, descending = parse_order(order_by)
+    rows = heapq.merge(*lists, key=sort_key(column, descending),
+        reverse=descending)
+    stop = None if limit is None else offset + limit
+    return list(itertools.islice(rows, offset, stop))
@@ -0,0 +1,82 @@
+import concurrent.futures
+import gc
+import multiprocessing
+import os
+import threading
+
+from kangaroo.filters import compile_filters
+
+# The rows of the scan that is running. The processes of the pool are
+# forked while it's set, so they share the rows with the parent process
+# instead of receiving a copy.
+scan_rows = None
+scan_lock = threading.Lock()
+
+def scan_range(filters, start, end):
+    """Returns the positions of the rows in [start, end) that match
+
+    It runs in the processes of the pool.
+
+    :param filters: A list of kangaroo.filters.Filter instances
+    :param start: The position of the first row
+    :param end: The position after the last row
+    :returns: A list of positions
+    """
+    match = compile_filters(filters)
+    rows = scan_rows
+    return [i for i in range(start, end) if match(rows[i])]
+
+class ParallelScan(object):
+    def __init__(self, threshold, processes=None, chunk_size=None):
+        """Evaluates the filters of a full scan in a pool of processes
+
+        The pool is forked for every scan, so the processes read the rows
+        of the table from the memory of the parent process. Every process
+        filters a range of rows, it only sends back the positions of the
+        matching rows and the rows are returned in the order of the table.
+
+        It needs the "fork" start method of multiprocessing, which isn't
+        available on Windows.
+
+        :param threshold: The minimum number of rows of a scan that uses
+            the pool, smaller scans are faster in the current process. It
+            depends on the machine, see kangaroo.bench.parallel_scan.
+        :param processes: The number of processes of the pool, the number
+            of cpus by default.
+        :param chunk_size: The number of rows filtered by a task, by default
+            every process gets a single range.
+        """
+        if "fork" not in multiprocessing.get_all_start_methods():
+            raise Exception("The parallel scan needs the fork start method")
+        self.threshold = threshold
+        self.processes = processes or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+
+    def scan(self, rows, filters):
+        """Returns the rows that match every filter
+
+        :param rows: A list of rows
+        :param filters: A list of kangaroo.filters.Filter instances
+        :returns: A list of rows
+        """
+        global scan_rows
+        chunk_size = self.chunk_size or \
+            max(1, -(-len(rows) // self.processes))
+        context = multiprocessing.get_context("fork")
+        with scan_lock:
+            scan_rows = rows
+            try:
+                # the garbage collector of the children would touch every
+                # object and copy the shared memory
+                with concurrent.futures.ProcessPoolExecutor(
+                        max_workers=self.processes, mp_context=context,
+                        initializer=gc.disable) as pool:
+                    futures = [pool.submit(scan_range, filters, start,
+                        min(start + chunk_size, len(rows)))
+                        for start in range(0, len(rows), chunk_size)]
+                    result = []
+                    for future in futures:
+                        result.extend(rows[i] for i in future.result())
+            finally:
+                scan_rows = None
+        return result
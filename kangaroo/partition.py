@@ -0,0 +1,348 @@
+import bisect
+import itertools
+import zlib
+
+from kangaroo.aggregates import pop_functions, empty, combine, \
+    combine_groups
+from kangaroo.filters import parse_filters
+from kangaroo.ordering import merge_ordered
+from kangaroo.projection import project_rows
+
+def shard_name(tbl_name, position):
+    """Returns the name of the table that keeps a shard of a table
+    """
+    return "{0}#{1}".format(tbl_name, position)
+
+def stable_hash(value):
+    """Returns a hash of the value that doesn't change between processes
+
+    Numbers that are equal hash the same, so 1, 1.0 and True go to the
+    same shard like they match the same equality filter.
+    """
+    if isinstance(value, bool):
+        value = int(value)
+    elif isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return zlib.crc32(repr(value).encode("utf-8"))
+
+class PartitionedTable(object):
+    def __init__(self, tbl_name, key, shards, get_shard, boundaries=None):
+        """A table split in several shards by the value of a column
+
+        Every shard is a normal table of the bucket, so storages save, load
+        and flush every shard on its own. Rows are placed with a hash of
+        the key or, when boundaries are given, by ranges: shard i keeps the
+        values between boundaries[i - 1] and boundaries[i]. Rows without
+        the key are kept in the first shard.
+
+        Filters over the key only visit the shards that can have matches:
+        equality and "in" with both kinds of partitions and gt, gte and
+        range with range partitions. The rest of the filters visit every
+        shard. Rows are returned shard after shard.
+
+        Rows belong to their shard (row.table is the shard) and their ids
+        are unique only inside it. Changing the key of a row moves it to
+        its new shard, the row keeps being the same object with a new id.
+        The move is made once the lock of the old shard is released, so a 
+        row changed holding "with shard.lock" moves at the end of the 
+        block.
+
+        Example:
+            >> cities = bucket.add_partitioned_table("cities", "state", 16)
+            >> cities.find_all(state="SP", population__gt=100000)
+
+        :param tbl_name: The name of the table
+        :param key: The name of the column used to partition
+        :param shards: The number of shards
+        :param get_shard: A function that receives the name of a shard and
+            returns the table
+        :param boundaries: A sorted list of shards - 1 values to partition
+            by ranges, None to partition by hash.
+        """
+        if boundaries is not None and len(boundaries) != shards - 1:
+            raise Exception("A range partition needs shards - 1 boundaries")
+        self.__tbl_name = tbl_name
+        self.__key = key
+        self.__shards = shards
+        self.__boundaries = boundaries
+        self.__get_shard = get_shard
+        self.__loaded = {}
+
+    def __unicode__(self):
+        return "Kangaroo.PartitionedTable<{0}>".format(self.tbl_name)
+
+    def __len__(self):
+        return sum(len(s) for s in self.shards)
+
+    @property
+    def tbl_name(self):
+        """Returns the name of the table
+        """
+        return self.__tbl_name
+
+    @property
+    def key(self):
+        """Returns the name of the column used to partition the table
+        """
+        return self.__key
+
+    @property
+    def boundaries(self):
+        """Returns the boundaries of a range partition, None for hash
+        """
+        return self.__boundaries
+
+    @property
+    def shard_names(self):
+        """Returns the names of the tables of the shards without loading them
+        """
+        return [shard_name(self.__tbl_name, i) for i in range(self.__shards)]
+
+    @property
+    def shards(self):
+        """Returns the tables of every shard, they are loaded if needed
+        """
+        return [self.shard(i) for i in range(self.__shards)]
+
+    @property
+    def tbl_index(self):
+        """Returns the list of indexes of the shards
+        """
+        return self.shard(0).tbl_index
+
+    @property
+    def tbl_index_kinds(self):
+        """Returns the kind of every index of the shards
+        """
+        return self.shard(0).tbl_index_kinds
+
+    def shard(self, position):
+        """Returns the table of a shard
+
+        :param position: The number of the shard
+        """
+        table = self.__loaded.get(position)
+        if table is None:
+            table = self.__get_shard(shard_name(self.__tbl_name, position))
+            table.add_listener(self.__shard_changed)
+            table = self.__loaded.setdefault(position, table)
+        return table
+
+    def position(self, value):
+        """Returns the number of the shard that keeps a value of the key
+
+        None goes to the first shard of a range partition.
+        """
+        if self.__boundaries is None:
+            return stable_hash(value) % self.__shards
+        if value is None:
+            return 0
+        return bisect.bisect_right(self.__boundaries, value)
+
+    def __position_of(self, data):
+        if self.__key not in data:
+            return 0
+        return self.position(data[self.__key])
+
+    def __shard_changed(self, event, table, row, key):
+        # A row whose key changed is moved to the shard of the new value. 
+        # The listener runs holding the lock of the shard, moving the row 
+        # there would lock the other shard (and maybe the bucket to load 
+        # it) in a different order than a flush.
+        if event != "update" or key != self.__key:
+            return
+        if self.__loaded.get(self.__position_of(row)) is not table:
+            table.lock.after_release(lambda: self.__move(row, table))
+
+    def __move(self, row, table):
+        if row.table is not table or table.get_row(row.idd) is not row:
+            # the row was deleted or moved by other change
+            return
+        target = self.shard(self.__position_of(row))
+        if target is not table:
+            target.move_row(row)
+
+    def __positions(self, filters):
+        # returns the shards that can have rows that match every filter
+        positions = set(range(self.__shards))
+        for f in filters:
+            if f.key != self.__key:
+                continue
+            try:
+                if f.name == "eq":
+                    found = set([self.position(f.value)])
+                elif f.name == "in" and isinstance(f.value, 
+                        (list, tuple, set, frozenset)):
+                    found = set(self.position(v) for v in f.value)
+                elif self.__boundaries is None:
+                    continue
+                elif f.name in ("gt", "gte"):
+                    found = set(range(self.position(f.value), self.__shards))
+                elif f.name == "range":
+                    found = set(range(self.position(f.value[0]),
+                        self.position(f.value[1]) + 1))
+                else:
+                    continue
+            except TypeError:
+                # values that can't be compared with the boundaries
+                continue
+            positions &= found
+        return sorted(positions)
+
+    def add_index(self, index_name, kind="hash"):
+        """Adds an index to every shard, see kangaroo.Table.add_index
+        """
+        for table in self.shards:
+            table.add_index(index_name, kind=kind)
+
+    def delete_index(self, index_name):
+        """Deletes an index from every shard
+        """
+        for table in self.shards:
+            table.delete_index(index_name)
+
+    def insert(self, data):
+        """Inserts a new row in the shard of its key
+
+        :param data: A dictionary with the columns of the row
+        :returns: An instance of Row
+        """
+        return self.shard(self.__position_of(data)).insert(data)
+
+    def insert_many(self, iterable):
+        """Inserts a group of rows, every shard receives its rows at once
+
+        :param iterable: An iterable of dictionaries
+        :returns: A list of Row instances in the order of the iterable
+        """
+        groups = {}
+        order = []
+        for data in iterable:
+            position = self.__position_of(data)
+            groups.setdefault(position, []).append(data)
+            order.append(position)
+        inserted = dict((p, iter(self.shard(p).insert_many(rows)))
+            for p, rows in groups.items())
+        return [next(inserted[p]) for p in order]
+
+    def delete_row(self, row):
+        """Deletes a row from its shard
+
+        :param row: An instance of kangaroo.Row
+        """
+        row.table.delete_row(row)
+
+    def update_where(self, filters, values):
+        """Sets the same values in the matching rows of every shard, see
+        kangaroo.Table.update_where
+
+        Rows whose key changes are moved to their new shard.
+        """
+        positions = self.__positions(parse_filters(filters))
+        if self.__key not in values:
+            return sum(self.shard(p).update_where(filters, values)
+                for p in positions)
+        # moved rows can match again in the shards updated later, but the
+        # values are the same, so they are only counted once
+        count = sum(self.shard(p).count(**filters) for p in positions)
+        for p in positions:
+            self.shard(p).update_where(filters, values)
+        return count
+
+    def delete_where(self, filters):
+        """Deletes the matching rows of every shard, see 
+        kangaroo.Table.delete_where
+        """
+        return sum(self.shard(p).delete_where(filters)
+            for p in self.__positions(parse_filters(filters)))
+
+    def iter_find(self, **kwargs):
+        """Iterates over the rows that match the filters, see
+        kangaroo.Table.iter_find
+        """
+        positions = self.__positions(parse_filters(kwargs))
+        return itertools.chain.from_iterable(
+            self.shard(p).iter_find(**kwargs) for p in positions)
+
+    def find(self, **kwargs):
+        """Finds a row in the table, see kangaroo.Table.find
+        """
+        for p in self.__positions(parse_filters(kwargs)):
+            row = self.shard(p).find(**kwargs)
+            if row is not None:
+                return row
+        return None
+
+    def find_all(self, limit=None, offset=0, order_by=None, fields=None,
+        values_list=False, **kwargs):
+        """Finds a list of rows in the table, see kangaroo.Table.find_all
+
+        With order_by every shard returns its best offset + limit rows and
+        they are merged.
+        """
+        if order_by is not None:
+            stop = None if limit is None else offset + limit
+            lists = [self.shard(p).find_all(limit=stop, order_by=order_by,
+                **kwargs) for p in self.__positions(parse_filters(kwargs))]
+            rows = merge_ordered(lists, order_by, limit, offset)
+            if fields is not None or values_list:
+                rows = project_rows(rows, fields, values_list)
+            return rows
+
+        rows = []
+        for p in self.__positions(parse_filters(kwargs)):
+            stop = None if limit is None else offset + limit - len(rows)
+            found = self.shard(p).find_all(limit=stop, fields=fields,
+                values_list=values_list, **kwargs)
+            skipped = min(offset, len(found))
+            offset -= skipped
+            rows.extend(found[skipped:])
+            if limit is not None and len(rows) >= limit:
+                break
+        return rows
+
+    def count(self, **kwargs):
+        """Returns the number of rows that match, see kangaroo.Table.count
+        """
+        return sum(self.shard(p).count(**kwargs) 
+            for p in self.__positions(parse_filters(kwargs)))
+
+    def aggregate(self, **kwargs):
+        """Computes sum, min and max of columns, see kangaroo.Table.aggregate
+
+        Every shard computes its own result and they are combined.
+        """
+        functions = pop_functions(kwargs)
+        params = dict(kwargs, **dict(functions))
+        result = empty(functions)
+        for p in self.__positions(parse_filters(kwargs)):
+            combine(result, functions, self.shard(p).aggregate(**params))
+        return result
+
+    def group_by(self, column, **kwargs):
+        """Counts the rows of every value of a column, see 
+        kangaroo.Table.group_by
+        """
+        functions = pop_functions(kwargs)
+        params = dict(kwargs, **dict(functions))
+        groups = {}
+        for p in self.__positions(parse_filters(kwargs)):
+            combine_groups(groups, functions, 
+                self.shard(p).group_by(column, **params))
+        return groups
+
+    def explain(self, **kwargs):
+        """Explains how the table resolves a query
+
+        :returns: A dictionary with the shards visited, the plan of every
+            shard and the number of rows returned
+        """
+        positions = self.__positions(parse_filters(kwargs))
+        plans = [self.shard(p).explain(**kwargs) for p in positions]
+        return {
+            "access": "partitioned",
+            "shards": [shard_name(self.__tbl_name, p) for p in positions],
+            "total_shards": self.__shards,
+            "plans": plans,
+            "actual_rows": sum(p["actual_rows"] for p in plans)
+        }
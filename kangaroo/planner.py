@@ -0,0 +1,129 @@
+class QueryPlan(object):
+    def __init__(self, filters, table_size):
+        """Describes how a table is going to resolve a list of filters
+
+        Every filter that an index can resolve is a candidate. The candidate
+        with the smallest number of rows drives the query, the other
+        equality candidates are probed with a constant time membership test
+        over their group and the rest of the filters are applied row by row
+        over the survivors.
+
+        :param filters: A list of kangaroo.filters.Filter instances.
+        :param table_size: The number of rows in the table.
+        """
+        self.filters = filters
+        self.table_size = table_size
+        self.candidates = []
+        self.driver = None
+        self.probes = []
+        self.residual = list(filters)
+
+    def add_candidate(self, operator, index, groups, covered=None):
+        """Registers the groups of rows that an index returned for a filter
+
+        :param operator: An instance of kangaroo.filters.Filter
+        :param index: The instance of kangaroo.index.Index that resolved it.
+        :param groups: The groups of rows returned by index.lookup
+        :param covered: The list of filters resolved by the groups when a
+            composite index resolves several filters, [operator] by default.
+        """
+        size = sum(len(g) for g in groups)
+        covered = [operator] if covered is None else covered
+        self.candidates.append((size, operator, index, groups, covered))
+
+    def __resolve(self, candidate):
+        for f in candidate[4]:
+            # a filter can be covered by several candidates
+            if f in self.residual:
+                self.residual.remove(f)
+
+    def choose(self):
+        """Picks the driver and the probes of the plan
+        """
+        if len(self.candidates) == 0:
+            return
+        self.candidates.sort(key=lambda c: c[0])
+        self.driver = self.candidates[0]
+        self.__resolve(self.driver)
+
+        for candidate in self.candidates[1:]:
+            # a single group is a dictionary, so checking a row id against
+            # it costs nothing. Several groups would have to be merged in a
+            # set first and that costs more than comparing the survivors.
+            if len(candidate[3]) == 1:
+                self.probes.append(candidate)
+                self.__resolve(candidate)
+
+    @property
+    def estimated_rows(self):
+        """Returns the number of rows that the plan expects to return
+
+        Filters are considered independent, so every probe reduces the
+        estimation by its selectivity.
+        """
+        if self.driver is None:
+            return self.table_size
+        estimated = float(self.driver[0])
+        for candidate in self.probes:
+            estimated *= float(candidate[0]) / max(self.table_size, 1)
+        return int(round(estimated))
+
+    @property
+    def scanned_rows(self):
+        """Returns the number of rows that the plan has to visit
+        """
+        if self.driver is None:
+            return self.table_size
+        return self.driver[0]
+
+    def execute(self, rows):
+        """Returns an iterator over the rows selected by the indexes
+
+        The residual filters still have to be applied over these rows. 
+        When the driver has several groups their rows are returned in the 
+        order of their ids, like a scan, so limit and offset don't depend 
+        on the indexes. A single group is returned in the order the rows 
+        entered it.
+
+        :param rows: An iterable with every row of the table.
+        :returns: An iterator of rows
+        """
+        if self.driver is None:
+            return iter(rows)
+        return self.__probe()
+
+    def __probe(self):
+        groups = [c[3][0] for c in self.probes]
+        driver = self.driver[3]
+        if len(driver) == 1:
+            rows = driver[0]
+            idds = rows.keys()
+        else:
+            rows = {}
+            for group in driver:
+                rows.update(group)
+            idds = sorted(rows)
+        for idd in idds:
+            for g in groups:
+                if idd not in g:
+                    break
+            else:
+                yield rows[idd]
+
+    def describe(self):
+        """Returns a dictionary that describes the plan
+        """
+        def step(candidate):
+            return dict(column=candidate[2].column, kind=candidate[2].kind,
+                operator=candidate[1].name, estimated_rows=candidate[0])
+
+        return {
+            "access": "scan" if self.driver is None else "index",
+            "driver": None if self.driver is None else step(self.driver),
+            "probes": [step(c) for c in self.probes],
+            "residual_filters": ["{0}__{1}".format(f.key, f.name)
+                for f in self.residual],
+            "table_rows": self.table_size,
+            "scanned_rows": self.scanned_rows,
+            "estimated_rows": self.estimated_rows
+        }
@@ -0,0 +1,139 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class QueryProfile(object):
+    def __init__(self, table, filters):
+        """The measures of a single query
+
+        :param table: The name of the table
+        :param filters: A list of kangaroo.filters.Filter instances
+        """
+        self.table = table
+        self.filters = ["{0}__{1}".format(f.key, f.name) for f in filters]
+        self.operators = [f.name for f in filters]
+        self.access = "scan"
+        self.index = None
+        self.rows_scanned = 0
+        self.rows_returned = 0
+        self.seconds = None
+        self.start = time.perf_counter()
+
+    def planned(self, plan):
+        """Records the plan chosen for the query
+
+        :param plan: An instance of kangaroo.planner.QueryPlan
+        """
+        if plan.driver is not None:
+            self.access = "index"
+            index = plan.driver[2]
+            self.index = dict(column=index.column, kind=index.kind,
+                operator=plan.driver[1].name)
+
+    def scan(self, rows):
+        """Counts the rows that the query visits
+
+        :param rows: An iterable of rows
+        :returns: An iterator over the same rows
+        """
+        for row in rows:
+            self.rows_scanned += 1
+            yield row
+
+    def finish(self, rows_returned):
+        """Records the end of the query
+
+        :param rows_returned: The number of rows returned
+        :returns: The same instance
+        """
+        self.seconds = time.perf_counter() - self.start
+        self.rows_returned = rows_returned
+        return self
+
+    def as_dict(self):
+        """Returns a dictionary with the measures of the query
+        """
+        return dict(table=self.table, filters=self.filters,
+            access=self.access, index=self.index, seconds=self.seconds,
+            rows_scanned=self.rows_scanned, rows_returned=self.rows_returned)
+
+class Profiler(object):
+    def __init__(self, slow_query_seconds=None, callback=None):
+        """Collects the profiles of the queries of one or more tables
+
+        Counters are kept per table and per operator. Queries slower than
+        slow_query_seconds are logged with the "kangaroo.profiling" logger
+        and every profile is passed to callback.
+
+        Example:
+            >> profiler = Profiler(slow_query_seconds=0.1)
+            >> table.enable_profiling(profiler)
+            >> table.find_all(number__gt=10)
+            >> profiler.stats["zoo"]["queries"]
+            1
+
+        :param slow_query_seconds: The seconds that make a query slow, None
+            to not log slow queries.
+        :param callback: A callable that receives every
+            kangaroo.profiling.QueryProfile
+        """
+        self.slow_query_seconds = slow_query_seconds
+        self.callback = callback
+        self.tables = {}
+        self.lock = threading.Lock()
+
+    def __counters(self, table):
+        counters = self.tables.get(table)
+        if counters is None:
+            counters = self.tables[table] = dict(queries=0, seconds=0.0,
+                rows_scanned=0, rows_returned=0, slow_queries=0,
+                access={}, operators={})
+        return counters
+
+    def record(self, profile):
+        """Adds a finished query to the counters
+
+        :param profile: An instance of kangaroo.profiling.QueryProfile
+        """
+        slow = self.slow_query_seconds is not None and \
+            profile.seconds >= self.slow_query_seconds
+        with self.lock:
+            counters = self.__counters(profile.table)
+            counters["queries"] += 1
+            counters["seconds"] += profile.seconds
+            counters["rows_scanned"] += profile.rows_scanned
+            counters["rows_returned"] += profile.rows_returned
+            counters["access"][profile.access] = \
+                counters["access"].get(profile.access, 0) + 1
+            for operator in profile.operators:
+                counters["operators"][operator] = \
+                    counters["operators"].get(operator, 0) + 1
+            if slow:
+                counters["slow_queries"] += 1
+
+        if slow:
+            logger.warning("Slow query on %s %s: %.4fs, %s access, "
+                "%d rows scanned, %d rows returned", profile.table,
+                profile.filters, profile.seconds, profile.access,
+                profile.rows_scanned, profile.rows_returned)
+        if self.callback is not None:
+            self.callback(profile)
+
+    @property
+    def stats(self):
+        """Returns the counters of every table
+
+        :returns: A dictionary of table name -> counters
+        """
+        with self.lock:
+            return dict((name, dict(c, access=dict(c["access"]),
+                operators=dict(c["operators"])))
+                for name, c in self.tables.items())
+
+    def reset(self):
+        """Sets every counter to zero
+        """
+        with self.lock:
+            self.tables = {}
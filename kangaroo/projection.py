@@ -0,0 +1,52 @@
+def projector(fields, values_list=False, schema=None):
+    """Returns a function that keeps only some columns of a row
+
+    :param fields: A list of column names
+    :param values_list: True to return tuples with the values in the order
+        of fields, None where the row doesn't have the column. By default
+        dictionaries with the columns of fields that the row has are
+        returned.
+    :param schema: The schema of a compact table, the values of its rows
+        are read by position.
+    :returns: A function that receives a row
+    """
+    fields = list(fields)
+    if schema is not None:
+        # kangaroo.table imports this module
+        from kangaroo.table import MISSING
+        positions = [schema.positions.get(f, -1) for f in fields]
+
+        def read(row):
+            values = row.packed()
+            size = len(values)
+            return [values[p] if 0 <= p < size else MISSING 
+                for p in positions]
+
+        if values_list:
+            def project(row):
+                return tuple([None if v is MISSING else v for v in read(row)])
+        else:
+            def project(row):
+                return dict([(f, v) for f, v in zip(fields, read(row))
+                    if v is not MISSING])
+    elif values_list:
+        def project(row):
+            get = row.get
+            return tuple([get(f) for f in fields])
+    else:
+        def project(row):
+            return dict([(f, row[f]) for f in fields if f in row])
+    return project
+
+def project_rows(rows, fields, values_list=False, schema=None):
+    """Returns the projection of every row, see projector
+
+    :param rows: An iterable of rows
+    :returns: A list of dictionaries or tuples
+    """
+    if fields is None:
+        if values_list:
+            raise Exception("values_list needs a list of fields")
+        return list(rows)
+    project = projector(fields, values_list, schema)
+    return [project(row) for row in rows]
@@ -1,8 +1,81 @@
+import contextlib
 import csv
+import itertools
 import json
+import mmap
+import os
 import pickle
+import struct
+import threading
 import time 
-from kangaroo.table import Table
+
+try:
+    from urllib.parse import quote, unquote
+except ImportError:
+    from urllib import quote, unquote
+
+from kangaroo.inference import infer_converter, safe_converter
+
+def sync_directory(path):
+    """Syncs to disk the entries of the directory that contains path
+
+    A rename or a new file is only durable once its directory is synced.
+    Windows can't open directories, there it does nothing.
+
+    :param path: The path of a file
+    """
+    if os.name == "nt":
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+@contextlib.contextmanager
+def atomic_open(path, mode='w'):
+    """Opens a temporary file that replaces path once it's written
+
+    The file is synced to disk before it's renamed and the directory after
+    it, so path always has either the old content or the new one, even if 
+    the process or the machine crashes.
+
+    Example:
+        >> with atomic_open("db.kg", "wb") as f:
+        ..     f.write(data)
+
+    :param path: The path of the file that we want to write
+    :param mode: The mode used to open the temporary file
+    """
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    sync_directory(path)
+
+def plain_rows(table):
+    """Returns the rows of a table as dictionaries for the encoders
+
+    Rows of a normal table are dictionaries already. Compact and columnar
+    tables project every column, so the encoders receive plain 
+    dictionaries and columnar tables don't create a Row per record.
+
+    :param table: A table of the bucket
+    :returns: A list of dictionaries
+    """
+    columns = getattr(table, "columns", None)
+    if columns is None and getattr(table, "schema", None) is not None:
+        columns = table.schema.columns
+    if columns is None:
+        return table.find_all()
+    return table.find_all(fields=list(columns))
 
 class Storage(object):
 
@@ -28,6 +101,11 @@ class Storage(object):
         """
         raise NotImplementedError()
 
+    def exists(self):
+        """Returns True if there is saved data to load
+        """
+        return os.path.exists(self.path)
+
     def get_data_to_save(self):
         data = {
             "tables": self.bucket.tables,
@@ -39,6 +117,36 @@ class Storage(object):
         for t in data["tables"]:
             self.bucket.add_table(t)
 
+    def lazy_tables(self):
+        """Returns the names of the tables that are saved but not loaded yet
+
+        Storages that load every table in load() don't have lazy tables.
+        """
+        return []
+
+    def load_table(self, name):
+        """Loads a table that it's saved but not loaded yet
+
+        :param name: The name of the table
+        :returns: None if the storage doesn't have the table or an instance
+            of kangaroo.Table
+        """
+        return None
+
+    def table_added(self, table):
+        """Called by the bucket when a table is added to it
+
+        :param table: An instance of kangaroo.Table
+        """
+        pass
+
+    def table_deleted(self, table):
+        """Called by the bucket when a table is deleted from it
+
+        :param table: An instance of kangaroo.Table
+        """
+        pass
+
 class StorageCPickle(Storage):
     
     def load(self):
@@ -48,7 +156,7 @@ class StorageCPickle(Storage):
 
     def dump(self):
         data = self.get_data_to_save()
-        with open(self.path, 'wb') as f:
+        with atomic_open(self.path, 'wb') as f:
             pickle.dump(data, f)
 
 class StorageJson(Storage):
@@ -58,10 +166,10 @@ class StorageJson(Storage):
             database = json.loads(f.read())
         data = dict(tables=[], time=database["time"])
         for t in database["tables"]:
-            table = Table(tbl_name=t["tbl_name"],
-                tbl_index=t["tbl_index"])
-            for row in t["rows"]:
-                table.insert(row)
+            table = self.bucket.make_table(tbl_name=t["tbl_name"],
+                tbl_index=t["tbl_index"],
+                tbl_index_kinds=t.get("tbl_index_kinds", {}))
+            table.insert_many(t["rows"])
             data["tables"].append(table)
         self.load_into_memory(data)
 
@@ -72,21 +180,114 @@ class StorageJson(Storage):
             d = {
                 "tbl_name": table.tbl_name,
                 "tbl_index": table.tbl_index,
-                "rows": table.find_all()
+                "tbl_index_kinds": table.tbl_index_kinds,
+                "rows": plain_rows(table)
             }
             tables.append(d)
         
         database = dict(time=time.time(), tables=tables)
 
-        with open(self.path, 'w') as f:
+        with atomic_open(self.path, 'w') as f:
             f.write(json.dumps(database))
 
+class StorageJsonLines(Storage):
+
+    def __init__(self, path, bucket, options):
+        """A json storage that writes one row per line
+
+        Every table is saved as a line with its name, indexes and number of
+        rows followed by a line per row. Rows are written while they are 
+        read from the table and loaded in chunks of "chunk_size" rows 
+        (10000 by default), so the whole database is never kept as a 
+        string.
+
+        :param path: A valid path where you will save the database
+        :param bucket: An instance of Bucket that we want to save
+        :param options: A dictionary of options for the storage
+        """
+        super(StorageJsonLines, self).__init__(path, bucket, options)
+
+    def load(self):
+        data = dict(tables=[])
+        chunk_size = self.options.get("chunk_size", 10000)
+        with open(self.path, 'r') as f:
+            data["time"] = json.loads(f.readline())["time"]
+            for line in f:
+                t = json.loads(line)
+                table = self.bucket.make_table(tbl_name=t["tbl_name"],
+                    tbl_index=t["tbl_index"],
+                    tbl_index_kinds=t["tbl_index_kinds"])
+                rows = (json.loads(l) for l in itertools.islice(f, t["rows"]))
+                while True:
+                    chunk = list(itertools.islice(rows, chunk_size))
+                    if len(chunk) == 0:
+                        break
+                    table.insert_many(chunk)
+                data["tables"].append(table)
+        self.load_into_memory(data)
+
+    def dump(self):
+        # compact rows are not dictionaries, default converts them
+        encode = json.JSONEncoder(default=dict).encode
+        with atomic_open(self.path, 'w') as f:
+            f.write(encode(dict(time=time.time())) + "\n")
+            for table in self.bucket.tables:
+                f.write(encode({
+                    "tbl_name": table.tbl_name,
+                    "tbl_index": table.tbl_index,
+                    "tbl_index_kinds": table.tbl_index_kinds,
+                    "rows": len(table)
+                }) + "\n")
+                for row in table.iter_find():
+                    f.write(encode(row) + "\n")
 
 class StorageCsv(Storage):
-    
+
+    def __init__(self, path, bucket, options):
+        """A storage that saves every table in a csv file
+
+        The rows are read in chunks of "chunk_size" rows (10000 by default) 
+        that are inserted with insert_many, so the memory used while loading
+        is the size of the table plus the size of a chunk.
+
+        Values are strings unless they are converted. "converters" is a 
+        dictionary of column name -> function and "conversion_methods" a 
+        list of functions in the order of the columns. If "infer_types" is 
+        True, the type of the rest of the columns (int, float, bool or date)
+        is inferred from the first "sample_size" rows (100 by default), 
+        empty values of those columns are left out of the row.
+
+        :param path: A valid path where you will save the database
+        :param bucket: An instance of Bucket that we want to save
+        :param options: A dictionary of options for the storage
+        """
+        super(StorageCsv, self).__init__(path, bucket, options)
+
+    def __converters(self, names, sample):
+        # returns a list of (converter, skip empty values) per column
+        converters = [(None, False)] * len(names)
+        methods = self.options.get("conversion_methods")
+        if methods is not None:
+            for i, method in enumerate(methods[:len(names)]):
+                converters[i] = (method, False)
+
+        by_name = self.options.get("converters", {})
+        infer = self.options.get("infer_types", False)
+        for i, name in enumerate(names):
+            if name in by_name:
+                converters[i] = (by_name[name], False)
+            elif converters[i][0] is None and infer:
+                converter = infer_converter([r[i] for r in sample 
+                    if i < len(r)])
+                if converter is not None:
+                    converters[i] = (safe_converter(converter), True)
+        return converters
+
     def load(self):
         data = dict(tables=[])
-        table = Table(tbl_name=self.options.get("table_name", "table1"))
+        table = self.bucket.make_table(
+            tbl_name=self.options.get("table_name", "table1"))
+        chunk_size = self.options.get("chunk_size", 10000)
 
         with open(self.path, 'r') as f:
             database = csv.reader(f, 
@@ -95,21 +296,36 @@ class StorageCsv(Storage):
             
             names = None
             if self.options.get("use_first_row_as_column_name", True):
-                names = next(database)
+                names = next(database, None)
 
-            for row in database:
-                if names is None:
-                    names = ["row{0}".format(i) for i in range(len(row))]                    
+            sample = list(itertools.islice(database, 
+                self.options.get("sample_size", 100)))
+            if names is None:
+                width = len(sample[0]) if len(sample) > 0 else 0
+                names = ["row{0}".format(i) for i in range(width)]
+            columns = [(n, c, skip) for n, (c, skip) in 
+                zip(names, self.__converters(names, sample))]
+
+            def convert(row):
                 drow = {}
-                if self.options.get("conversion_methods") is not None:
-                    row = map(lambda x, y: x(y), 
-                            self.options.get("conversion_methods"), row)
-                drow = dict(zip(names, row))
-                table.insert(drow)
+                for (name, converter, skip), value in zip(columns, row):
+                    if converter is None:
+                        drow[name] = value
+                    elif not skip or value != "":
+                        drow[name] = converter(value)
+                return drow
+
+            rows = itertools.chain(sample, database)
+            while True:
+                chunk = [convert(r) for r in itertools.islice(rows, 
+                    chunk_size)]
+                if len(chunk) == 0:
+                    break
+                table.insert_many(chunk)
+
         data["tables"].append(table)
         self.load_into_memory(data)
 
-
     def dump(self):
         data = self.get_data_to_save()
         i = -1
@@ -125,9 +341,364 @@ class StorageCsv(Storage):
                 if self.options.get("use_first_row_as_column_name", True):
                     title = table.find()
                     if title is not None:
-                        writter.writerow(list(title.keys()))
+                        names = list(title.keys())
+                        writter.writerow(names)
+                        # the values are written in the order of the names
+                        writter.writerows(table.find_all(fields=names, 
+                            values_list=True))
+                    continue
 
                 for drow in table.find_all():
                     writter.writerow(list(drow.values()))
 
+class StorageLog(Storage):
+
+    def __init__(self, path, bucket, options):
+        """A storage that appends every change to a log file
+
+        Inserts, updates, deletes and index changes are written to the log 
+        as they happen, so flush only has to sync the file. When the bucket
+        is opened the log is replayed over the last snapshot. Once the log 
+        grows past the "compact_size" option (bytes, 16MB by default) flush 
+        folds it into a new snapshot saved in path + ".snapshot".
+
+        Every record is a json line, so the values of the rows have to be 
+        serializable with json. Tables are changed by many threads at the
+        same time, so the writes to the log hold the lock of the storage.
+
+        :param path: A valid path where you will save the log
+        :param bucket: An instance of Bucket that we want to save
+        :param options: A dictionary of options for the storage
+        """
+        super(StorageLog, self).__init__(path, bucket, options)
+        self.snapshot_path = path + ".snapshot"
+        self.generation = 0
+        self.loading = False
+        self.file = None
+        # compact is called by dump holding the lock
+        self.lock = threading.RLock()
+
+    def __record(self, record):
+        return json.dumps(record, default=dict) + "\n"
+
+    def __append(self, record):
+        line = self.__record(record)
+        with self.lock:
+            if self.file is None:
+                new = not os.path.exists(self.path)
+                self.file = open(self.path, "a")
+                if new:
+                    self.file.write(self.__record(
+                        dict(op="log", generation=self.generation)))
+            self.file.write(line)
+
+    def table_added(self, table):
+        table.add_listener(self.table_changed)
+        if not self.loading:
+            self.__append(dict(op="table", table=table.tbl_name,
+                index=table.tbl_index_kinds, tbl_index=table.tbl_index))
+
+    def table_deleted(self, table):
+        table.remove_listener(self.table_changed)
+        self.__append(dict(op="drop", table=table.tbl_name))
+
+    def table_changed(self, event, table, row, key):
+        """Appends to the log a change of a table, see TableEvents
+        """
+        record = dict(table=table.tbl_name)
+        if event == "insert":
+            record.update(op="insert", id=row.idd, row=row)
+        elif event == "update" and key in row:
+            record.update(op="update", id=row.idd, key=key, value=row[key])
+        elif event == "update":
+            record.update(op="unset", id=row.idd, key=key)
+        elif event == "delete":
+            record.update(op="delete", id=row.idd)
+        elif event == "add_index":
+            record.update(op="index", key=key,
+                kind=table.tbl_index_kinds.get(key, "hash"))
+        elif event == "delete_index":
+            record.update(op="drop_index", key=key)
+        self.__append(record)
+
+    def __apply(self, record, tables):
+        op = record["op"]
+        if op == "table":
+            # logs written before composite indexes only have the kinds
+            tbl_index = record.get("tbl_index", list(record["index"]))
+            tables[record["table"]] = self.bucket.make_table(
+                tbl_name=record["table"], tbl_index=tbl_index,
+                tbl_index_kinds=record["index"])
+            return
+        elif op == "drop":
+            del tables[record["table"]]
+            return
+
+        table = tables[record["table"]]
+        if op in ("update", "unset", "delete"):
+            row = table.get_row(record["id"])
+            if row is None:
+                # older logs recorded changes of rows already deleted
+                return
+        if op == "insert":
+            table.restore(record["id"], record["row"])
+        elif op == "update":
+            row[record["key"]] = record["value"]
+        elif op == "unset":
+            del row[record["key"]]
+        elif op == "delete":
+            table.delete_row(row)
+        elif op == "index":
+            table.add_index(record["key"], kind=record["kind"])
+        elif op == "drop_index":
+            table.delete_index(record["key"])
+
+    def __replay(self, path, tables):
+        # Returns the size of the valid part of the file. A line without end
+        # is a record that was being written when the process stopped.
+        size = 0
+        header = None
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    break
+                size += len(line)
+                if header is None:
+                    header = record
+                    if header["op"] == "snapshot":
+                        self.generation = header["generation"]
+                    elif header["generation"] != self.generation:
+                        # the log was already folded in the snapshot
+                        return 0
+                else:
+                    self.__apply(record, tables)
+        return size
+
+    def exists(self):
+        return os.path.exists(self.path) or \
+            os.path.exists(self.snapshot_path)
+
+    def load(self):
+        tables = {}
+        if os.path.exists(self.snapshot_path):
+            self.__replay(self.snapshot_path, tables)
+        size = 0
+        if os.path.exists(self.path):
+            size = self.__replay(self.path, tables)
+        if size == 0 and os.path.exists(self.path):
+            # the log was folded in the snapshot or its header was lost, a 
+            # new empty log of the current generation replaces it.
+            with atomic_open(self.path, 'w') as f:
+                f.write(self.__record(dict(op="log", 
+                    generation=self.generation)))
+        elif size < os.path.getsize(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(size)
+
+        self.loading = True
+        try:
+            self.load_into_memory(dict(tables=list(tables.values())))
+        finally:
+            self.loading = False
+
+    def dump(self):
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            if self.file.tell() > self.options.get("compact_size", 2 ** 24):
+                self.compact()
+
+    def compact(self):
+        """Folds the bucket into a new snapshot and starts an empty log
+
+        The bucket calls it from dump holding the read side of every table,
+        changes of the tables hold their write side before the lock of the
+        storage, so both locks are always taken in the same order.
+        """
+        with self.lock:
+            generation = self.generation + 1
+            with atomic_open(self.snapshot_path, 'w') as f:
+                f.write(self.__record(dict(op="snapshot",
+                    generation=generation)))
+                for table in self.bucket.tables:
+                    name = table.tbl_name
+                    f.write(self.__record(dict(op="table", table=name,
+                        index=table.tbl_index_kinds,
+                        tbl_index=table.tbl_index)))
+                    for row in table.iter_find():
+                        f.write(self.__record(dict(op="insert", table=name,
+                            id=row.idd, row=row)))
+
+            # a crash before the new log is created leaves the old log with
+            # the previous generation, so it's ignored when the bucket is
+            # opened.
+            if self.file is not None:
+                self.file.close()
+            self.generation = generation
+            self.file = open(self.path, "w")
+            self.file.write(self.__record(dict(op="log",
+                generation=generation)))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+class StorageBinary(Storage):
+    MAGIC = b"KANGAROO-BIN-1\n"
+    # magic, offset and length of the table directory
+    HEADER = struct.Struct(">15sQQ")
+
+    def __init__(self, path, bucket, options):
+        """A binary storage that loads every table on demand
+
+        The file starts with a fixed size header that points to a json 
+        directory with the offset and length of every table. Tables are 
+        saved as independent pickles. The file is opened with mmap and a 
+        table is only decoded the first time that the bucket uses it, so 
+        opening a bucket doesn't depend on the size of the database and the
+        tables that are not used don't take memory.
+
+        :param path: A valid path where you will save the database
+        :param bucket: An instance of Bucket that we want to save
+        :param options: A dictionary of options for the storage
+        """
+        super(StorageBinary, self).__init__(path, bucket, options)
+        self.file = None
+        self.map = None
+        self.pending = {}
+
+    def __close(self):
+        if self.map is not None:
+            self.map.close()
+            self.file.close()
+        self.map = None
+        self.file = None
+
+    def load(self):
+        self.__close()
+        self.pending = {}
+        self.file = open(self.path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, offset, length = self.HEADER.unpack_from(self.map, 0)
+        if magic != self.MAGIC:
+            self.__close()
+            raise Exception("Invalid binary storage {0}".format(self.path))
+        directory = json.loads(self.map[offset:offset + length].decode("utf-8"))
+        for t in directory["tables"]:
+            self.pending[t["tbl_name"]] = (t["offset"], t["length"])
+
+    def lazy_tables(self):
+        return list(self.pending.keys())
+
+    def load_table(self, name):
+        if name not in self.pending:
+            return None
+        offset, length = self.pending.pop(name)
+        return pickle.loads(self.map[offset:offset + length])
+
+    def dump(self):
+        tmp_path = self.path + ".tmp"
+        tables = []
+        with open(tmp_path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, 0, 0))
+            for name in self.bucket.table_names:
+                if name in self.pending:
+                    # tables that were not loaded are copied as they are
+                    offset, length = self.pending[name]
+                    blob = self.map[offset:offset + length]
+                else:
+                    blob = pickle.dumps(getattr(self.bucket, name),
+                        pickle.HIGHEST_PROTOCOL)
+                tables.append(dict(tbl_name=name, offset=f.tell(), 
+                    length=len(blob)))
+                f.write(blob)
+
+            directory = json.dumps(dict(time=time.time(), tables=tables))
+            directory = directory.encode("utf-8")
+            offset = f.tell()
+            f.write(directory)
+            f.seek(0)
+            f.write(self.HEADER.pack(self.MAGIC, offset, len(directory)))
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.__close()
+        os.replace(tmp_path, self.path)
+        sync_directory(self.path)
+        loaded = [t["tbl_name"] for t in tables 
+            if t["tbl_name"] not in self.pending]
+        self.load()
+        for name in loaded:
+            del self.pending[name]
+
+class StorageDirectory(Storage):
+    EXTENSION = ".table"
+
+    def __init__(self, path, bucket, options):
+        """A storage that saves every table in its own file of a directory
+
+        Tables are pickled in path/<table name>.table and they are loaded 
+        the first time that the bucket uses them. flush only writes the 
+        tables that changed since they were saved, every file is written 
+        to a temporary file, synced and renamed, so a crash never leaves a 
+        table half written.
+
+        :param path: A valid path of a directory where you will save the 
+            database
+        :param bucket: An instance of Bucket that we want to save
+        :param options: A dictionary of options for the storage
+        """
+        super(StorageDirectory, self).__init__(path, bucket, options)
+        self.pending = set()
+        self.deleted = set()
+
+    def __table_path(self, name):
+        return os.path.join(self.path, quote(name, safe="") + self.EXTENSION)
+
+    def load(self):
+        for f in os.listdir(self.path):
+            if f.endswith(self.EXTENSION):
+                self.pending.add(unquote(f[:-len(self.EXTENSION)]))
+
+    def lazy_tables(self):
+        return list(self.pending)
+
+    def load_table(self, name):
+        if name not in self.pending:
+            return None
+        self.pending.remove(name)
+        with open(self.__table_path(name), 'rb') as f:
+            table = pickle.load(f)
+        table.mark_clean()
+        return table
+
+    def table_deleted(self, table):
+        self.deleted.add(table.tbl_name)
+
+    def dump(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+            sync_directory(self.path)
+
+        names = self.bucket.table_names
+        removed = False
+        for name in self.deleted:
+            if name not in names and os.path.exists(self.__table_path(name)):
+                os.remove(self.__table_path(name))
+                removed = True
+        if removed:
+            sync_directory(self.__table_path(""))
+        self.deleted = set()
 
+        for name in names:
+            if name in self.pending:
+                continue
+            table = getattr(self.bucket, name)
+            if table.dirty:
+                with atomic_open(self.__table_path(name), 'wb') as f:
+                    pickle.dump(table, f, pickle.HIGHEST_PROTOCOL)
+                table.mark_clean()
@@ -1,29 +1,95 @@
-from kangaroo.filters import get_operator
-from kangaroo.unique import generate_aleatory_string
+import contextlib
+import itertools
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+from kangaroo.aggregates import pop_functions, aggregate_rows, group_rows
+from kangaroo.cache import QueryCache
+from kangaroo.filters import parse_filters, compile_filters
+from kangaroo.index import normalize_name, make_index
+from kangaroo.locks import RWLock
+from kangaroo.ordering import parse_order, order_rows
+from kangaroo.planner import QueryPlan
+from kangaroo.profiling import QueryProfile
+from kangaroo.projection import project_rows
+
+def restore_row(data, table=None, idd=None):
+    """Creates a Row with the given columns without calling Row.__init__
+
+    It's used by pickle and by the tables to create rows quickly.
+
+    :param data: A dictionary with the columns of the row
+    :param table: The table that contains the row
+    :param idd: The id of the row
+    :returns: An instance of Row
+    """
+    row = Row.__new__(Row)
+    dict.update(row, data)
+    state = row.__dict__
+    state["table"] = table
+    state["_Row__id"] = idd
+    return row
 
 class Row(dict):
     
     def __init__(self, table=None, **kwargs):
         super(Row, self).__init__(**kwargs)        
-        self.__id = generate_aleatory_string()
+        self.__id = None
         self.table = table
 
 
-    def __getattribute__(self, name):
-        try:
-            return super(Row, self).__getattribute__(name)
-        except AttributeError:
-            if name in self.keys():
-                return self[name]
-            raise
+    def __getattr__(self, name):
+        # it's only called when the normal lookup fails, so columns never 
+        # hide the attributes and methods of the row
+        if name in self.keys():
+            return self[name]
+        raise AttributeError(name)
     
     def __setitem__(self, key, value):
-        super(Row, self).__setitem__(key, value)
-        
         # We use getattr here otherwise it will generate a problem with 
         # pickle in python3.2+
-        if getattr(self, "table", None) is not None:
-            self.table.row_updated(self, key)
+        table = getattr(self, "table", None)
+        if table is None:
+            super(Row, self).__setitem__(key, value)
+            return
+        with table.lock:
+            old = dict.get(self, key, MISSING)
+            super(Row, self).__setitem__(key, value)
+            self.__updated(table, key, old)
+
+    def __updated(self, table, key, old):
+        # if an index of the table can't keep the new value the row gets
+        # its old value back
+        try:
+            table.row_updated(self, key)
+        except Exception:
+            if old is MISSING:
+                dict.pop(self, key, None)
+            else:
+                dict.__setitem__(self, key, old)
+            table.row_restored(self, key)
+            raise
+
+    def __reduce__(self):
+        # the columns are restored at once with dict.update instead of 
+        # calling __setitem__ for every column
+        return (restore_row, (dict(self),), self.__dict__)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def __delitem__(self, key):
+        table = getattr(self, "table", None)
+        if table is None:
+            super(Row, self).__delitem__(key)
+            return
+        with table.lock:
+            old = self[key]
+            super(Row, self).__delitem__(key)
+            self.__updated(table, key, old)
 
     def __setattr__(self, name, value):
         if name in self:
@@ -34,27 +100,414 @@ class Row(dict):
     @property
     def idd(self):
         """Returns an unique id of the row
+
+        The id is an integer given by the table when the row is inserted. 
+        Ids are unique inside a table and they are never reused.
         """
         return self.__id
 
-class Table(object):
-    def __init__(self, tbl_name, tbl_index=[]):
+    def set_idd(self, idd):
+        """Sets the id of the row. It's used by the table that stores it.
+
+        :param idd: An integer
+        """
+        self.__id = idd
+
+class Missing(object):
+    """Marks the columns of the schema that a compact row doesn't have
+    """
+    def __repr__(self):
+        return "MISSING"
+
+    def __reduce__(self):
+        return "MISSING"
+
+MISSING = Missing()
+
+class Schema(object):
+    def __init__(self):
+        """The list of columns shared by the compact rows of a table
+        """
+        self.columns = []
+        self.positions = {}
+
+    def position(self, name):
+        """Returns the position of a column, adding it if it doesn't exist
+        """
+        position = self.positions.get(name)
+        if position is None:
+            position = self.positions[name] = len(self.columns)
+            self.columns.append(name)
+        return position
+
+    def pack(self, data):
+        """Returns a tuple with the values of data in the schema order
+
+        :param data: A dictionary of column -> value
+        """
+        for k in data:
+            if k not in self.positions:
+                self.position(k)
+        return tuple(data.get(k, MISSING) for k in self.columns)
+
+class CompactRow(MutableMapping):
+    __slots__ = ("table", "__id", "__values")
+
+    def __init__(self, table, values):
+        """A row that only keeps a tuple of values
+
+        The names of the columns are kept once in the schema of the table, 
+        so a compact row uses a fraction of the memory of a Row. It behaves
+        like a Row, but attributes that are not columns can't be set on it.
+
+        :param table: An instance of kangaroo.Table created with compact=True
+        :param values: A tuple of values in the order of the table schema
+        """
+        self.table = table
+        self.__id = None
+        self.__values = values
+
+    def __getitem__(self, key):
+        position = self.table.schema.positions.get(key)
+        values = self.__values
+        if position is None or position >= len(values) or \
+                values[position] is MISSING:
+            raise KeyError(key)
+        return values[position]
+
+    def __set_value(self, key, value):
+        with self.table.lock:
+            position = self.table.schema.position(key)
+            old = values = self.__values
+            if position >= len(values):
+                values += (MISSING,) * (position + 1 - len(values))
+            self.__values = values[:position] + (value,) + \
+                values[position + 1:]
+            try:
+                self.table.row_updated(self, key)
+            except Exception:
+                # see Row.__setitem__
+                self.__values = old
+                self.table.row_restored(self, key)
+                raise
+
+    def __setitem__(self, key, value):
+        self.__set_value(key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.__set_value(key, MISSING)
+
+    def __iter__(self):
+        for name, value in zip(self.table.schema.columns, self.__values):
+            if value is not MISSING:
+                yield name
+
+    def __len__(self):
+        return sum(1 for v in self.__values if v is not MISSING)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def __getattr__(self, name):
+        if name in ("table", "_CompactRow__id", "_CompactRow__values"):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name in ("table", "_CompactRow__id", "_CompactRow__values"):
+            super(CompactRow, self).__setattr__(name, value)
+        elif name in self:
+            self[name] = value
+        else:
+            raise AttributeError("Compact rows can't have new attributes, "
+                "use row[{0!r}] to add a column".format(name))
+
+    def copy(self):
+        """Returns a dictionary with the columns of the row
+        """
+        return dict(self.items())
+
+    def set_packed(self, values):
+        """Replaces the tuple of values, the table is not notified
+
+        :param values: A tuple of values in the order of the table schema
+        """
+        self.__values = values
+
+    def packed(self):
+        """Returns the tuple of values in the order of the table schema
+
+        Columns that the row doesn't have are MISSING and the tuple can be
+        shorter than the schema.
+        """
+        return self.__values
+
+    @property
+    def idd(self):
+        """Returns an unique id of the row, see Row.idd
+        """
+        return self.__id
+
+    def set_idd(self, idd):
+        """Sets the id of the row. It's used by the table that stores it.
+
+        :param idd: An integer
+        """
+        self.__id = idd
+
+class TableEvents(object):
+    """Lets other objects follow the changes of a table
+
+    A listener is a callable that receives (event, table, row, key). The 
+    events are "insert", "update" (key is the column modified), "delete", 
+    "add_index" and "delete_index" (key is the index name, row is None).
+
+    Listeners are not pickled with the table.
+
+    Every event also marks the table as dirty, so storages can skip the 
+    tables that didn't change since they were saved.
+
+    Changes of the table are made holding the write side of its lock and
+    queries hold the read side, so queries run at the same time while 
+    changes are exclusive. Another thread (like the autosave of the 
+    bucket) can hold the read side to see a consistent version of the 
+    table.
+    """
+    __listeners = ()
+    __dirty = True
+
+    @property
+    def lock(self):
+        """Returns the reader/writer lock of the table
+
+        "with table.lock" holds the write side and "with table.lock.reader"
+        the read side.
+
+        :returns: An instance of kangaroo.locks.RWLock
+        """
+        lock = self.__dict__.get("_TableEvents__lock")
+        if lock is None:
+            # setdefault is atomic, so two threads get the same lock
+            lock = self.__dict__.setdefault("_TableEvents__lock", RWLock())
+        return lock
+
+    @property
+    def dirty(self):
+        """Returns True if the table changed since mark_clean was called
+        """
+        return self.__dirty
+
+    def mark_clean(self):
+        """Marks the table as saved, it's used by the storages
+        """
+        self.__dirty = False
+
+    def add_listener(self, listener):
+        """Registers a listener of the changes of the table
+
+        :param listener: A callable
+        """
+        self.__listeners = self.__listeners + (listener,)
+
+    def remove_listener(self, listener):
+        """Removes a registered listener
+
+        :param listener: A callable registered with add_listener
+        """
+        self.__listeners = tuple(l for l in self.__listeners 
+            if l != listener)
+
+    def notify(self, event, row=None, key=None):
+        """Calls every listener with an event
+        """
+        self.__dirty = True
+        for listener in self.__listeners:
+            listener(event, self, row, key)
+
+    def notify_many(self, event, rows, keys=(None,)):
+        """Calls every listener with an event for every row
+
+        :param keys: The columns of the event, the listeners are called for
+            every row and every key.
+        """
+        self.__dirty = True
+        for listener in self.__listeners:
+            for row in rows:
+                for key in keys:
+                    listener(event, self, row, key)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_TableEvents__listeners", None)
+        state.pop("_TableEvents__lock", None)
+        return state
+
+class Table(TableEvents):
+    __cache = None
+    __parallel = None
+    __profiler = None
+
+    def __init__(self, tbl_name, tbl_index=[], tbl_index_kinds={}, 
+        compact=False):
         """Creates a new instance of kangaroo.Table
         
         :param tbl_name: The name of the table
         :param tbl_index: a list of index names that we want to use 
             in this table. 
+        :param tbl_index_kinds: a dictionary of index name -> kind of index
+            for the indexes that are not "hash" indexes.
+        :param compact: if it's True the rows are instances of CompactRow,
+            which share the column names in the schema of the table and 
+            only keep their values.
         """
         self.__tbl_name = tbl_name
-        self.__rows = []
+        self.__schema = Schema() if compact else None
+        self.__rows = {}
+        self.__next_id = 1
         self.__index = {}
-        self.__index_map = {}
         for i in tbl_index:
-            self.__index[i] = {}
+            i = normalize_name(i)
+            self.__index[i] = make_index(i, tbl_index_kinds.get(i, "hash"))
 
     def __unicode__(self):
         return "Kangaroo.Table<{0}>".format(self.tbl_name)
 
+    def __len__(self):
+        """Returns the number of rows in the table
+        """
+        return len(self.__rows)
+
+    def __getstate__(self):
+        state = super(Table, self).__getstate__()
+        state.pop("_Table__cache", None)
+        state.pop("_Table__parallel", None)
+        state.pop("_Table__profiler", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self.__rows, list):
+            self.__migrate()
+
+    def __migrate(self):
+        # tables pickled by older versions keep a list of rows with random
+        # string ids and indexes of value -> list of rows
+        rows = {}
+        for idd, row in enumerate(self.__rows, 1):
+            row.__dict__["table"] = self
+            row.set_idd(idd)
+            rows[idd] = row
+        self.__rows = rows
+        self.__next_id = len(rows) + 1
+        self.__schema = None
+        self.__dict__.pop("_Table__index_map", None)
+        index = {}
+        for name in self.__index:
+            index[name] = make_index(name)
+            index[name].add_many(list(rows.values()))
+        self.__index = index
+
+    def enable_cache(self, max_size=128):
+        """Keeps the results of find_all in a LRU cache
+
+        The results are invalidated when the rows change, see 
+        kangaroo.cache.QueryCache. The cache is not saved with the table.
+
+        :param max_size: The maximum number of results kept
+        """
+        if self.__cache is None:
+            self.__cache = QueryCache(max_size)
+            self.add_listener(self.__cache.table_changed)
+        self.__cache.max_size = max_size
+
+    def disable_cache(self):
+        """Removes the cache of results of the table
+        """
+        if self.__cache is not None:
+            self.remove_listener(self.__cache.table_changed)
+            self.__cache = None
+
+    def enable_parallel_scan(self, threshold, processes=None, 
+        chunk_size=None):
+        """Evaluates the filters of large full scans in a pool of processes
+
+        Queries that can't use an index, have to check at least threshold
+        rows and read every match are split in chunks that are filtered by
+        a concurrent.futures.ProcessPoolExecutor, see 
+        kangaroo.parallel.ParallelScan. Queries with a limit and without 
+        order_by, like find, and iter_find stay in the current process 
+        because the scan of the pool can't stop early. The rows are 
+        returned in the same order than a normal scan. Filter values have 
+        to be picklable and it needs the "fork" start method of 
+        multiprocessing.
+
+        The pool is forked for every query, which costs more than the scan
+        itself on small machines: with a single cpu and 1M rows the serial
+        scan took 0.41s and the pool 1.12s to 1.38s. It's disabled by 
+        default and there is no default threshold, measure the table with 
+        "python -m kangaroo.bench parallel_scan" on the machine that runs 
+        it before enabling it.
+
+        Example:
+            >> table.enable_parallel_scan(threshold=500000, processes=8)
+
+        :param threshold: The minimum number of rows to use the pool, see 
+            the speedup measured by the benchmark
+        :param processes: The number of processes, the number of cpus by 
+            default
+        :param chunk_size: The number of rows sent to a process at once
+        """
+        # kangaroo.parallel imports this module
+        from kangaroo.parallel import ParallelScan
+        self.__parallel = ParallelScan(threshold=threshold, 
+            processes=processes, chunk_size=chunk_size)
+
+    def disable_parallel_scan(self):
+        """Scans every table in the current process again
+        """
+        self.__parallel = None
+
+    def enable_profiling(self, profiler):
+        """Records the time, plan and rows of every query in a profiler
+
+        find and find_all are profiled, iter_find isn't because the rows
+        are consumed after it returns. When profiling is disabled queries
+        only pay an attribute check.
+
+        Example:
+            >> profiler = Profiler(slow_query_seconds=0.05)
+            >> table.enable_profiling(profiler)
+
+        :param profiler: An instance of kangaroo.profiling.Profiler
+        """
+        self.__profiler = profiler
+
+    def disable_profiling(self):
+        """Stops recording the queries of the table
+        """
+        self.__profiler = None
+
+    @property
+    def profiler(self):
+        """Returns the profiler of the table or None
+        """
+        return self.__profiler
+
+    @property
+    def cache_stats(self):
+        """Returns the counters of the cache of results
+        :returns: None if the cache is disabled or a dictionary with the 
+            hits, misses, evictions, invalidations and size of the cache.
+        """
+        if self.__cache is None:
+            return None
+        return self.__cache.stats
+
     @property
     def tbl_name(self):
         """Returns the name of the table
@@ -62,6 +515,13 @@ class Table(object):
         """
         return self.__tbl_name
 
+    @property
+    def schema(self):
+        """Returns the schema shared by the rows of a compact table
+        :returns: None if the table is not compact or an instance of Schema
+        """
+        return self.__schema
+
     @property
     def tbl_index(self):
         """Returns the list of indexs of the table
@@ -69,82 +529,276 @@ class Table(object):
         """
         return list(self.__index.keys())
 
-    def add_index(self, index_name):
+    @property
+    def tbl_index_kinds(self):
+        """Returns the kind of every index of the table
+
+        Composite indexes are left out, they are always "hash" indexes and
+        their names are tuples that json can't use as keys.
+
+        :returns: A dictionary of index name -> kind of index
+        """
+        return dict((k, v.kind) for k, v in self.__index.items()
+            if not isinstance(k, tuple))
+
+    def index_groups(self, column):
+        """Returns the rows grouped by the index over a column
+
+        The groups belong to the index, they change with the table and 
+        they should not be modified.
+
+        :param column: The name of an indexed column
+        :returns: None if the column has no index or a dictionary of 
+            value -> dictionary of row.idd -> row
+        """
+        index = self.__index.get(column)
+        return None if index is None else index.groups
+
+    def add_index(self, index_name, kind="hash"):
         """Add a new index in the table 
+
+        A tuple of columns creates a composite index, see 
+        kangaroo.index.CompositeIndex. It resolves equality over every
+        column of the tuple or over its leftmost columns.
+
+        Example:
+            >> table.add_index("number", kind="sorted")
+            >> table.add_index(("country", "state"))
         
-        :param index_name: The name of the index (a column in the table).
+        :param index_name: The name of the index (a column in the table) or
+            a tuple of column names.
+        :param kind: The kind of index. A "hash" index resolves equality 
+            filters, a "sorted" index also resolves gt, gte, range and 
+            startswith filters.
         """
-        if index_name not in self.__index:
-            self.__index[index_name] = {}
-            self.__build_index(index_name)
+        index_name = normalize_name(index_name)
+        with self.lock:
+            index = self.__index.get(index_name)
+            if index is None or index.kind != kind:
+                index = make_index(index_name, kind)
+                # the index is only used once every row is in it
+                index.add_many(list(self.__rows.values()))
+                self.__index[index_name] = index
+                self.notify("add_index", key=index_name)
     
     def delete_index(self, index_name):
         """Deletes an existing index in the table
         
         :param index_name: The name of the index
         """
-        if index_name in self.__index:
-            del self.__index[index_name]
+        index_name = normalize_name(index_name)
+        with self.lock:
+            if index_name in self.__index:
+                del self.__index[index_name]
+                self.notify("delete_index", key=index_name)
 
     def __delete_row_from_index(self, row):
-        if row.idd in self.__index_map:
-            for index_name, v in self.__index_map[row.idd]:
-                self.__index[index_name][v].remove(row)
-                
-    def __build_index(self, index_name, rows=None):
-        if rows is None:
-            rows = self.__rows
-
-        for row in rows:
-            if index_name in row:
-                v = row[index_name]
-                if v not in self.__index[index_name]:
-                    self.__index[index_name][v] = []    
-                self.__index[index_name][v].append(row)
+        for index in self.__index.values():
+            index.remove(row)
                 
-                if row.idd not in self.__index_map:
-                    self.__index_map[row.idd] = []
-                self.__index_map[row.idd].append((index_name, v))
-    
-    
     def row_updated(self, row, key_changed):
         """Updates the index tree when a row it's modified
         
+        Rows that are not in the table, like deleted rows, are ignored.
+
         :param row: An instance of kangaroo.Row
         :param key_changed: The name of the column that was modified
         """
-        if key_changed not in self.tbl_index:
-            return 
-        
-        # verify if we need to update the index_map
-        update = True
-        if row.idd in self.__index_map:
-            self.__index_map[row.idd] = []
-        
-        for i, v in self.__index_map[row.idd]:
-            if i == key_changed:
-                if v != row[i]:
-                    self.__index[i][v].remove(row)
-                    self.__index_map[row.idd].remove((i, v))
-                else:
-                    # if the value didn't change
-                    update = False
-        if update:
-            value = row[key_changed]
-            if value not in self.__index[key_changed]:
-                self.__index[key_changed][value] = []
-            self.__index[key_changed][value].append(row)
-            im = (key_changed, value)
-            self.__index_map[row.idd].append(im)
+        with self.lock:
+            if self.__rows.get(row.idd) is not row:
+                return
+            for index in self.__index.values():
+                if key_changed in index.columns:
+                    index.update(row)
+            self.notify("update", row, key_changed)
 
+    def row_restored(self, row, key_changed):
+        """Puts back the row in the indexes after row_updated failed
+
+        The row already has its old value and the listeners are not 
+        notified, for them the row never changed.
+
+        :param row: An instance of kangaroo.Row
+        :param key_changed: The name of the column that was modified
+        """
+        with self.lock:
+            if self.__rows.get(row.idd) is not row:
+                return
+            for index in self.__index.values():
+                if key_changed in index.columns:
+                    index.update(row)
 
     def delete_row(self, row):
         """Deletes a row from the table
         
         :param row: An instance of kangaroo.Row
+        :raises: ValueError if the row is not in the table
+        """
+        with self.lock:
+            if self.__rows.get(row.idd) is not row:
+                raise ValueError("The row is not in the table {0}".format(
+                    self.__tbl_name))
+            self.__delete_row_from_index(row)
+            del self.__rows[row.idd]
+            self.notify("delete", row)
+
+    def move_row(self, row):
+        """Moves a row of other table to this table
+
+        The same object is kept, so the references to the row see the 
+        changes made after the move. The row is deleted from its table and
+        it gets a new id in this one.
+
+        Both tables are locked in the order of their names, like a flush of
+        the bucket does, so the thread can't hold the lock of any of them.
+
+        :param row: An instance of kangaroo.Row or CompactRow
+        :returns: The same row
+        :raises: ValueError if the row is not in its table
         """
-        self.__delete_row_from_index(row)
-        self.__rows.remove(row)
+        while True:
+            source = row.table
+            tables = [self]
+            if source is not None and source is not self:
+                tables.append(source)
+            with contextlib.ExitStack() as stack:
+                for table in sorted(tables, key=lambda t: t.tbl_name):
+                    stack.enter_context(table.lock)
+                # other thread could have moved the row while we waited
+                if row.table is source:
+                    return self.__move_row(row, source)
+
+    def __move_row(self, row, source):
+        # holds the locks of both tables
+        if source is not None and source is not self:
+            source.delete_row(row)
+        data = dict(row)
+        idd = self.__next_id
+        if self.__schema is not None:
+            row.table = self
+            row.set_packed(self.__schema.pack(data))
+        else:
+            # a column named "table" would hide the attribute
+            row.__dict__["table"] = self
+        row.set_idd(idd)
+        self.__next_id = idd + 1
+        self.__rows[idd] = row
+        for index in self.__index.values():
+            index.add(row)
+        self.notify("insert", row)
+        return row
+
+    def update_where(self, filters, values):
+        """Sets the same values in every row that matches the filters
+
+        The rows are found once and every index over the modified columns 
+        is updated in a single batch. Listeners receive an "update" event 
+        for every row and column, like when the columns are set one by one.
+
+        Example:
+            >> table.update_where(dict(animal="lion"), dict(number=0))
+            2
+
+        :param filters: A dictionary with the same params that we use in
+            find_all
+        :param values: A dictionary of column -> new value
+        :returns: The number of modified rows
+        """
+        filters = parse_filters(filters)
+        with self.lock:
+            rows = list(self.__execute(self.__plan(filters), complete=True))
+            if len(rows) == 0 or len(values) == 0:
+                return len(rows)
+            indexes = [i for i in self.__index.values() 
+                if any(k in i.columns for k in values)]
+            for index in indexes:
+                index.remove_many(rows)
+            restore = self.__set_values(rows, values)
+            added = []
+            try:
+                for index in indexes:
+                    index.add_many(rows)
+                    added.append(index)
+            except Exception:
+                # an index can't keep a value, the rows get their old 
+                # values back and return to every index
+                restore()
+                for index in added:
+                    index.remove_many(rows)
+                for index in indexes:
+                    index.add_many(rows)
+                raise
+            self.notify_many("update", rows, list(values.keys()))
+        return len(rows)
+
+    def __set_values(self, rows, values):
+        # returns a function that puts back the old values of the rows
+        if self.__schema is None:
+            keys = list(values.keys())
+            old = [[dict.get(row, k, MISSING) for k in keys] for row in rows]
+            for row in rows:
+                dict.update(row, values)
+
+            def restore():
+                for row, row_values in zip(rows, old):
+                    for k, v in zip(keys, row_values):
+                        if v is MISSING:
+                            dict.pop(row, k, None)
+                        else:
+                            dict.__setitem__(row, k, v)
+            return restore
+
+        schema = self.__schema
+        for k in values:
+            schema.position(k)
+        positions = [(schema.positions[k], v) for k, v in values.items()]
+        size = len(schema.columns)
+        old = [row.packed() for row in rows]
+        for row in rows:
+            packed = list(row.packed())
+            packed.extend([MISSING] * (size - len(packed)))
+            for position, value in positions:
+                packed[position] = value
+            row.set_packed(tuple(packed))
+
+        def restore():
+            for row, packed in zip(rows, old):
+                row.set_packed(packed)
+        return restore
+
+    def delete_where(self, filters):
+        """Deletes every row that matches the filters
+
+        The rows are found once and removed from every index in a single
+        batch.
+
+        Example:
+            >> table.delete_where(dict(number__gt=10))
+            3
+
+        :param filters: A dictionary with the same params that we use in
+            find_all
+        :returns: The number of deleted rows
+        """
+        filters = parse_filters(filters)
+        with self.lock:
+            rows = list(self.__execute(self.__plan(filters), complete=True))
+            if len(rows) == 0:
+                return 0
+            for index in self.__index.values():
+                index.remove_many(rows)
+            for row in rows:
+                del self.__rows[row.idd]
+            self.notify_many("delete", rows)
+        return len(rows)
+
+    def get_row(self, idd):
+        """Returns the row with the given id
+
+        :param idd: The id of the row
+        :returns: None if there is no row with that id or an instance of Row
+        """
+        return self.__rows.get(idd)
 
     def insert(self, data):
         """Inserts a new row in the table
@@ -153,10 +807,87 @@ class Table(object):
             new Row.
         :returns: An instance of Row
         """
-        row = Row(table=self, **data)
-        self.__rows.append(row)
-        for k in self.tbl_index:
-            self.__build_index(k, [row])
+        with self.lock:
+            row = self.__store(data, self.__next_id)
+            self.notify("insert", row)
+        return row
+
+    def insert_many(self, iterable):
+        """Inserts a group of rows in the table
+
+        Rows are stored first and then every index is updated in a single 
+        pass, so it's faster than calling insert for every row.
+
+        Example:
+            >> table.insert_many(dict(number=i) for i in range(1000))
+
+        :param iterable: An iterable of dictionaries
+        :returns: A list of Row instances
+        """
+        with self.lock:
+            return self.__insert_many(iterable)
+
+    def __insert_many(self, iterable):
+        rows = []
+        schema = self.__schema
+        next_id = self.__next_id
+        try:
+            for data in iterable:
+                if schema is not None:
+                    row = CompactRow(self, schema.pack(data))
+                    row.set_idd(next_id)
+                else:
+                    row = restore_row(data, self, next_id)
+                self.__rows[next_id] = row
+                next_id += 1
+                rows.append(row)
+        finally:
+            # the rows stored before an error are indexed too
+            self.__next_id = next_id
+            self.__index_rows(rows)
+            self.notify_many("insert", rows)
+        return rows
+
+    def __index_rows(self, rows):
+        # if an index can't keep a row, the rows leave the table and the 
+        # indexes
+        added = []
+        try:
+            for index in self.__index.values():
+                if len(rows) == 1:
+                    index.add(rows[0])
+                else:
+                    index.add_many(rows)
+                added.append(index)
+        except Exception:
+            for index in added:
+                index.remove_many(rows)
+            for row in rows:
+                del self.__rows[row.idd]
+            raise
+
+    def restore(self, idd, data):
+        """Inserts a row keeping the id that it had when it was saved
+
+        It's used by the storages that record row ids, listeners are not 
+        notified.
+
+        :param idd: The id of the row
+        :param data: A dictionary with the columns of the row
+        :returns: An instance of Row
+        """
+        with self.lock:
+            return self.__store(data, idd)
+
+    def __store(self, data, idd):
+        if self.__schema is not None:
+            row = CompactRow(self, self.__schema.pack(data))
+            row.set_idd(idd)
+        else:
+            row = restore_row(data, self, idd)
+        self.__rows[idd] = row
+        self.__index_rows([row])
+        self.__next_id = max(self.__next_id, idd + 1)
         return row
 
     def find(self, **kwargs):
@@ -170,66 +901,299 @@ class Table(object):
         :returns: None if there is no row that matchs or an instance of Row 
             otherwise.
         """
-        result_set = self.find_all(**kwargs)
-        if len(result_set) > 0:
-            return result_set[0]
-        return None
-
-    def __reduce_row_by_index(self, filters):
-        row_groups = []
-        active_indexs = 0
-        for filter_name, filter_value in filters.items():
-            if filter_name in self.tbl_index:
-                active_indexs += 1
-                row_groups.append(
-                    self.__index[filter_name].get(filter_value, []))
-        
-        if active_indexs == 0:
-            return self.__rows
+        rows = self.find_all(limit=1, **kwargs)
+        return rows[0] if len(rows) > 0 else None
 
-        rows = []
-        row_groups.sort(key=lambda x: len(x))
-        for row in row_groups[0]:
-            add = True
-            for ll in row_groups[1:]:
-                add = a in ll
-                if not add:
+    def __plan(self, filters):
+        plan = QueryPlan(filters, len(self.__rows))
+        composites = []
+        for name, index in self.__index.items():
+            if isinstance(name, tuple):
+                composites.append(index)
+        for f in filters:
+            index = self.__index.get(f.key)
+            if index is None:
+                continue
+            groups = index.lookup(f)
+            if groups is not None:
+                plan.add_candidate(f, index, groups)
+        if len(composites) > 0:
+            self.__plan_composites(plan, filters, composites)
+        plan.choose()
+        return plan
+
+    def __plan_composites(self, plan, filters, composites):
+        # a composite index resolves the equalities over its leftmost
+        # columns
+        equal = dict((f.key, f) for f in filters if f.name == "eq")
+        for index in composites:
+            covered = []
+            for column in index.columns:
+                if column not in equal:
                     break
-            if add:
-                rows.append(row)
-        return rows
-        
-    
-    def __parse_filters(self, params):
-        filters = []
-        fields = {}
-        for k in params.keys():
-            args = k.split("__")
-            key = args[0]
-            value = params[k]
-            operator_name = args[1] if len(args) == 2 else "eq"
-            fields[key] = value
-            op_class = get_operator(operator_name)
-            operator = op_class(key, value)
-            filters.append(operator)
-
-        return fields, filters
-
-    def find_all(self, **kwargs):
+                covered.append(equal[column])
+            if len(covered) == 0:
+                continue
+            groups = index.lookup_prefix(tuple([f.value for f in covered]))
+            if groups is not None:
+                plan.add_candidate(covered[0], index, groups, covered)
+
+    def iter_find(self, **kwargs):
+        """Iterates over the rows of the table that match the filters
+
+        Rows are evaluated one by one against every filter while the 
+        iterator is consumed, so the work stops as soon as the caller stops 
+        asking for rows. The table should not be modified while iterating,
+        other threads can hold "table.lock.reader" during the iteration to
+        keep writers out.
+
+        Example:
+            >> for row in table.iter_find(other_field__gt=50):
+            ..     print(row.my_field)
+
+        :param kwargs: a list of params that we are going to use to filter
+            the existing rows. 
+        :returns: An iterator of Row instances
+        """
+        filters = parse_filters(kwargs)
+        return self.__execute(self.__plan(filters))
+
+    def __execute(self, plan, profile=None, complete=False):
+        # complete is True when the caller reads every row, the pool is only
+        # used then because its scan can't stop early
+        parallel = self.__parallel
+        if complete and parallel is not None and plan.driver is None and \
+                len(plan.residual) > 0 and \
+                len(self.__rows) >= parallel.threshold:
+            if profile is not None:
+                profile.rows_scanned = len(self.__rows)
+            return iter(parallel.scan(list(self.__rows.values()), 
+                plan.residual))
+
+        rows = plan.execute(self.__rows.values())
+        if profile is not None:
+            rows = profile.scan(rows)
+        match = compile_filters(plan.residual)
+        if match is None:
+            return rows
+        return (row for row in rows if match(row))
+
+    def find_all(self, limit=None, offset=0, order_by=None, fields=None, 
+        values_list=False, **kwargs):
         """Finds a list of rows in the table
+
+        With order_by and a limit only the best offset + limit rows are
+        kept in a heap while the matches are found. When the column of the
+        order has a sorted index and no index resolves the filters, the
+        rows are read in the order of the index and the search stops after
+        offset + limit matches. Rows without the column or with None go 
+        last in both directions.
         
         Example:
             >> table.database.find_all(my_field=1, other_field__gt=50)
+            >> table.database.find_all(limit=10, offset=20, my_field=1)
+            >> table.database.find_all(order_by="-score", limit=10)
+            >> table.database.find_all(fields=["name", "score"])
+            >> table.database.find_all(fields=["name"], values_list=True)
 
+        :param limit: the maximum number of rows to return. None means that
+            every row that matches is returned.
+        :param offset: the number of matching rows to skip.
+        :param order_by: the name of the column used to sort the rows, with
+            a "-" prefix for descending order. None keeps the order of the
+            table.
+        :param fields: a list of column names. The result is a list of 
+            plain dictionaries with only those columns instead of rows.
+        :param values_list: if it's True the result is a list of tuples with
+            the values of fields in order, None for missing columns.
         :param kwargs: a list of params that we are going to use to filter
             the existing rows. 
-        :returns: None if there is no row that matchs or a list of Row 
-            instances otherwise.
+        :returns: A list of Row instances, empty if there is no row that
+            matchs.
         """
-        fields, filters = self.__parse_filters(kwargs)
-        result_set = self.__reduce_row_by_index(fields)
+        filters = parse_filters(kwargs)
+        profiler = self.__profiler
+        profile = None
+        if profiler is not None:
+            profile = QueryProfile(self.__tbl_name, filters)
 
-        for f in filters:
-            result_set = list(filter(f.compare, result_set))
+        with self.lock.reader:
+            rows = self.__find_all(filters, limit, offset, order_by, profile)
+            if fields is not None or values_list:
+                rows = project_rows(rows, fields, values_list, 
+                    self.__schema)
+        if profile is not None:
+            profiler.record(profile.finish(len(rows)))
+        return rows
+
+    def __find_all(self, filters, limit, offset, order_by, profile):
+        cache = self.__cache
+        key = None
+        if cache is not None:
+            key = cache.key(filters, limit, offset, order_by)
+            if key is not None:
+                rows = cache.get(key)
+                if rows is not None:
+                    if profile is not None:
+                        profile.access = "cache"
+                    return rows
+
+        plan = self.__plan(filters)
+        index = None
+        if order_by is not None and plan.driver is None:
+            column, descending = parse_order(order_by)
+            index = self.__index.get(column)
+            if getattr(index, "keys", None) is None:
+                index = None
+
+        if index is not None:
+            rows = self.__index_order(index, descending, filters)
+            if profile is not None:
+                profile.access = "index"
+                profile.index = dict(column=index.column, kind=index.kind,
+                    operator="order_by")
+                rows = profile.scan(rows)
+        else:
+            if profile is not None:
+                profile.planned(plan)
+            rows = self.__execute(plan, profile, 
+                complete=limit is None or order_by is not None)
+            if order_by is not None:
+                rows = order_rows(rows, order_by, limit, offset)
+                limit, offset = None, 0
+        if limit is not None or offset:
+            stop = None if limit is None else offset + limit
+            rows = itertools.islice(rows, offset, stop)
+        rows = list(rows)
+        if key is not None:
+            cache.put(key, filters, rows, order_by)
+        return rows
+
+    def __index_order(self, index, descending, filters):
+        # visits the rows in the order of a sorted index, rows without a
+        # value are not in the index and they go last
+        match = compile_filters(filters)
+        keys = reversed(index.keys) if descending else index.keys
+        groups = (index.groups[value].values() for value in keys)
+        last = (row for row in self.__rows.values() 
+            if row.get(index.column) is None)
+        for row in itertools.chain(itertools.chain.from_iterable(groups),
+                last):
+            if match is None or match(row):
+                yield row
+
+    def count(self, **kwargs):
+        """Returns the number of rows that match the filters
+
+        Rows are counted while they are found, no list is created. When an
+        index resolves every filter the rows are not visited, so counting
+        an equality over an indexed column takes constant time.
+
+        Example:
+            >> table.count(animal="lion", number__gt=2)
+
+        :param kwargs: the same params that we use in find_all
+        :returns: An integer
+        """
+        filters = parse_filters(kwargs)
+        with self.lock.reader:
+            if len(filters) == 0:
+                return len(self.__rows)
+            plan = self.__plan(filters)
+            if plan.driver is not None and len(plan.probes) == 0 and \
+                    len(plan.residual) == 0:
+                return plan.driver[0]
+            return sum(1 for row in self.__execute(plan, complete=True))
+
+    def aggregate(self, **kwargs):
+        """Computes sum, min and max of columns over the matching rows
 
-        return result_set
+        The functions are given as function=column and the rest of the 
+        params are filters. Rows without the column or with None are 
+        ignored. Without filters, min and max of a column with a sorted 
+        index are read from the index.
+
+        Example:
+            >> table.aggregate(sum="price", max="price", animal="lion")
+            {'sum': 120, 'max': 50}
+
+        :param kwargs: "sum", "min" and "max" with the name of a column and
+            the same filters that we use in find_all
+        :returns: A dictionary of function -> value. The sum of no values 
+            is 0, min and max are None.
+        """
+        functions = pop_functions(kwargs)
+        filters = parse_filters(kwargs)
+        with self.lock.reader:
+            indexed = {}
+            if len(filters) == 0:
+                for name, column in functions:
+                    index = self.__index.get(column)
+                    keys = getattr(index, "keys", None)
+                    if name in ("min", "max") and keys is not None:
+                        value = None
+                        if len(keys) > 0:
+                            value = keys[0] if name == "min" else keys[-1]
+                        indexed[name] = value
+            pending = [f for f in functions if f[0] not in indexed]
+            if len(pending) == 0:
+                return indexed
+            result = aggregate_rows(self.__execute(self.__plan(filters),
+                complete=True), pending)
+        result.update(indexed)
+        return result
+
+    def group_by(self, column, **kwargs):
+        """Counts the matching rows for every value of a column
+
+        "sum", "min" and "max" can be computed for every group like in 
+        aggregate. Rows without the column are counted in the None group.
+        Without filters nor functions the groups of an index over the 
+        column are counted without visiting the rows.
+
+        Example:
+            >> table.group_by("animal", sum="number", number__gt=2)
+            {'lion': {'count': 2, 'sum': 10}, 'kangaroo': {...}}
+
+        :param column: The name of the column used to group the rows
+        :param kwargs: the functions and filters, see aggregate
+        :returns: A dictionary of value -> dictionary with the count and 
+            the functions of the group
+        """
+        functions = pop_functions(kwargs)
+        filters = parse_filters(kwargs)
+        with self.lock.reader:
+            index = self.__index.get(column)
+            if index is not None and len(filters) == 0 and \
+                    len(functions) == 0:
+                groups = dict((value, dict(count=len(group))) 
+                    for value, group in index.groups.items())
+                missing = len(self.__rows) - len(index)
+                if missing > 0:
+                    groups.setdefault(None, dict(count=0))
+                    groups[None]["count"] += missing
+                return groups
+            return group_rows(self.__execute(self.__plan(filters),
+                complete=True), column, functions)
+
+    def explain(self, **kwargs):
+        """Explains how the table resolves a query
+
+        The query is executed, so the report includes the number of rows 
+        that were really returned.
+
+        Example:
+            >> table.explain(number__gt=50, animal="lion")
+            {'access': 'index', 'driver': {'column': 'animal', ...}, ...}
+
+        :param kwargs: the same params that we use in find_all
+        :returns: A dictionary with the chosen plan, the estimated rows and 
+            the actual rows.
+        """
+        filters = parse_filters(kwargs)
+        with self.lock.reader:
+            plan = self.__plan(filters)
+            result = plan.describe()
+            result["actual_rows"] = sum(1 for row in self.__execute(plan,
+                complete=True))
+        return result
@@ -20,5 +20,8 @@ setup(
     include_package_data=True,
     zip_safe=False,
     platforms='any',
+    extras_require={
+        'columnar': ['numpy']
+    },
     classifiers=[]
 )
@@ -1,18 +1,28 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import datetime
+import json
 import os
+import shutil
+import threading
+import time
 import unittest
 import logging
 
 from kangaroo.bucket import Bucket
+from kangaroo import bench, columnar, storage
+from kangaroo.locks import RWLock
 
 class KangarooTest(unittest.TestCase):
     test_path = os.path.dirname(__file__)
 
     def tearDown(self):
-        filesToDelete = ["test.kg"]
+        filesToDelete = ["test.kg", "test.kg.snapshot"]
         for f in filesToDelete:
             p = os.path.join(self.test_path, f)
-            if os.path.exists(p):
+            if os.path.isdir(p):
+                shutil.rmtree(p)
+            elif os.path.exists(p):
                 os.remove(p)
 
     def test_create_bucket(self):
@@ -97,6 +107,40 @@ class KangarooTest(unittest.TestCase):
         f = dict(number=2)
         self.assertEqual(bucket.zoo.find(**f).number, 2)
     
+    def test_storage_pickle_old_layout(self):
+        import pickle
+        from kangaroo.table import Row, Table
+        # tables of older versions kept a list of rows with random string
+        # ids and indexes of value -> list of rows
+        table = Table.__new__(Table)
+        rows = [Row(table=table, animal="lion", number=2),
+            Row(table=table, animal="kangaroo", number=100),
+            Row(table=table, animal="lion", number=5)]
+        for i, row in enumerate(rows):
+            row.set_idd("abc{0}".format(i))
+        table.__dict__.update({"_Table__tbl_name": "zoo",
+            "_Table__rows": rows,
+            "_Table__index": {"animal": {"lion": [rows[0], rows[2]],
+                "kangaroo": [rows[1]]}},
+            "_Table__index_map": dict((r.idd, [("animal", r.animal)])
+                for r in rows)})
+        p = os.path.join(self.test_path, "test.kg")
+        with open(p, "wb") as f:
+            pickle.dump(dict(tables=[table], time=0), f)
+
+        bucket = Bucket(storage_format="pickle", storage_path=p)
+        self.assertEqual([r.idd for r in bucket.zoo.find_all()], [1, 2, 3])
+        self.assertEqual(bucket.zoo.tbl_index, ["animal"])
+        self.assertEqual(len(bucket.zoo.find_all(animal="lion")), 2)
+        self.assertEqual(bucket.zoo.insert(dict(animal="bear")).idd, 4)
+        bucket.zoo.find(number=5).animal = "bear"
+        self.assertEqual(len(bucket.zoo.find_all(animal="bear")), 2)
+        bucket.zoo.delete_row(bucket.zoo.find(number=2))
+        self.assertEqual(len(bucket.zoo.find_all(animal="lion")), 0)
+        bucket.flush()
+        self.assertEqual(len(Bucket(storage_format="pickle",
+            storage_path=p).zoo), 3)
+
     def test_storage_json(self):
         p = os.path.join(self.test_path, "test.kg")
         bucket = Bucket(storage_format="json", storage_path=p)
@@ -111,6 +155,214 @@ class KangarooTest(unittest.TestCase):
         f = dict(number=2)
         self.assertEqual(bucket.zoo.find(**f).number, 2)
 
+    def test_storage_json_lines(self):
+        p = os.path.join(self.test_path, "test.kg")
+        bucket = Bucket(storage_format="jsonl", storage_path=p)
+        bucket.zoo.add_index("number", kind="sorted")
+        bucket.zoo.insert_many(dict(animal="lion", number=i) 
+            for i in range(25))
+        bucket.birds.insert(dict(name="owl\nbird"))
+        bucket.empty.add_index("name")
+        bucket.flush()
+
+        bucket = Bucket(storage_format="jsonl", storage_path=p,
+            storage_options=dict(chunk_size=10))
+        self.assertEqual(len(bucket.zoo), 25)
+        self.assertEqual(len(bucket.zoo.find_all(number__gte=20)), 5)
+        self.assertEqual(bucket.zoo.tbl_index_kinds, {"number": "sorted"})
+        self.assertEqual(bucket.birds.find().name, "owl\nbird")
+        self.assertEqual(bucket.empty.tbl_index, ["name"])
+
+    def test_dirty_tables(self):
+        bucket = Bucket()
+        row = bucket.zoo.insert(dict(animal="lion", number=2))
+        self.assertTrue(bucket.zoo.dirty)
+        bucket.zoo.mark_clean()
+        self.assertFalse(bucket.zoo.dirty)
+        bucket.zoo.find_all(number=2)
+        self.assertFalse(bucket.zoo.dirty)
+        row["number"] = 3
+        self.assertTrue(bucket.zoo.dirty)
+
+    def test_storage_directory(self):
+        p = os.path.join(self.test_path, "test.kg")
+        bucket = Bucket(storage_format="directory", storage_path=p)
+        bucket.zoo.insert(dict(animal="lion", number=2))
+        bucket.birds.insert(dict(name="owl"))
+        bucket.fish.insert(dict(name="nemo"))
+        bucket.flush()
+        self.assertEqual(sorted(os.listdir(p)), 
+            ["birds.table", "fish.table", "zoo.table"])
+        inode = lambda name: os.stat(os.path.join(p, name)).st_ino
+        birds = inode("birds.table")
+
+        bucket = Bucket(storage_format="directory", storage_path=p)
+        zoo = inode("zoo.table")
+        bucket.zoo.insert(dict(animal="kangaroo", number=100))
+        bucket.delete_table("fish")
+        # the renames and the deletes are synced in the directory
+        synced = []
+        sync_directory = storage.sync_directory
+        storage.sync_directory = lambda path: synced.append(
+            os.path.dirname(os.path.abspath(path))) or sync_directory(path)
+        try:
+            bucket.flush()
+        finally:
+            storage.sync_directory = sync_directory
+        self.assertEqual(synced, [os.path.abspath(p)] * 2)
+        # only the changed table is written again
+        self.assertEqual(inode("birds.table"), birds)
+        self.assertNotEqual(inode("zoo.table"), zoo)
+        self.assertEqual(sorted(os.listdir(p)), ["birds.table", "zoo.table"])
+
+        bucket = Bucket(storage_format="directory", storage_path=p)
+        self.assertEqual(len(bucket.zoo), 2)
+        self.assertEqual(bucket.birds.find().name, "owl")
+        self.assertFalse(bucket.zoo.dirty)
+
+    def test_storage_log(self):
+        p = os.path.join(self.test_path, "test.kg")
+        bucket = Bucket(storage_format="log", storage_path=p)
+        bucket.zoo.add_index("number", kind="sorted")
+        bucket.zoo.insert(dict(animal="lion", number=2))
+        row = bucket.zoo.insert(dict(animal="kangaroo", number=100))
+        bucket.zoo.insert(dict(animal="bear", number=7))
+        row["number"] = 50
+        bucket.zoo.delete_row(bucket.zoo.find(animal="lion"))
+        bucket.birds.insert(dict(name="owl"))
+        bucket.delete_table("birds")
+        bucket.flush()
+
+        bucket = Bucket(storage_format="log", storage_path=p)
+        self.assertEqual(len(bucket.tables), 1)
+        self.assertEqual(len(bucket.zoo.find_all()), 2)
+        self.assertEqual(bucket.zoo.tbl_index_kinds, {"number": "sorted"})
+        self.assertEqual(bucket.zoo.find(number__gt=10).idd, row.idd)
+
+        # the changes after opening are appended to the same log
+        bucket.zoo.insert(dict(animal="lion", number=3))
+        bucket.flush()
+        bucket = Bucket(storage_format="log", storage_path=p)
+        self.assertEqual(len(bucket.zoo.find_all()), 3)
+        
+    def test_storage_log_compaction(self):
+        p = os.path.join(self.test_path, "test.kg")
+        options = dict(compact_size=1)
+        bucket = Bucket(storage_format="log", storage_path=p, 
+            storage_options=options)
+        for i in range(10):
+            bucket.zoo.insert(dict(number=i))
+        bucket.flush()
+        self.assertTrue(os.path.exists(p + ".snapshot"))
+
+        bucket.zoo.delete_row(bucket.zoo.find(number=0))
+        bucket.flush()
+        with open(p, 'a') as f:
+            f.write('{"op": "delete", "table": "zo')
+        
+        bucket = Bucket(storage_format="log", storage_path=p, 
+            storage_options=options)
+        self.assertEqual(len(bucket.zoo.find_all()), 9)
+        bucket.zoo.insert(dict(number=10))
+        bucket.flush()
+        bucket = Bucket(storage_format="log", storage_path=p, 
+            storage_options=options)
+        self.assertEqual(len(bucket.zoo.find_all()), 10)
+
+    def test_storage_log_threads(self):
+        p = os.path.join(self.test_path, "test.kg")
+        options = dict(compact_size=4096)
+        bucket = Bucket(storage_format="log", storage_path=p, 
+            storage_options=options)
+        names = ["zoo", "farm", "park", "forest"]
+        tables = [getattr(bucket, name) for name in names]
+        start = threading.Barrier(len(tables) + 1, timeout=5)
+
+        def writer(table):
+            start.wait()
+            for i in range(300):
+                table.insert(dict(number=i))
+
+        def flusher():
+            start.wait()
+            for i in range(20):
+                bucket.flush()
+
+        workers = [threading.Thread(target=writer, args=(t,)) 
+            for t in tables]
+        workers.append(threading.Thread(target=flusher))
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        bucket.flush()
+
+        bucket = Bucket(storage_format="log", storage_path=p, 
+            storage_options=options)
+        for name in names:
+            self.assertEqual(len(getattr(bucket, name)), 300)
+
+    def test_storage_log_recovery(self):
+        p = os.path.join(self.test_path, "test.kg")
+        options = dict(compact_size=1)
+        bucket = Bucket(storage_format="log", storage_path=p, 
+            storage_options=options)
+        bucket.zoo.insert(dict(number=1))
+        with open(p) as f:
+            stale = f.read()
+        bucket.flush()
+        # a crash after the snapshot was renamed leaves the old log
+        bucket._Bucket__storage.file.close()
+        with open(p, 'w') as f:
+            f.write(stale)
+
+        for i in range(2):
+            bucket = Bucket(storage_format="log", storage_path=p)
+            self.assertEqual(len(bucket.zoo), 1)
+        bucket.zoo.insert(dict(number=2))
+        bucket.flush()
+        bucket = Bucket(storage_format="log", storage_path=p)
+        self.assertEqual(len(bucket.zoo), 2)
+
+        # logs of older versions had updates of deleted rows
+        bucket.flush()
+        with open(p, 'a') as f:
+            f.write(json.dumps(dict(op="update", table="zoo", id=99, 
+                key="number", value=3)) + "\n")
+        bucket = Bucket(storage_format="log", storage_path=p)
+        self.assertEqual(len(bucket.zoo), 2)
+        row = bucket.zoo.find(number=2)
+        bucket.zoo.delete_row(row)
+        row["number"] = 5
+        bucket.flush()
+        bucket = Bucket(storage_format="log", storage_path=p)
+        self.assertEqual(len(bucket.zoo), 1)
+
+    def test_storage_binary(self):
+        p = os.path.join(self.test_path, "test.kg")
+        bucket = Bucket(storage_format="binary", storage_path=p)
+        bucket.zoo.add_index("number", kind="sorted")
+        bucket.zoo.insert(dict(animal="lion", number=2))
+        bucket.zoo.insert(dict(animal="kangaroo", number=100))
+        bucket.birds.insert(dict(name="owl"))
+        bucket.flush()
+
+        bucket = Bucket(storage_format="binary", storage_path=p)
+        self.assertEqual(sorted(bucket.table_names), ["birds", "zoo"])
+        self.assertEqual(bucket.zoo.find(number__gt=2).animal, "kangaroo")
+        bucket.zoo.insert(dict(animal="bear", number=7))
+        # birds is not loaded, it's copied from the previous file
+        bucket.flush()
+        bucket.zoo.insert(dict(animal="owl", number=1))
+        bucket.flush()
+
+        bucket = Bucket(storage_format="binary", storage_path=p)
+        self.assertEqual(len(bucket.zoo.find_all()), 4)
+        self.assertEqual(bucket.birds.find().name, "owl")
+        bucket.delete_table("birds")
+        self.assertEqual(len(bucket.tables), 1)
+        self.assertRaises(Exception, bucket.add_table, bucket.make_table("zoo"))
+
     def test_storage_csv(self):
         p = os.path.join(self.test_path, "test.kg")
         bucket = Bucket(storage_format="csv", storage_path=p,
@@ -152,6 +404,31 @@ class KangarooTest(unittest.TestCase):
         f = dict(row0=51)
         self.assertEqual(bucket.cidades.find(**f).row2, '"AL"')
 
+    def test_storage_csv_infer_types(self):
+        p = os.path.join(self.test_path, "test.kg")
+        with open(p, 'w') as f:
+            f.write("id,price,active,day,code,name\n")
+            f.write("1,10.5,true,2013-10-25,0051,lion\n")
+            f.write("2,3,False,2013-10-26,0052,kangaroo\n")
+            f.write("3,,true,2013-10-27,0053,\n")
+            f.write("x4,7,true,2013-10-28,0054,bear\n")
+
+        bucket = Bucket(storage_format="csv", storage_path=p, 
+            storage_options=dict(table_name="zoo", infer_types=True,
+                sample_size=3, chunk_size=2, 
+                converters=dict(name=lambda x: x.upper())))
+        row = bucket.zoo.find(id=1)
+        self.assertEqual(row.price, 10.5)
+        self.assertEqual(row.active, True)
+        self.assertEqual(row.day, datetime.date(2013, 10, 25))
+        self.assertEqual(row.code, "0051")
+        self.assertEqual(row.name, "LION")
+        self.assertFalse("price" in bucket.zoo.find(id=3))
+        self.assertEqual(bucket.zoo.find(id=3).name, "")
+        self.assertEqual(len(bucket.zoo.find_all(price__gt=5)), 2)
+        # values after the sample that can't be converted are kept
+        self.assertEqual(bucket.zoo.find(id="x4").price, 7)
+
     def test_index(self):
         bucket = Bucket()
         bucket.zoo.add_index("number")
@@ -161,6 +438,21 @@ class KangarooTest(unittest.TestCase):
         self.assertEqual(len(bucket.zoo.find_all()), 2)        
         self.assertEqual(len(bucket.zoo.find_all(**f)), 1)        
 
+    def test_insert_many(self):
+        bucket = Bucket()
+        bucket.zoo.add_index("animal")
+        bucket.zoo.add_index("number", kind="sorted")
+        bucket.zoo.insert(dict(animal="lion", number=50))
+        rows = bucket.zoo.insert_many(dict(animal="lion", number=i) 
+            for i in range(100))
+
+        self.assertEqual(len(rows), 100)
+        self.assertEqual(rows[0].idd, 2)
+        self.assertEqual(len(bucket.zoo.find_all(animal="lion")), 101)
+        self.assertEqual(len(bucket.zoo.find_all(number__range=(10, 19))), 10)
+        self.assertEqual(len(bucket.zoo.find_all(number=50)), 2)
+        self.assertEqual(bucket.zoo.explain(number=50)["access"], "index")
+
     def test_delete_row(self):
         bucket = Bucket()
         bucket.zoo.insert(dict(animal="lion", number=2))
@@ -178,6 +470,17 @@ class KangarooTest(unittest.TestCase):
         bucket.zoo.delete_row(bucket.zoo.find_all()[0])
         self.assertEqual(len(bucket.zoo.find_all()), 1)
 
+    def test_row_ids(self):
+        bucket = Bucket()
+        rows = [bucket.zoo.insert(dict(number=i)) for i in range(3)]
+        self.assertEqual([r.idd for r in rows], [1, 2, 3])
+
+        bucket.zoo.delete_row(rows[1])
+        row = bucket.zoo.insert(dict(number=3))
+        self.assertEqual(row.idd, 4)
+        self.assertEqual([r["number"] for r in bucket.zoo.find_all()], 
+            [0, 2, 3])
+
     def test_update_row_with_index(self):
         bucket = Bucket()
         bucket.zoo.add_index("number")
@@ -199,6 +502,863 @@ class KangarooTest(unittest.TestCase):
         self.assertEqual(bucket.zoo.find().new_value, 2)
         self.assertEqual(bucket.zoo.find()["new_value"], 2)
     
+    def test_sorted_index(self):
+        bucket = Bucket()
+        bucket.zoo.add_index("number", kind="sorted")
+        for i in range(10):
+            bucket.zoo.insert(dict(animal="lion{0}".format(i), number=i))
+        
+        self.assertEqual(len(bucket.zoo.find_all(number__gt=6)), 3)
+        self.assertEqual(len(bucket.zoo.find_all(number__gte=6)), 4)
+        self.assertEqual(len(bucket.zoo.find_all(number__range=[2, 4])), 3)
+        self.assertEqual(len(bucket.zoo.find_all(number__in=[1, 5, 20])), 2)
+        self.assertEqual(len(bucket.zoo.find_all(number=20)), 0)
+
+        bucket.zoo.add_index("animal", kind="sorted")
+        self.assertEqual(len(bucket.zoo.find_all(animal__startswith="lion")),
+            10)
+        self.assertEqual(len(bucket.zoo.find_all(animal__startswith="lion1",
+            number__gt=0)), 1)
+
+    def test_sorted_index_update_and_delete(self):
+        bucket = Bucket()
+        bucket.zoo.add_index("number", kind="sorted")
+        rows = [bucket.zoo.insert(dict(number=i)) for i in range(5)]
+
+        rows[0]["number"] = 100
+        self.assertEqual(len(bucket.zoo.find_all(number__gte=4)), 2)
+        self.assertEqual(len(bucket.zoo.find_all(number__range=(0, 1))), 1)
+
+        bucket.zoo.delete_row(rows[4])
+        self.assertEqual(len(bucket.zoo.find_all(number__gte=4)), 1)
+        self.assertEqual(bucket.zoo.find(number__gt=50).idd, rows[0].idd)
+
+    def test_storage_json_sorted_index(self):
+        p = os.path.join(self.test_path, "test.kg")
+        bucket = Bucket(storage_format="json", storage_path=p)
+        bucket.zoo.add_index("number", kind="sorted")
+        bucket.zoo.insert(dict(animal="lion", number=2))
+        bucket.flush()
+
+        bucket = Bucket(storage_format="json", storage_path=p)
+        self.assertEqual(bucket.zoo.tbl_index_kinds, {"number": "sorted"})
+        self.assertEqual(len(bucket.zoo.find_all(number__gt=1)), 1)
+
+    def test_index_intersection(self):
+        bucket = Bucket()
+        bucket.zoo.add_index("animal")
+        bucket.zoo.add_index("number")
+        bucket.zoo.insert(dict(animal="lion", number=2))
+        bucket.zoo.insert(dict(animal="lion", number=3))
+        bucket.zoo.insert(dict(animal="kangaroo", number=2))
+        bucket.zoo.insert(dict(animal="kangaroo", number=2))
+
+        rows = bucket.zoo.find_all(animal="lion", number=2)
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]["animal"], "lion")
+        self.assertEqual(len(bucket.zoo.find_all(animal="kangaroo", 
+            number=2)), 2)
+
+    def test_explain(self):
+        bucket = Bucket()
+        bucket.zoo.add_index("animal")
+        bucket.zoo.add_index("number", kind="sorted")
+        for i in range(10):
+            bucket.zoo.insert(dict(animal="lion", number=i, 
+                legs=i % 2 and 4 or 2))
+        bucket.zoo.insert(dict(animal="kangaroo", number=5, legs=2))
+
+        plan = bucket.zoo.explain(animal="kangaroo", number__gte=5, legs=2)
+        self.assertEqual(plan["access"], "index")
+        self.assertEqual(plan["driver"]["column"], "animal")
+        self.assertEqual(plan["residual_filters"], 
+            ["number__gte", "legs__eq"])
+        self.assertEqual(plan["scanned_rows"], 1)
+        self.assertEqual(plan["actual_rows"], 1)
+
+        plan = bucket.zoo.explain(legs=2)
+        self.assertEqual(plan["access"], "scan")
+        self.assertEqual(plan["scanned_rows"], 11)
+        self.assertEqual(plan["actual_rows"], 6)
+
+    def test_iter_find(self):
+        bucket = Bucket()
+        for i in range(10):
+            bucket.zoo.insert(dict(animal="lion", number=i))
+        
+        rows = bucket.zoo.iter_find(animal="lion", number__gte=5)
+        self.assertEqual(next(rows)["number"], 5)
+        self.assertEqual([r["number"] for r in rows], [6, 7, 8, 9])
+        self.assertEqual(bucket.zoo.find(number__gt=3)["number"], 4)
+
+    def test_find_all_limit_offset(self):
+        bucket = Bucket()
+        for i in range(10):
+            bucket.zoo.insert(dict(animal="lion", number=i))
+
+        rows = bucket.zoo.find_all(limit=3, offset=2, number__gte=1)
+        self.assertEqual([r["number"] for r in rows], [3, 4, 5])
+        self.assertEqual(len(bucket.zoo.find_all(offset=8)), 2)
+        self.assertEqual(len(bucket.zoo.find_all(limit=0)), 0)
+
+        # the pages don't change when an index drives the query
+        animals = ["lion", "tiger", "bear", "kangaroo", "koala"]
+        for i in range(30):
+            bucket.zoo.insert(dict(animal=animals[i % 5], number=i % 7))
+        queries = [dict(animal__in=["koala", "bear", "lion", "bear"]),
+            dict(number__gte=4), dict(number__range=(2, 5), 
+            animal__in=("tiger", "koala"))]
+        pages = [bucket.zoo.find_all(limit=4, offset=2, **q) 
+            for q in queries]
+        bucket.zoo.add_index("animal")
+        bucket.zoo.add_index("number", kind="sorted")
+        for query, page in zip(queries, pages):
+            self.assertEqual(bucket.zoo.explain(**query)["access"], "index")
+            self.assertEqual([r.idd for r in bucket.zoo.find_all(limit=4,
+                offset=2, **query)], [r.idd for r in page])
+
+    def test_compact_rows(self):
+        bucket = Bucket(table_format="compact")
+        bucket.zoo.add_index("number", kind="sorted")
+        bucket.zoo.insert(dict(animal="lion", number=2))
+        row = bucket.zoo.insert(dict(animal="kangaroo", number=100))
+
+        self.assertEqual(row, dict(animal="kangaroo", number=100))
+        self.assertEqual(row.animal, "kangaroo")
+        self.assertFalse("legs" in row)
+        row.number = 1
+        row["legs"] = 2
+        self.assertEqual(bucket.zoo.find(number__range=(0, 1)).idd, row.idd)
+        self.assertEqual(bucket.zoo.find(legs=2).animal, "kangaroo")
+        self.assertFalse("legs" in bucket.zoo.find(animal="lion"))
+        self.assertRaises(AttributeError, setattr, row, "other", 1)
+
+        del row["legs"]
+        self.assertEqual(bucket.zoo.find(legs=2), None)
+
+    def test_storage_compact_rows(self):
+        for storage_format in ("pickle", "json"):
+            p = os.path.join(self.test_path, "test.kg")
+            bucket = Bucket(storage_format=storage_format, storage_path=p,
+                table_format="compact")
+            bucket.zoo.insert(dict(animal="lion", number=2))
+            bucket.zoo.insert(dict(animal="kangaroo"))
+            bucket.flush()
+
+            bucket = Bucket(storage_format=storage_format, storage_path=p,
+                table_format="compact")
+            self.assertEqual(bucket.zoo.find(number=2).animal, "lion")
+            self.assertEqual(bucket.zoo.find(animal="kangaroo").keys(),
+                {"animal"})
+            os.remove(p)
+
+    @unittest.skipIf(columnar.numpy is None, "numpy is not installed")
+    def test_columnar_table(self):
+        bucket = Bucket(table_format="columnar")
+        for i in range(2000):
+            bucket.zoo.insert(dict(animal="lion{0}".format(i % 3), number=i))
+        bucket.zoo.insert(dict(animal="kangaroo", number=2500, legs=2.5))
+
+        self.assertEqual(len(bucket.zoo.find_all(number__gt=1997)), 3)
+        self.assertEqual(len(bucket.zoo.find_all(number__range=(2, 3))), 2)
+        self.assertEqual(len(bucket.zoo.find_all(number__in=[1, 2])), 2)
+        self.assertEqual(len(bucket.zoo.find_all(animal="lion1", 
+            number__gte=1990)), 4)
+        self.assertEqual(len(bucket.zoo.find_all(legs__gt=2)), 1)
+        self.assertEqual(bucket.zoo.find(number=7)["number"], 7)
+        self.assertFalse("legs" in bucket.zoo.find(number=7))
+
+        row = bucket.zoo.find(animal="kangaroo")
+        row["number"] = "many"
+        self.assertEqual(bucket.zoo.find(number="many").idd, row.idd)
+        self.assertEqual(bucket.zoo.find(number=7)["number"], 7)
+        bucket.zoo.delete_row(row)
+        self.assertEqual(bucket.zoo.find(number="many"), None)
+        self.assertRaises(ValueError, bucket.zoo.delete_row, row)
+        other = Bucket(table_format="columnar").zoo
+        self.assertRaises(ValueError, bucket.zoo.delete_row, 
+            other.insert(dict(number=7)))
+        self.assertEqual(bucket.zoo.count(number=7), 1)
+        self.assertEqual(len(bucket.zoo.find_all(limit=5, offset=1998)), 2)
+
+        bucket.zoo.insert({"table": 4, "self": "chair", 1: "one"})
+        row = bucket.zoo.find(table=4)
+        self.assertEqual(row["self"], "chair")
+        self.assertEqual(row[1], "one")
+        self.assertTrue(row.table is bucket.zoo)
+
+    @unittest.skipIf(columnar.numpy is None, "numpy is not installed")
+    def test_storage_json_columnar(self):
+        p = os.path.join(self.test_path, "test.kg")
+        bucket = Bucket(storage_format="json", storage_path=p,
+            table_format="columnar")
+        bucket.zoo.insert(dict(animal="lion", number=2))
+        bucket.zoo.insert(dict(animal="kangaroo", number=100))
+        bucket.flush()
+
+        bucket = Bucket(storage_format="json", storage_path=p,
+            table_format="columnar")
+        self.assertTrue(isinstance(bucket.zoo, columnar.ColumnarTable))
+        self.assertEqual(bucket.zoo.find(number__gt=2).animal, "kangaroo")
+
+    def test_query_cache(self):
+        bucket = Bucket()
+        bucket.zoo.enable_cache(max_size=2)
+        bucket.zoo.insert(dict(animal="lion", number=2))
+        kangaroo = bucket.zoo.insert(dict(animal="kangaroo", number=100))
+
+        self.assertEqual(len(bucket.zoo.find_all(number__gt=1)), 2)
+        self.assertEqual(len(bucket.zoo.find_all(number__gt=1)), 2)
+        stats = bucket.zoo.cache_stats
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+        # rows that don't match the filters keep the result
+        bucket.zoo.insert(dict(animal="ant", number=0))
+        self.assertEqual(len(bucket.zoo.find_all(number__gt=1)), 2)
+        self.assertEqual(bucket.zoo.cache_stats["hits"], 2)
+
+        bucket.zoo.insert(dict(animal="bear", number=5))
+        self.assertEqual(len(bucket.zoo.find_all(number__gt=1)), 3)
+        self.assertEqual(bucket.zoo.cache_stats["misses"], 2)
+
+        kangaroo.number = 0
+        self.assertEqual(len(bucket.zoo.find_all(number__gt=1)), 2)
+        bucket.zoo.delete_row(kangaroo)
+        self.assertEqual(len(bucket.zoo.find_all(number__gt=1)), 2)
+
+        bucket.zoo.find_all(animal="lion")
+        bucket.zoo.find_all(animal="bear")
+        self.assertEqual(bucket.zoo.cache_stats["evictions"], 1)
+        self.assertEqual(bucket.zoo.cache_stats["size"], 2)
+
+        bucket.zoo.disable_cache()
+        self.assertEqual(bucket.zoo.cache_stats, None)
+
+    def test_autosave(self):
+        p = os.path.join(self.test_path, "test.kg")
+        bucket = Bucket(storage_format="json", storage_path=p)
+        bucket.enable_autosave(changes=2)
+        bucket.zoo.insert(dict(animal="lion", number=2))
+        bucket.zoo.insert(dict(animal="kangaroo", number=100))
+        deadline = time.time() + 5
+        while not os.path.exists(p) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(os.path.exists(p))
+
+        # flushes made while a save is running are saved together
+        saves = []
+        started = threading.Event()
+        release = threading.Event()
+        dump = bucket._Bucket__storage.dump
+
+        def blocked_dump():
+            if not saves:
+                started.set()
+                release.wait(5)
+            saves.append(dump())
+
+        requests = []
+        autosave = bucket._Bucket__autosave
+        request = autosave.request
+
+        def counted_request():
+            ticket = request()
+            requests.append(ticket)
+            return ticket
+
+        autosave.request = counted_request
+        bucket._Bucket__storage.dump = blocked_dump
+        first = threading.Thread(target=bucket.flush)
+        first.start()
+        self.assertTrue(started.wait(5))
+        threads = [threading.Thread(target=bucket.flush) for i in range(8)]
+        for t in threads:
+            t.start()
+        deadline = time.time() + 5
+        while len(requests) < 9 and time.time() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for t in [first] + threads:
+            t.join()
+        self.assertEqual(len(saves), 2)
+
+        bucket.zoo.insert(dict(animal="bear", number=5))
+        asyncio.run(bucket.aflush())
+        bucket.disable_autosave()
+        self.assertEqual(len(Bucket(storage_format="json",
+            storage_path=p).zoo), 3)
+
+    def test_autosave_interval(self):
+        p = os.path.join(self.test_path, "test.kg")
+        bucket = Bucket(storage_format="pickle", storage_path=p)
+        bucket.enable_autosave(interval=0.05)
+        bucket.zoo.insert(dict(animal="lion", number=2))
+        deadline = time.time() + 5
+        while not os.path.exists(p) and time.time() < deadline:
+            time.sleep(0.01)
+        bucket.disable_autosave()
+        self.assertEqual(len(Bucket(storage_format="pickle",
+            storage_path=p).zoo), 1)
+
+    def test_rw_lock(self):
+        lock = RWLock()
+        inside = threading.Barrier(2, timeout=5)
+
+        def reader():
+            with lock.reader:
+                # both readers have to be inside at the same time
+                inside.wait()
+
+        threads = [threading.Thread(target=reader) for i in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertFalse(inside.broken)
+
+        events = []
+
+        def blocked_reader():
+            with lock.reader:
+                events.append("read")
+
+        with lock:
+            with lock.reader:
+                t = threading.Thread(target=blocked_reader)
+                t.start()
+                t.join(0.05)
+                self.assertEqual(events, [])
+            events.append("write")
+        t.join()
+        self.assertEqual(events, ["write", "read"])
+
+        with lock.reader:
+            self.assertRaises(Exception, lock.acquire_write)
+
+    def test_concurrent_tables(self):
+        bucket = Bucket()
+        tables = []
+
+        def worker(n):
+            table = bucket.zoo
+            tables.append(table)
+            for i in range(200):
+                row = table.insert(dict(number=i, thread=n))
+                row["number"] = i + 1
+                table.find_all(thread=n, number__gt=100)
+
+        bucket.zoo.add_index("thread")
+        bucket.delete_table("zoo")
+        threads = [threading.Thread(target=worker, args=(i,)) 
+            for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(set(id(t) for t in tables)), 1)
+        self.assertEqual(len(bucket.zoo), 800)
+        self.assertEqual(len(bucket.zoo.find_all(number__gt=100)), 400)
+
+    def test_parallel_scan(self):
+        bucket = Bucket()
+        bucket.zoo.insert_many(dict(number=i, animal="lion" if i % 3 else
+            "ant") for i in range(1000))
+        bucket.zoo.insert(dict(animal="bear"))
+        expected = [r.idd for r in bucket.zoo.find_all(number__gt=500,
+            animal="ant")]
+
+        bucket.zoo.enable_parallel_scan(threshold=100, processes=2,
+            chunk_size=128)
+        try:
+            rows = bucket.zoo.find_all(number__gt=500, animal="ant")
+            self.assertEqual([r.idd for r in rows], expected)
+            self.assertTrue(rows[0] is bucket.zoo.get_row(rows[0].idd))
+            self.assertEqual(len(bucket.zoo.find_all(number__range=(1, 10),
+                limit=3)), 3)
+
+            # queries that can stop early don't fork the pool
+            scans = []
+            parallel = bucket.zoo._Table__parallel
+            scan = parallel.scan
+            parallel.scan = lambda *args: scans.append(1) or scan(*args)
+            self.assertEqual(bucket.zoo.find(animal="ant").idd, 1)
+            self.assertEqual(next(bucket.zoo.iter_find(animal="ant")).idd, 1)
+            self.assertEqual(len(scans), 0)
+            self.assertEqual(bucket.zoo.count(animal="ant"), 334)
+            self.assertEqual(len(scans), 1)
+        finally:
+            bucket.zoo.disable_parallel_scan()
+
+    def test_partitioned_table(self):
+        p = os.path.join(self.test_path, "test.kg")
+        bucket = Bucket(storage_format="directory", storage_path=p)
+        cities = bucket.add_partitioned_table("cities", "state", shards=4,
+            tbl_index=["name"])
+        cities.insert_many(dict(state=s, name="{0}{1}".format(s, i), 
+            number=i) for s in ["SP", "RJ", "MG", "BA"] for i in range(10))
+        self.assertEqual(len(cities), 40)
+
+        # a string is not a list of values, every shard is visited
+        self.assertEqual(cities.count(state__in="SPRJ"), 20)
+        self.assertEqual(len(cities.explain(state__in="SPRJ")["shards"]), 4)
+        result = cities.explain(state="SP", number__gt=4)
+        self.assertEqual(len(result["shards"]), 1)
+        self.assertEqual(result["actual_rows"], 5)
+        self.assertEqual(len(cities.find_all(number__gt=4, limit=12, 
+            offset=3)), 12)
+        self.assertEqual(cities.find(name="RJ3").number, 3)
+
+        # a row whose key changes is moved to the shard of the new value
+        row = cities.find(name="RJ3")
+        row["state"] = "SP"
+        self.assertEqual(cities.find(state="SP", name="RJ3").number, 3)
+        self.assertEqual(cities.find(state="RJ", name="RJ3"), None)
+        # the same object is kept, so later changes reach the table
+        row = cities.find(name="SP5")
+        row["state"] = "BA"
+        self.assertTrue(row.table is cities.shard(cities.position("BA")))
+        self.assertFalse(row.table is cities.shard(cities.position("SP")))
+        row["number"] = 55
+        self.assertEqual(cities.find(name="SP5").number, 55)
+        self.assertEqual(cities.count(number=55), 1)
+        self.assertEqual(cities.count(number=5), 3)
+        row["state"] = "SP"
+        row["number"] = 5
+        self.assertEqual(cities.count(number=5), 4)
+        bucket.flush()
+
+        bucket = Bucket(storage_format="directory", storage_path=p)
+        self.assertEqual(len(bucket.cities.find_all(state="SP")), 11)
+        # only the shard of "SP" and the description were loaded
+        self.assertEqual(len(bucket.table_names) - 
+            len(bucket._Bucket__lazy_tables()), 2)
+        self.assertEqual(len(bucket.cities), 40)
+
+        bucket.delete_table("cities")
+        self.assertEqual(bucket.table_names, [Bucket.PARTITIONS])
+
+    def test_range_partitioned_table(self):
+        bucket = Bucket()
+        sales = bucket.add_partitioned_table("sales", "year", shards=3,
+            boundaries=[2000, 2010])
+        sales.insert_many(dict(year=y) for y in range(1990, 2020))
+        self.assertEqual([len(s) for s in sales.shards], [10, 10, 10])
+        self.assertEqual(sales.explain(year__gte=2012)["shards"], 
+            ["sales#2"])
+        self.assertEqual(len(sales.explain(year__range=(1995, 2005))[
+            "shards"]), 2)
+        self.assertEqual(len(sales.find_all(year__range=(1995, 2005))), 11)
+        sales.insert(dict(year=None))
+        self.assertEqual(len(sales.shard(0)), 11)
+        sales.find(year=2015)["year"] = 1980
+        self.assertEqual(len(sales.shard(0)), 12)
+
+        hashed = bucket.add_partitioned_table("floats", "value", shards=3)
+        hashed.insert_many([dict(value=float("nan")), dict(value=1.0),
+            dict(value=float("inf"))])
+        self.assertEqual(hashed.position(1.0), hashed.position(True))
+        self.assertEqual(len(hashed), 3)
+
+        bucket = Bucket(table_format="columnar")
+        self.assertRaises(Exception, bucket.add_partitioned_table, "sales",
+            "year", shards=3, boundaries=[2000, 2010])
+
+    def test_partition_move_threads(self):
+        p = os.path.join(self.test_path, "test.kg")
+        bucket = Bucket(storage_format="pickle", storage_path=p)
+        counters = bucket.add_partitioned_table("counters", "number", 
+            shards=2, boundaries=[100])
+        rows = counters.insert_many(dict(number=100 + i) for i in range(200))
+        start = threading.Barrier(2, timeout=5)
+
+        def mover():
+            # the rows move from counters#1 to counters#0 while the flush
+            # locks the shards in the order of their names
+            start.wait()
+            for row in rows:
+                row["number"] -= 200
+
+        def flusher():
+            start.wait()
+            for i in range(50):
+                bucket.flush()
+
+        workers = [threading.Thread(target=mover), 
+            threading.Thread(target=flusher)]
+        for w in workers:
+            w.daemon = True
+            w.start()
+        for w in workers:
+            w.join(10)
+            self.assertFalse(w.is_alive())
+        self.assertEqual([len(s) for s in counters.shards], [200, 0])
+        self.assertTrue(all(r.table is counters.shard(0) for r in rows))
+
+    def test_bench_suite(self):
+        result = bench.suite(sizes=[200], repeat=1, formats=["json", "csv"],
+            cidades=None)
+        dataset = result["datasets"]["synthetic_200"]
+        self.assertEqual(dataset["rows"], 200)
+        self.assertEqual(sorted(dataset["queries"]["gt"]), 
+            ["rows", "scan", "sorted"])
+        self.assertEqual(sorted(dataset["storages"]), ["csv", "json"])
+        # the result can be saved as json
+        json.dumps(result)
+
+    def test_profiling(self):
+        bucket = Bucket()
+        bucket.zoo.insert_many(dict(animal="lion", number=i) 
+            for i in range(100))
+        bucket.zoo.add_index("number", kind="sorted")
+        profiles = []
+        profiler = bucket.enable_profiling(slow_query_seconds=0,
+            callback=profiles.append)
+        bucket.birds.insert(dict(name="owl"))
+
+        with self.assertLogs("kangaroo.profiling", level="WARNING"):
+            bucket.zoo.find_all(number__gt=89, animal="lion")
+        bucket.zoo.find_all(animal="lion", limit=5)
+        bucket.birds.find(name="owl")
+
+        self.assertEqual(profiles[0].access, "index")
+        self.assertEqual(profiles[0].index["column"], "number")
+        self.assertEqual((profiles[0].rows_scanned, 
+            profiles[0].rows_returned), (10, 10))
+        self.assertEqual((profiles[1].access, profiles[1].rows_scanned),
+            ("scan", 5))
+        stats = profiler.stats
+        self.assertEqual(stats["zoo"]["queries"], 2)
+        self.assertEqual(stats["zoo"]["operators"], dict(gt=1, eq=2))
+        self.assertEqual(stats["zoo"]["rows_returned"], 15)
+        self.assertEqual(stats["birds"]["slow_queries"], 1)
+
+        bucket.disable_profiling()
+        bucket.zoo.find_all()
+        self.assertEqual(len(profiles), 3)
+
+    def test_aggregates(self):
+        bucket = Bucket()
+        bucket.zoo.insert_many([dict(animal="lion", number=2), 
+            dict(animal="lion", number=5), dict(animal="kangaroo", number=9),
+            dict(animal="kangaroo"), dict(number=1)])
+        zoo = bucket.zoo
+
+        self.assertEqual(zoo.count(), 5)
+        self.assertEqual(zoo.count(animal="lion"), 2)
+        self.assertEqual(zoo.count(animal="lion", number__gt=2), 1)
+        self.assertEqual(zoo.aggregate(sum="number", min="number", 
+            max="number"), dict(sum=17, min=1, max=9))
+        self.assertEqual(zoo.aggregate(sum="number", animal="tiger"), 
+            dict(sum=0))
+        groups = zoo.group_by("animal", max="number")
+        self.assertEqual(groups["lion"], dict(count=2, max=5))
+        self.assertEqual(groups["kangaroo"], dict(count=2, max=9))
+        self.assertEqual(groups[None], dict(count=1, max=1))
+
+        zoo.add_index("animal")
+        zoo.add_index("number", kind="sorted")
+        self.assertEqual(zoo.count(animal="lion"), 2)
+        self.assertEqual(zoo.count(number__gte=5), 2)
+        self.assertEqual(zoo.aggregate(min="number", max="number"), 
+            dict(min=1, max=9))
+        self.assertEqual(zoo.group_by("animal"), {"lion": dict(count=2), 
+            "kangaroo": dict(count=2), None: dict(count=1)})
+
+        sales = bucket.add_partitioned_table("sales", "year", shards=3)
+        sales.insert_many(dict(year=y, total=y % 10) for y in range(2000, 
+            2020))
+        self.assertEqual(sales.count(year__gte=2010), 10)
+        self.assertEqual(sales.aggregate(sum="total", max="year"),
+            dict(sum=90, max=2019))
+        self.assertEqual(sales.group_by("total", min="year")[3], 
+            dict(count=2, min=2003))
+
+    def test_order_by(self):
+        bucket = Bucket()
+        zoo = bucket.zoo
+        zoo.insert_many([dict(animal="lion", score=s) 
+            for s in [5, 1, 9, 3, 7]] + [dict(animal="lion"), 
+            dict(animal="lion", score=None), dict(animal="kangaroo", score=8)])
+
+        def scores(rows):
+            return [r.get("score") for r in rows]
+
+        self.assertEqual(scores(zoo.find_all(order_by="-score", limit=3)),
+            [9, 8, 7])
+        self.assertEqual(scores(zoo.find_all(order_by="score", limit=2,
+            offset=1)), [3, 5])
+        self.assertEqual(scores(zoo.find_all(order_by="score", 
+            animal="lion")), [1, 3, 5, 7, 9, None, None])
+        self.assertEqual(scores(zoo.find_all(order_by="-score", 
+            animal="lion"))[:5], [9, 7, 5, 3, 1])
+
+        expected = [scores(zoo.find_all(order_by=o, limit=l, offset=f, 
+            animal="lion")) for o in ("score", "-score") 
+            for l, f in ((3, 0), (2, 4), (None, 0))]
+        zoo.add_index("score", kind="sorted")
+        self.assertEqual(zoo.explain(animal="lion")["access"], "scan")
+        self.assertEqual([scores(zoo.find_all(order_by=o, limit=l, offset=f,
+            animal="lion")) for o in ("score", "-score") 
+            for l, f in ((3, 0), (2, 4), (None, 0))], expected)
+
+        zoo.enable_cache()
+        self.assertEqual(scores(zoo.find_all(order_by="-score", limit=1)), 
+            [9])
+        zoo.find(score=1)["score"] = 10
+        self.assertEqual(scores(zoo.find_all(order_by="-score", limit=1)), 
+            [10])
+
+        sales = bucket.add_partitioned_table("sales", "year", shards=3)
+        sales.insert_many(dict(year=y, total=(y * 7) % 20) 
+            for y in range(2000, 2020))
+        rows = sales.find_all(order_by="-total", limit=4, offset=1)
+        self.assertEqual([r["total"] for r in rows], [18, 17, 16, 15])
+
+    def test_join(self):
+        bucket = Bucket()
+        bucket.customers.insert_many([dict(id=1, name="ana"), 
+            dict(id=2, name="bob"), dict(id=3, name="eva"), dict(name="x")])
+        bucket.orders.insert_many([dict(customer_id=1, total=10), 
+            dict(customer_id=1, total=200), dict(customer_id=3, total=150),
+            dict(customer_id=4, total=300), dict(customer_id=None, total=5),
+            dict(total=1)])
+
+        def names(pairs):
+            return sorted((o["total"], c and c["name"]) for o, c in pairs)
+
+        expected = [(10, "ana"), (150, "eva"), (200, "ana")]
+        self.assertEqual(names(bucket.join("orders", "customers", 
+            "customer_id", "id")), expected)
+        self.assertEqual(names(bucket.join("orders", "customers", 
+            "customer_id", "id", left_filters=dict(total__gt=100), 
+            right_filters=dict(name__in=["ana", "bob"]))), [(200, "ana")])
+        self.assertEqual(names(bucket.join("orders", "customers", 
+            "customer_id", "id", how="left")), [(1, None), (5, None), 
+            (10, "ana"), (150, "eva"), (200, "ana"), (300, None)])
+
+        bucket.customers.add_index("id")
+        self.assertEqual(names(bucket.join(bucket.orders, bucket.customers, 
+            "customer_id", "id")), expected)
+        self.assertEqual(names(bucket.join("orders", "customers", 
+            "customer_id", "id", right_filters=dict(name="eva"))), 
+            [(150, "eva")])
+        bucket.orders.add_index("customer_id")
+        bucket.customers.delete_index("id")
+        self.assertEqual(names(bucket.join("orders", "customers", 
+            "customer_id", "id", left_filters=dict(total__range=(0, 100)))), 
+            [(10, "ana")])
+        for order, customer in bucket.join("orders", "customers",
+                "customer_id", "id"):
+            self.assertEqual(order["customer_id"], customer["id"])
+
+    def test_projection(self):
+        formats = [None, "compact"]
+        if columnar.numpy is not None:
+            formats.append("columnar")
+        for table_format in formats:
+            bucket = Bucket(table_format=table_format)
+            bucket.zoo.insert_many([dict(animal="lion", number=2, legs=4),
+                dict(animal="kangaroo", number=100), dict(number=7)])
+            zoo = bucket.zoo
+            self.assertEqual(zoo.find_all(fields=["animal", "number"]), 
+                [dict(animal="lion", number=2), 
+                dict(animal="kangaroo", number=100), dict(number=7)])
+            self.assertEqual(zoo.find_all(fields=["number", "legs"], 
+                values_list=True, number__gt=1, limit=2), 
+                [(2, 4), (100, None)])
+            self.assertEqual(zoo.find_all(fields=["animal"], 
+                values_list=True, order_by="-number"), 
+                [("kangaroo",), (None,), ("lion",)])
+            self.assertEqual(type(zoo.find_all(fields=["legs"])[0]), dict)
+            self.assertRaises(Exception, zoo.find_all, values_list=True)
+
+        p = os.path.join(self.test_path, "test.kg")
+        bucket = Bucket(storage_format="csv", storage_path=p)
+        bucket.zoo.insert(dict(animal="lion", number=2))
+        bucket.zoo.insert(dict(number=100, animal="kangaroo"))
+        bucket.flush()
+        bucket = Bucket(storage_format="csv", storage_path=p, 
+            storage_options=dict(table_name="zoo"))
+        self.assertEqual(bucket.zoo.find(number="100").animal, "kangaroo")
+
+    def test_update_delete_where(self):
+        for table_format in [None, "compact"]:
+            bucket = Bucket(table_format=table_format)
+            zoo = bucket.zoo
+            zoo.add_index("animal")
+            zoo.add_index("number", kind="sorted")
+            zoo.insert_many([dict(animal="lion", number=i) for i in range(5)]
+                + [dict(animal="kangaroo", number=i) for i in range(3)])
+            events = []
+            zoo.add_listener(lambda e, t, r, k: events.append((e, k)))
+
+            self.assertEqual(zoo.update_where(dict(animal="lion", 
+                number__gte=3), dict(animal="tiger", legs=4)), 2)
+            self.assertEqual(events.count(("update", "animal")), 2)
+            self.assertEqual(events.count(("update", "legs")), 2)
+            self.assertEqual(zoo.count(animal="tiger"), 2)
+            self.assertEqual(zoo.count(animal="lion"), 3)
+            self.assertEqual(zoo.find(animal="tiger").legs, 4)
+            self.assertEqual(zoo.update_where(dict(animal="bear"), 
+                dict(number=1)), 0)
+
+            self.assertEqual(zoo.update_where(dict(animal="kangaroo"), 
+                dict(number=10)), 3)
+            self.assertEqual(zoo.count(number=10), 3)
+            self.assertEqual(zoo.count(number__gte=5), 3)
+            self.assertEqual(zoo.aggregate(max="number", min="number"), 
+                dict(max=10, min=0))
+
+            # the sorted index rejects the value after the animal index 
+            # was updated, nothing changes
+            count = len(events)
+            self.assertRaises(TypeError, zoo.update_where, 
+                dict(animal="kangaroo"), dict(animal="koala", number="x",
+                legs=2))
+            self.assertEqual(zoo.count(animal="kangaroo"), 3)
+            self.assertEqual(zoo.count(animal="koala"), 0)
+            self.assertEqual(zoo.count(number=10), 3)
+            self.assertEqual(zoo.count(number="x"), 0)
+            self.assertFalse("legs" in zoo.find(animal="kangaroo"))
+            self.assertEqual(len(events), count)
+
+            self.assertEqual(zoo.delete_where(dict(number__gte=3)), 5)
+            self.assertEqual(len(zoo), 3)
+            self.assertEqual(zoo.count(animal="kangaroo"), 0)
+            self.assertEqual(zoo.aggregate(max="number"), dict(max=2))
+            self.assertEqual(events.count(("delete", None)), 5)
+
+        sales = bucket.add_partitioned_table("sales", "year", shards=3)
+        sales.insert_many(dict(year=y % 4, total=1) for y in range(20))
+        self.assertEqual(sales.update_where(dict(year__in=[1, 2]), 
+            dict(year=3)), 10)
+        self.assertEqual(sales.count(year=3), 15)
+        self.assertEqual(sales.delete_where(dict(year=3)), 15)
+        self.assertEqual(len(sales), 5)
+
+    def test_composite_index(self):
+        bucket = Bucket()
+        cities = bucket.cities
+        cities.insert_many([dict(country="BR", state="AL", city="Maceio"),
+            dict(country="BR", state="SP", city="Santos"),
+            dict(country="BR", state="AL", city="Arapiraca"),
+            dict(country="AR", state="BA", city="La Plata"),
+            dict(country="BR", city="Brasilia")])
+        cities.add_index(("country", "state"))
+        self.assertEqual(cities.tbl_index, [("country", "state")])
+        self.assertEqual(cities.tbl_index_kinds, {})
+
+        plan = cities.explain(country="BR", state="AL")
+        self.assertEqual(plan["driver"]["column"], ("country", "state"))
+        self.assertEqual(plan["residual_filters"], [])
+        self.assertEqual(plan["actual_rows"], 2)
+        plan = cities.explain(country="BR", city="Santos")
+        self.assertEqual(plan["driver"]["estimated_rows"], 4)
+        self.assertEqual(plan["residual_filters"], ["city__eq"])
+        self.assertEqual(plan["actual_rows"], 1)
+        self.assertEqual(cities.explain(state="AL")["access"], "scan")
+        self.assertEqual(cities.count(country="BR", state="AL"), 2)
+        self.assertEqual(cities.count(country="BR"), 4)
+
+        row = cities.find(city="Santos")
+        row["state"] = "AL"
+        self.assertEqual(cities.count(country="BR", state="AL"), 3)
+        self.assertEqual(cities.find_all(country="BR", state="SP"), [])
+        row["country"] = "CL"
+        self.assertEqual(cities.count(country="BR"), 3)
+        self.assertEqual(cities.update_where(dict(city="Brasilia"), 
+            dict(state="DF")), 1)
+        self.assertEqual(cities.find(country="BR", state="DF").city, 
+            "Brasilia")
+        cities.delete_row(cities.find(city="Maceio"))
+        self.assertEqual(cities.count(country="BR", state="AL"), 1)
+        self.assertRaises(Exception, cities.add_index, ("a", "b"), 
+            kind="sorted")
+
+        for storage_format in ["json", "jsonl", "log", "pickle"]:
+            p = os.path.join(self.test_path, "test.kg")
+            bucket = Bucket(storage_format=storage_format, storage_path=p)
+            bucket.cities.add_index("city", kind="sorted")
+            bucket.cities.insert(dict(country="BR", state="AL", city="Maceio"))
+            bucket.cities.add_index(["country", "state"])
+            bucket.flush()
+            bucket = Bucket(storage_format=storage_format, storage_path=p)
+            self.assertEqual(sorted(bucket.cities.tbl_index, key=str), 
+                [("country", "state"), "city"])
+            self.assertEqual(bucket.cities.explain(country="BR", 
+                state="AL")["actual_rows"], 1)
+            os.remove(p)
+
+    def test_rows_of_other_tables(self):
+        bucket = Bucket()
+        bucket.customers.add_index("n")
+        customer = bucket.customers.insert(dict(name="ana", n=1))
+        order = bucket.orders.insert(dict(total=10, n=5))
+        self.assertEqual(customer.idd, order.idd)
+        self.assertRaises(ValueError, bucket.customers.delete_row, order)
+        self.assertEqual(len(bucket.customers), 1)
+        bucket.customers.row_updated(order, "n")
+        self.assertEqual(bucket.customers.count(n=5), 0)
+
+        bucket.customers.delete_row(customer)
+        self.assertRaises(ValueError, bucket.customers.delete_row, customer)
+        customer["n"] = 5
+        self.assertEqual(bucket.customers.find_all(n=5), [])
+        self.assertEqual(bucket.customers.count(n=5), 0)
+        row = bucket.customers.insert(dict(n=7))
+        bucket.customers.delete_where(dict(n=7))
+        row["n"] = 8
+        self.assertEqual(bucket.customers.count(n=8), 0)
+        self.assertEqual(len(bucket.customers), 0)
+
+    def test_index_errors(self):
+        for table_format in [None, "compact"]:
+            bucket = Bucket(table_format=table_format)
+            zoo = bucket.zoo
+            zoo.add_index("n", kind="sorted")
+            zoo.add_index("animal")
+            zoo.insert(dict(n=1, animal="lion"))
+            self.assertRaises(TypeError, zoo.insert, dict(n="a", animal="x"))
+            self.assertRaises(TypeError, zoo.insert_many, 
+                [dict(n=2, animal="y"), dict(n="a", animal="z")])
+            self.assertEqual(len(zoo), 1)
+            self.assertEqual(zoo.find_all(n="a"), [])
+            self.assertEqual(zoo.count(animal="x"), 0)
+            self.assertEqual(zoo.count(animal="y"), 0)
+            self.assertEqual(zoo.index_groups("n"), {1: {1: zoo.find(n=1)}})
+            self.assertEqual(zoo.aggregate(max="n"), dict(max=1))
+            zoo.insert(dict(n=3, animal="lion"))
+            self.assertEqual(zoo.count(n__gt=0), 2)
+
+            # the composite index is updated before the sorted one fails
+            zoo.add_index(("animal", "n"))
+            zoo.delete_index("n")
+            zoo.add_index("n", kind="sorted")
+            events = []
+            zoo.add_listener(lambda *args: events.append(args[0]))
+            row = zoo.find(n=3)
+            self.assertRaises(TypeError, row.__setitem__, "n", "a")
+            self.assertEqual(row["n"], 3)
+            self.assertEqual(zoo.find(n=3), row)
+            self.assertEqual(zoo.find_all(n="a"), [])
+            self.assertEqual(zoo.count(animal="lion", n=3), 1)
+            self.assertEqual(zoo.count(animal="lion", n="a"), 0)
+            self.assertEqual(events, [])
+            zoo.delete_index(("animal", "n"))
+
+            zoo.delete_index("animal")
+            zoo.insert(dict(animal=5))
+            self.assertRaises(TypeError, zoo.add_index, "animal", 
+                kind="sorted")
+            self.assertEqual(zoo.tbl_index, ["n"])
+
+            zoo.delete_where(dict(animal=5))
+            zoo.add_index("animal")
+            zoo.insert(dict(animal="l"))
+            # a string is searched like a substring, not as a set of letters
+            self.assertEqual(len(zoo.find_all(animal__in="lion")), 3)
+            self.assertEqual(len(zoo.find_all(animal__in=["l", "x"])), 1)
+
     def test_weird_name_override(self):
         bucket = Bucket()
         names = ["__setitem__", "__setattr__", "__init__"]